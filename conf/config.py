@@ -71,6 +71,17 @@ DB_MYSQL_USER = 'user'
 DB_MYSQL_PASS = 'pass'
 DB_MYSQL_PORT = 3306            # Default port for MySQL
 
+# Read replicas. Auth checks and stats reads go to these, falling back to the
+# primary above when a replica is down or lags more than DB_MYSQL_REPLICA_MAX_LAG.
+# Missing keys are taken from the primary settings.
+DB_MYSQL_REPLICAS = []
+#DB_MYSQL_REPLICAS = [
+#    {'host': '127.0.0.1', 'port': 3307},
+#    {'host': '127.0.0.1', 'port': 3308, 'user': 'readonly', 'pass': 'pass'},
+#]
+DB_MYSQL_REPLICA_MAX_LAG = 30   # Seconds behind the primary before a replica is skipped
+DB_MYSQL_REPLICA_CHECKTIME = 30 # How often the replication lag is checked
+
 # ******************** Adv. DB Settings *********************
 #  Don't change these unless you know what you are doing
 
@@ -81,6 +92,24 @@ DB_LOADER_FORCE_TIME = 300      # How often the cache should be flushed into the
 DB_STATS_AVG_TIME = 300         # When using the DATABASE_EXTEND option, average speed over X sec
                                 # Note: this is also how often it updates
 DB_USERCACHE_TIME = 600         # How long the usercache is good for before we refresh
+DB_USERCACHE_JITTER = 60        # Random extra seconds per entry, spreads the refreshes out
+DB_USERCACHE_NEGATIVE_TIME = 60 # How long failed logins are cached
+DB_USERCACHE_STALE_TIME = 300   # How long an expired entry is still used while it is refreshed
+DB_USERCACHE_SIZE = 100000      # Most worker/password results kept, the least recently used are dropped
+DB_SOLUTION_CACHE_SIZE = 10000  # How many inserted share ids are kept for found block updates
+
+DB_SHARE_ROLLUP = False         # Aggregate shares into one row per worker every DB_ROLLUP_TIME (share_rollups table)
+DB_ROLLUP_TIME = 60             # Length of a rollup bucket in seconds
+DB_SHARE_ROWS = True            # Also insert one row per share. Found blocks are always recorded.
+                                # Set to False with DB_SHARE_ROLLUP to cut down DB writes
+
+PPLNS_ENABLE = False            # Keep a rolling PPLNS window in memory and snapshot it to pplns_payouts on every found block
+PPLNS_WINDOW = 1000000          # Window size in share difficulty units (difficulty * SHARE_MULTIPLIER)
+
+DB_SHARES_PARTITION = False     # Partition the shares table by day (`time` must be DATETIME). The first start converts the table!
+DB_SHARES_PARTITION_AHEAD = 2   # How many days of empty partitions to keep ready
+DB_SHARES_RETENTION_DAYS = 7    # Older days are compacted into shares_archive and their partition dropped
+DB_PARTITION_CHECKTIME = 3600   # How often the partition maintenance runs
 
 # ******************** Pool Settings *********************
 
@@ -88,6 +117,12 @@ DB_USERCACHE_TIME = 600         # How long the usercache is good for before we r
 USERS_AUTOADD = False           # Automatically add users to database when they connect.
                                 # This basically disables User Auth for the pool.
 USERS_CHECK_PASSWORD = False    # Check the workers password? (Many pools don't)
+USERS_AUTH_MODE = 'cache'       # 'cache' asks the DB on cache misses (see DB_USERCACHE_*),
+                                # 'table' loads all of pool_worker into memory and never queries on authorize
+USERS_TABLE_SYNC_TIME = 30      # How often the credential table picks up new and changed workers
+USERS_TABLE_FULL_SYNC_TIME = 3600   # How often the credential table is reloaded (catches deleted workers)
+USERS_TABLE_UPDATED_COLUMN = None   # pool_worker column with the last change time (e.g. 'updated_at'),
+                                    # None picks up new ids only and leaves changes to the full reload
 
 # Transaction Settings
 COINBASE_EXTRAS = '/stratum-pool/'  # Extra Descriptive String to incorporate in solved blocks
@@ -102,9 +137,34 @@ MERKLE_REFRESH_INTERVAL = 60    # How often check memorypool
 
 INSTANCE_ID = 31                # Used for extranonce and needs to be 0-31
 
+# Multi-process mode: "twistd -ny supervisor.tac" runs this many launcher.tac workers sharing
+# LISTEN_SOCKET_TRANSPORT (SO_REUSEPORT, Linux 3.9+). Worker n uses INSTANCE_ID + n (mod 32),
+# only worker 0 has the HTTP/WS transports. The supervisor talks to the daemon and the DB writes go through it.
+# The ban_ip/unban_ip/migrate/repartition admin calls and the automatic IP bans are relayed to all workers.
+# Every worker keeps its own submit rate limits and admission control; SUBMIT_RATE_IP, SUBMIT_BURST_IP and
+# ADMISSION_MAX_INFLIGHT are divided by WORKER_PROCESSES, so they stay limits for the whole pool.
+WORKER_PROCESSES = 4
+WORKER_RESTART_DELAY = 5        # Seconds before a worker which ended is started again
+
+# Share hashes (coinbase, merkle root, PoW) are checked by this many processes reading the jobs
+# from shared memory, the reactor keeps the cheap checks. Worth it for scrypt/x11 on spare cores,
+# 0 checks them in the reactor.
+VALIDATOR_PROCESSES = 0
+VALIDATOR_TIMEOUT = 10          # Shares without a verdict after this many seconds are rejected. Dead validators
+                                # are restarted and their shares rejected (see the get_validator_stats admin call)
+
 FORCE_REFRESH_INTERVAL = 300    # How often to 'force' new work if no new blocks 
 
 WORK_EXPIRE = 180               # How long before work expires
+WORK_LOG_SIZE = 32              # How many recent work_ids are remembered per connection,
+                                # older ones are dropped as new work is sent
+TEMPLATE_MAX_JOBS = 16          # How many templates of the current block are kept for share checks
+TEMPLATE_MAX_AGE = 600          # Templates older than this are released (the newest is always kept)
+TEMPLATE_MAX_BYTES = 64 * 1024 * 1024   # Approximate memory limit for all kept templates, 0 disables it
+                                # (see the get_template_stats admin call)
+
+VERSION_ROLLING_MASK = 0x1fffe000   # Block version bits miners may roll (BIP310 mining.configure, ASICBoost),
+                                    # 0 disables version rolling
 
 # ******************** Pool Difficulty Settings *********************
 VDIFF_X2_TYPE = True            # Powers of 2 e.g. 2,4,8,16,32,64,128,256,512,1024
@@ -122,6 +182,14 @@ VDIFF_MIN_TARGET = 0.00390625   # Minimum target difficulty same as POOL_TARGET
 VDIFF_MAX_TARGET = 1            # Maximum target difficulty 
 VDIFF_TARGET_TIME = 15          # Target time per share (i.e. try to get 1 share per this many seconds)
 VDIFF_RETARGET_TIME = 90        # Check to see if we should retarget this often
+VDIFF_SWEEP_TIME = 5            # How often the retarget pass over all connections runs
+VDIFF_IDLE_TIME = 600           # Vardiff state of connections without shares for this long is dropped
+VDIFF_START_HISTORY = True      # Start reconnecting workers at their last difficulty (pool_worker.difficulty)
+VDIFF_HISTORY_SYNC_TIME = 60    # How often workers of supervisor.tac pick up the difficulties the others set
+VDIFF_ESTIMATOR = 'basic'       # 'basic' uses the average share time and the variance above,
+                                # 'ewma' a decayed share rate estimate that retargets less often
+VDIFF_EWMA_HALF_LIFE = 300      # Half life of the 'ewma' share rate estimate in seconds
+VDIFF_CONFIDENCE = 2.0          # 'ewma' retargets when the share count is this many standard deviations off
 VDIFF_VARIANCE_PERCENT = 30     # Allow average time to very this % from target without retarget
 
 # ******************** Worker Ban Options *********************
@@ -131,5 +199,36 @@ WORKER_CACHE_TIME = 600         # How long the worker stats cache is good before
 WORKER_BAN_TIME = 300           # How long we temporarily ban worker
 INVALID_SHARES_PERCENT = 500    # Allow average invalid shares vary this % before we ban
 INVALID_SHARES_SPAM = 200       # Ban if we have this many invalids total before check time
-
-
+IP_BAN_TIME = 0                 # A worker banned above also gets its IP refused on subscribe/authorize for this long,
+                                #   0 disables it. Behind NAT or a proxy this locks out every miner on the address.
+                                #   Manual bans work either way: ban_ip/unban_ip/get_ip_bans admin calls
+
+
+
+# ******************** Submit Rate Limits *********************
+# Token buckets checked before a mining.submit is looked at (and before authorization),
+# over-limit calls are rejected. Off by default: a stratum proxy or a NAT'd farm sends the shares
+# of all its miners from one connection or address. A miner at vardiff sends a share every few
+# seconds, so 20/s per connection and 100/s per IP (some 500 miners behind one address) are
+# reasonable starting points; size the IP limit for the biggest farm or proxy you serve.
+SUBMIT_RATE_IP = 0              # mining.submit calls per second allowed per IP address, 0 disables the limit
+SUBMIT_BURST_IP = 500           # Calls an IP address may make at once before SUBMIT_RATE_IP applies
+SUBMIT_RATE_CONNECTION = 0      # mining.submit calls per second allowed per connection, 0 disables the limit
+SUBMIT_BURST_CONNECTION = 100   # Calls a connection may make at once before SUBMIT_RATE_CONNECTION applies
+SUBMIT_LIMIT_SIZE = 100000      # How many IPs and connections are remembered (least recently used are dropped)
+
+# ******************** Admission Control *********************
+# Reconnect storms: excess mining.authorize calls wait in a queue, taking turns per IP address.
+# This keeps the reactor responsive for miners already connected (shares, notifies), but the
+# reconnecting miners wait longer: in python mining/admission_controller.py (20k connections)
+# the reactor lag drops from 7.7 to 1.6 sec while the authorize wait goes from 4.8 to 5.4 sec
+# median and from 7.7 to 9.4 sec at the 99th percentile.
+ADMISSION_MAX_INFLIGHT = 200    # How many authorizations may be in progress at once, 0 disables admission control
+ADMISSION_MAX_LAG = 0.5         # No new authorizations are started while the reactor runs this many seconds late
+
+# ******************** Idle Connections *********************
+# Subscribed connections which don't mine still get every notify, these are closed (0 disables a timeout)
+REAP_PRE_AUTH_TIME = 120        # Subscribed but not authorized within this many seconds
+REAP_IDLE_TIME = 7200           # Authorized but no share for this long
+REAP_WRITE_STALL_TIME = 300     # More than REAP_WRITE_BUFFER bytes waiting to be sent for this long (not reading)
+REAP_WRITE_BUFFER = 256 * 1024
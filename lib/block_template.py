@@ -13,6 +13,11 @@ log = lib.logger.get_logger('block_template')
 # provided from coinbaser
 import settings
 
+# Rough sizes used for the memory accounting, measured with sys.getsizeof
+OBJECT_SIZE = 400   # transaction, input, outpoint or output object with its __dict__
+SUBMIT_SIZE = 300   # one registered submit tuple with its strings and set slot
+HASH_SIZE = 80      # one 32 byte hash string kept by the merkle tree
+
 class BlockTemplate(halfnode.CBlock):
     '''Template is used for generating new jobs for clients.
     Let's iterate extranonce1, extranonce2, ntime and nonce
@@ -24,9 +29,12 @@ class BlockTemplate(halfnode.CBlock):
         super(BlockTemplate, self).__init__()
         
         self.job_id = job_id 
+        self.generation = 0 # Set by TemplateRegistry, see get_job()
+        self.job_slot = None # JobTable slot of the validator processes, None when not published
         self.timestamper = timestamper
         self.coinbaser = coinbaser
         
+        self.base_version = 0 # nVersion from getblocktemplate, before any version rolling
         self.prevhash_bin = '' # reversed binary form of prevhash
         self.prevhash_hex = ''
         self.timedelta = 0
@@ -37,10 +45,14 @@ class BlockTemplate(halfnode.CBlock):
                 
         self.broadcast_args = []
         
-        # List of 4-tuples (extranonce1, extranonce2, ntime, nonce)
+        # Set of 4-tuples (extranonce1, extranonce2, ntime, nonce)
         # registers already submitted and checked shares
         # There may be registered also invalid shares inside!
-        self.submits = [] 
+        self.submits = set()
+
+        # Raw size and object count of the transactions, see memory_usage()
+        self.tx_bytes = 0
+        self.tx_objects = 0
                 
     def fill_from_rpc(self, data):
         '''Convert getblocktemplate result into BlockTemplate instance'''
@@ -54,6 +66,7 @@ class BlockTemplate(halfnode.CBlock):
 
         self.height = data['height']
         self.nVersion = data['version']
+        self.base_version = data['version']
         self.hashPrevBlock = int(data['previousblockhash'], 16)
         self.nBits = int(data['bits'], 16)
 
@@ -63,9 +76,12 @@ class BlockTemplate(halfnode.CBlock):
         self.vtx = [ coinbase, ]
         
         for tx in data['transactions']:
+            raw = binascii.unhexlify(tx['data'])
             t = halfnode.CTransaction()
-            t.deserialize(StringIO.StringIO(binascii.unhexlify(tx['data'])))
+            t.deserialize(StringIO.StringIO(raw))
             self.vtx.append(t)
+            self.tx_bytes += len(raw)
+            self.tx_objects += 1 + 2 * len(t.vin) + len(t.vout)
             
         self.curtime = data['curtime']
         self.timedelta = self.curtime - int(self.timestamper.time()) 
@@ -80,15 +96,22 @@ class BlockTemplate(halfnode.CBlock):
         log.info("Block height: %i network difficulty: %s" % (self.height, util.diff_to_target(self.target)))
 
                 
-    def register_submit(self, extranonce1, extranonce2, ntime, nonce):
+    def register_submit(self, extranonce1, extranonce2, ntime, nonce, version_bits=None):
         '''Client submitted some solution. Let's register it to
         prevent double submissions.'''
         
-        t = (extranonce1, extranonce2, ntime, nonce)
+        t = (extranonce1, extranonce2, ntime, nonce, version_bits)
         if t not in self.submits:
-            self.submits.append(t)
+            self.submits.add(t)
             return True
         return False
+
+    def memory_usage(self):
+        '''Approximate bytes held by the transactions, the merkle
+        branch and the registered submits of this template'''
+        merkle = len(self.merkletree.data) * HASH_SIZE if self.merkletree else 0
+        return self.tx_bytes + self.tx_objects * OBJECT_SIZE + merkle + \
+            len(self.submits) * SUBMIT_SIZE
             
     def build_broadcast_args(self):
         '''Build parameters of mining.notify call. All clients
@@ -124,9 +147,16 @@ class BlockTemplate(halfnode.CBlock):
         
         return True
 
-    def serialize_header(self, merkle_root_int, ntime_bin, nonce_bin):
-        '''Serialize header for calculating block hash'''
-        r  = struct.pack(">i", self.nVersion)
+    def rolled_version(self, version_bits, mask):
+        '''Block version with the bits of mask taken from version_bits (BIP310)'''
+        return (self.base_version & ~mask) | (version_bits & mask)
+
+    def serialize_header(self, merkle_root_int, ntime_bin, nonce_bin, version=None):
+        '''Serialize header for calculating block hash,
+        version overrides the template's version (version rolling)'''
+        if version is None:
+            version = self.base_version
+        r  = struct.pack(">i", version)
         r += self.prevhash_bin
         r += util.ser_uint256_be(merkle_root_int)
         r += ntime_bin
@@ -134,10 +164,11 @@ class BlockTemplate(halfnode.CBlock):
         r += nonce_bin    
         return r       
 
-    def finalize(self, merkle_root_int, extranonce1_bin, extranonce2_bin, ntime, nonce):
+    def finalize(self, merkle_root_int, extranonce1_bin, extranonce2_bin, ntime, nonce, version=None):
         '''Take all parameters required to compile block candidate.
         self.is_valid() should return True then...'''
         
+        self.nVersion = self.base_version if version is None else version
         self.hashMerkleRoot = merkle_root_int
         self.nTime = ntime
         self.nNonce = nonce
@@ -169,5 +169,64 @@ DB_LOADER_FORCE_TIME = 300      # How often the cache should be flushed into the
 DB_STATS_AVG_TIME = 300     # When using the DATABASE_EXTEND option, average speed over X sec
                 #   Note: this is also how often it updates
 DB_USERCACHE_TIME = 600     # How long the usercache is good for before we refresh
-
-
+DB_USERCACHE_JITTER = 60    # Random extra seconds per entry, spreads the refreshes out
+DB_USERCACHE_NEGATIVE_TIME = 60 # How long failed logins are cached
+DB_USERCACHE_STALE_TIME = 300   # How long an expired entry is still used while it is refreshed
+DB_USERCACHE_SIZE = 100000  # Most worker/password results kept, the least recently used are dropped
+USERS_AUTH_MODE = 'cache'   # 'cache' asks the DB on cache misses, 'table' keeps all of pool_worker in memory
+USERS_TABLE_SYNC_TIME = 30  # How often the credential table picks up new and changed workers
+USERS_TABLE_FULL_SYNC_TIME = 3600 # How often the credential table is reloaded (catches deleted workers)
+USERS_TABLE_UPDATED_COLUMN = None # pool_worker column with the last change time, None syncs new ids only
+DB_SOLUTION_CACHE_SIZE = 10000      # How many inserted share ids are kept for found block updates
+
+DB_SHARE_ROLLUP = False             # Aggregate shares into one row per worker every DB_ROLLUP_TIME (share_rollups table)
+DB_ROLLUP_TIME = 60                 # Length of a rollup bucket in seconds
+DB_SHARE_ROWS = True                # Also insert one row per share. Found blocks are always recorded.
+
+PPLNS_ENABLE = False                # Keep a rolling PPLNS window in memory and snapshot it to pplns_payouts on every found block
+PPLNS_WINDOW = 1000000              # Window size in share difficulty units (difficulty * SHARE_MULTIPLIER)
+
+DB_SHARES_PARTITION = False         # Partition the shares table by day (`time` must be DATETIME). The first start converts the table!
+DB_SHARES_PARTITION_AHEAD = 2       # How many days of empty partitions to keep ready
+DB_SHARES_RETENTION_DAYS = 7        # Older days are compacted into shares_archive and their partition dropped
+DB_PARTITION_CHECKTIME = 3600       # How often the partition maintenance runs
+
+DB_MYSQL_REPLICAS = []              # Read-only endpoints for auth and stats reads, e.g. [{'host': '127.0.0.1', 'port': 3307}]
+DB_MYSQL_REPLICA_MAX_LAG = 30       # Replicas more seconds behind the primary are skipped
+DB_MYSQL_REPLICA_CHECKTIME = 30     # How often the replication lag is checked
+
+WORK_EXPIRE = 180                   # How long before work expires
+WORK_LOG_SIZE = 32                  # How many recent work_ids are remembered per connection
+TEMPLATE_MAX_JOBS = 16              # How many templates of the current block are kept for share checks
+TEMPLATE_MAX_AGE = 600              # Templates older than this are released (the newest is always kept)
+TEMPLATE_MAX_BYTES = 64 * 1024 * 1024 # Approximate memory limit for all templates, 0 disables it
+
+VDIFF_SWEEP_TIME = 5                # How often the vardiff pass over all connections runs
+VDIFF_IDLE_TIME = 600               # Vardiff state of connections without shares for this long is dropped
+VDIFF_START_HISTORY = True          # Start reconnecting workers at their last difficulty (pool_worker.difficulty)
+VDIFF_HISTORY_SYNC_TIME = 60        # How often workers of supervisor.tac reload the last difficulties of all workers
+
+SUBMIT_RATE_IP = 0                  # mining.submit calls per second allowed per IP address, 0 disables the limit
+SUBMIT_BURST_IP = 500               # Calls an IP address may make at once before SUBMIT_RATE_IP applies
+SUBMIT_RATE_CONNECTION = 0          # mining.submit calls per second allowed per connection, 0 disables the limit
+SUBMIT_BURST_CONNECTION = 100       # Calls a connection may make at once before SUBMIT_RATE_CONNECTION applies
+SUBMIT_LIMIT_SIZE = 100000          # How many IPs and connections the limits remember (least recently used are dropped)
+IP_BAN_TIME = 0                     # Workers banned for invalid shares also get their IP banned for this long, 0 disables it
+ADMISSION_MAX_INFLIGHT = 200        # How many mining.authorize calls may be in progress at once, 0 disables admission control
+                                    # (trades a longer authorize wait for less reactor lag, see conf/config.py)
+ADMISSION_MAX_LAG = 0.5             # No new authorizations are started while the reactor runs this many seconds late
+REAP_PRE_AUTH_TIME = 120            # Close subscribed connections which didn't authorize within this many seconds, 0 disables it
+REAP_IDLE_TIME = 7200               # Close authorized connections without a share for this long, 0 disables it
+REAP_WRITE_STALL_TIME = 300         # Close connections whose write buffer stays over REAP_WRITE_BUFFER this long, 0 disables it
+REAP_WRITE_BUFFER = 256 * 1024      # Bytes waiting to be sent to count as a stalled connection
+
+WORKER_PROCESSES = 4                # How many workers supervisor.tac runs, they use INSTANCE_ID .. INSTANCE_ID + n - 1 (mod 32)
+WORKER_RESTART_DELAY = 5            # Seconds before a worker which ended is started again
+WORKER_ID = None                    # Set by launcher.tac in the workers of supervisor.tac, not a setting of its own
+VALIDATOR_PROCESSES = 0             # Processes checking the share hashes (shared-memory job table), 0 checks them in the reactor
+VALIDATOR_TIMEOUT = 10              # Shares without a verdict of a validator after this many seconds are rejected
+
+VERSION_ROLLING_MASK = 0x1fffe000   # Version bits miners may roll (BIP310 mining.configure), 0 disables version rolling
+VDIFF_ESTIMATOR = 'basic'           # 'basic' average share time rules, 'ewma' share rate estimate (VardiffEstimator)
+VDIFF_EWMA_HALF_LIFE = 300          # Half life of the 'ewma' share rate estimate in seconds
+VDIFF_CONFIDENCE = 2.0              # 'ewma' retargets when the share count is this many std. deviations off
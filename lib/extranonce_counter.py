@@ -6,7 +6,14 @@ class ExtranonceCounter(object):
     '''Implementation of a counter producing
        unique extranonce across all pool instances.
        This is just dumb "quick&dirty" solution,
-       but it can be changed at any time without breaking anything.'''       
+       but it can be changed at any time without breaking anything.
+
+       Layout of the 32 bit extranonce1:
+         5 bits  instance_id of the partition
+         1 bit   0 = issued by the partition's own instance,
+                 1 = handed out by another instance for a migration
+         then either a 26 bit counter, or 5 bits issuing instance_id
+         and a 21 bit counter (see get_new_bin(instance_id)).'''
 
     def __init__(self, instance_id):
         if instance_id < 0 or instance_id > 31:
@@ -14,14 +21,38 @@ class ExtranonceCounter(object):
 
         # Last 5 most-significant bits represents instance_id
         # The rest is just an iterator of jobs.
+        self.instance_id = instance_id
         self.counter = instance_id << 27
         self.size = struct.calcsize('>L')
-        
+        self.ranges = {}    # instance_id -> last counter in our range of its partition
+
     def get_size(self):
         '''Return expected size of generated extranonce in bytes'''
         return self.size
-    
-    def get_new_bin(self):
-        self.counter += 1
-        return struct.pack('>L', self.counter)
-        
+
+    def get_new_bin(self, instance_id=None):
+        '''New extranonce1 of our own partition, or of the partition of
+        instance_id from the range this instance may hand out there'''
+        if instance_id is None or instance_id == self.instance_id:
+            # Stays below bit 26, the values above are the migration ranges
+            # other instances hand out in our partition
+            counter = ((self.counter & 0x3ffffff) + 1) % (1 << 26)
+            if counter == 0:
+                log.warning("Extranonce counter of instance %d wrapped around", self.instance_id)
+            self.counter = (self.instance_id << 27) | counter
+            return struct.pack('>L', self.counter)
+
+        if instance_id < 0 or instance_id > 31:
+            raise Exception("instance_id must be in <0, 31>")
+
+        counter = (self.ranges.get(instance_id, 0) + 1) % (1 << 21)
+        if counter == 0:
+            log.warning("Extranonce range of instance %d in the partition of instance %d wrapped around",
+                self.instance_id, instance_id)
+        self.ranges[instance_id] = counter
+        return struct.pack('>L', (instance_id << 27) | (1 << 26) | (self.instance_id << 21) | counter)
+
+    @staticmethod
+    def get_instance(extranonce1_bin):
+        '''instance_id of the partition an extranonce1 belongs to'''
+        return struct.unpack('>L', extranonce1_bin)[0] >> 27
@@ -0,0 +1,95 @@
+'''Request/response channel between the supervisor and its worker
+processes (see mining/supervisor.py and mining/worker_process.py).'''
+
+import json
+from twisted.internet import defer
+
+import lib.logger
+log = lib.logger.get_logger('ipc')
+
+class IPCError(Exception):
+    pass
+
+class IPCChannel(object):
+    '''One JSON object per line over any byte stream, in both directions:
+
+      {"id": 1, "method": "getblocktemplate", "params": []}   request
+      {"id": 1, "result": {...}, "error": null}                response
+      {"id": null, "method": "share", "params": [...]}         notification
+
+    A request for `method` calls handler.ipc_<method>(*params), which
+    may return a Deferred. call() returns a Deferred of the other side's
+    result; notify() expects no answer. write(data) sends the bytes,
+    data_received(data) takes the bytes coming in.'''
+
+    def __init__(self, write, handler):
+        self.write = write
+        self.handler = handler
+        self.buffer = ''
+        self.request_id = 0
+        self.pending = {}   # request id -> Deferred
+
+    def call(self, method, *params):
+        self.request_id += 1
+        d = self.pending[self.request_id] = defer.Deferred()
+        self._send({'id': self.request_id, 'method': method, 'params': params})
+        return d
+
+    def notify(self, method, *params):
+        self._send({'id': None, 'method': method, 'params': params})
+
+    def _send(self, message):
+        self.write(json.dumps(message) + '\n')
+
+    def data_received(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            if line:
+                self.line_received(line)
+
+    def line_received(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            log.error("Invalid IPC message: %s" % line[:200])
+            return
+
+        if 'method' in message:
+            self._dispatch(message)
+            return
+
+        d = self.pending.pop(message.get('id'), None)
+        if d is None:
+            return
+        if message.get('error') is not None:
+            d.errback(IPCError(message['error']))
+        else:
+            d.callback(message.get('result'))
+
+    def _dispatch(self, message):
+        method = getattr(self.handler, 'ipc_' + message['method'], None)
+        if method is None:
+            d = defer.fail(IPCError("Unknown method %s" % message['method']))
+        else:
+            d = defer.maybeDeferred(method, *message.get('params', []))
+
+        request_id = message.get('id')
+        if request_id is None:
+            d.addErrback(self._notification_failed, message['method'])
+        else:
+            d.addCallbacks(self._respond, self._respond_error, callbackArgs=(request_id,), errbackArgs=(request_id,))
+
+    def _respond(self, result, request_id):
+        self._send({'id': request_id, 'result': result, 'error': None})
+
+    def _respond_error(self, failure, request_id):
+        self._send({'id': request_id, 'result': None, 'error': failure.getErrorMessage()})
+
+    def _notification_failed(self, failure, method):
+        log.error("IPC %s failed: %s" % (method, failure.getErrorMessage()))
+
+    def connection_lost(self):
+        (pending, self.pending) = (self.pending, {})
+        for d in pending.itervalues():
+            d.errback(IPCError("Connection lost"))
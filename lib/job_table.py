@@ -0,0 +1,180 @@
+'''Share validation outside of the reactor: the job fields a share check
+needs, in shared memory (JobTable), and the check itself (check_share),
+which runs in the reactor or in validator processes (see validator_main
+and lib/validator_pool.py).'''
+
+import mmap
+import signal
+import struct
+from hashlib import sha256
+
+SLOT_SIZE = 16384
+SLOT_HEADER = struct.Struct('<Q16siI32sHHB')     # seq, job_id, version, nbits, prevhash, coinb1, coinb2, merkle steps
+
+def doublesha(b):
+    return sha256(sha256(b).digest()).digest()
+
+def swap_words(b):
+    '''Reverses the byte order of every 4 byte word'''
+    return ''.join([ b[i:i + 4][::-1] for i in xrange(0, len(b), 4) ])
+
+def pow_function(algo):
+    if algo == 'scrypt':
+        import ltc_scrypt
+        return ltc_scrypt.getPoWHash
+    elif algo == 'x11':
+        import x11_hash
+        return x11_hash.getPoWHash
+    return doublesha
+
+def check_share(coinb1, coinb2, merkle_steps, version, prevhash_bin, nbits, extranonce1_bin, extranonce2_bin,
+                ntime_bin, nonce_bin, target, pow_hash):
+    '''The hashing part of TemplateRegistry.submit_share. Returns
+    (header_bin, hash_bin, merkle_root_bin), or None when the share is
+    above target'''
+
+    # 1. Build coinbase
+    coinbase_hash = doublesha(coinb1 + extranonce1_bin + extranonce2_bin + coinb2)
+
+    # 2. Calculate merkle root
+    merkle_root_bin = coinbase_hash
+    for step in merkle_steps:
+        merkle_root_bin = doublesha(merkle_root_bin + step)
+
+    # 3. Serialize header with given merkle, ntime and nonce
+    header_bin = struct.pack('>i', version) + prevhash_bin + swap_words(merkle_root_bin) + ntime_bin + \
+        struct.pack('>I', nbits) + nonce_bin
+
+    # 4. Reverse header and compare it with target of the user
+    hash_bin = pow_hash(swap_words(header_bin))
+    if int(hash_bin[::-1].encode('hex'), 16) > target:
+        return None
+    return (header_bin, hash_bin, merkle_root_bin)
+
+class JobTable(object):
+    '''Fixed slots in an anonymous shared mmap, created before the
+    validator processes are forked so all of them see the same memory.
+    The reactor process is the only writer.
+
+    Every slot starts with a sequence number which is odd while the slot
+    is being written. Readers check it before and after reading and try
+    again when it moved, and keep the parsed slot until the sequence
+    number changes, so a job is read once per process, not per share.'''
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.memory = mmap.mmap(-1, slots * SLOT_SIZE)
+        self.next_slot = 0
+        self.cache = {}     # slot -> (seq, job)
+
+    def publish(self, job_id, version, prevhash_bin, nbits, coinb1, coinb2, merkle_steps):
+        '''Writes the job into the next slot (round robin) and returns
+        it, None when the job doesn't fit into a slot'''
+        data = coinb1 + coinb2 + ''.join(merkle_steps)
+        if SLOT_HEADER.size + len(data) > SLOT_SIZE or len(job_id) > 16:
+            return None
+
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.slots
+        offset = slot * SLOT_SIZE
+        seq = struct.unpack_from('<Q', self.memory, offset)[0]
+        struct.pack_into('<Q', self.memory, offset, seq + 1)
+        SLOT_HEADER.pack_into(self.memory, offset, seq + 1, job_id, version, nbits, prevhash_bin,
+            len(coinb1), len(coinb2), len(merkle_steps))
+        self.memory[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(data)] = data
+        struct.pack_into('<Q', self.memory, offset, seq + 2)
+        return slot
+
+    def read(self, slot):
+        '''Returns (job_id, version, prevhash_bin, nbits, coinb1, coinb2, merkle_steps)'''
+        offset = slot * SLOT_SIZE
+        while True:
+            seq = struct.unpack_from('<Q', self.memory, offset)[0]
+            cached = self.cache.get(slot)
+            if cached is not None and cached[0] == seq:
+                return cached[1]
+            if seq % 2:
+                continue
+
+            (_, job_id, version, nbits, prevhash_bin, coinb1_len, coinb2_len, steps) = \
+                SLOT_HEADER.unpack_from(self.memory, offset)
+            start = offset + SLOT_HEADER.size
+            data = self.memory[start:start + coinb1_len + coinb2_len + steps * 32]
+            if struct.unpack_from('<Q', self.memory, offset)[0] != seq:
+                # Written meanwhile
+                continue
+
+            coinb1 = data[:coinb1_len]
+            coinb2 = data[coinb1_len:coinb1_len + coinb2_len]
+            merkle_steps = [ data[coinb1_len + coinb2_len + i * 32:coinb1_len + coinb2_len + (i + 1) * 32]
+                for i in xrange(steps) ]
+            job = (job_id.rstrip('\0'), version, prevhash_bin, nbits, coinb1, coinb2, merkle_steps)
+            self.cache[slot] = (seq, job)
+            return job
+
+def validator_main(table, algo, requests, results):
+    '''Loop of a validator process: requests are (request_id, slot, job_id,
+    extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin, version, target),
+    results (request_id, check_share result, error)'''
+    # The parent handles the signals
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pow_hash = pow_function(algo)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        (request_id, slot, job_id, extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin, version, target) = request
+        try:
+            (slot_job_id, base_version, prevhash_bin, nbits, coinb1, coinb2, merkle_steps) = table.read(slot)
+            if slot_job_id != job_id:
+                # The slot has been reused, the job is long gone
+                results.put((request_id, None, "Job '%s' not found" % job_id))
+                continue
+            result = check_share(coinb1, coinb2, merkle_steps, base_version if version is None else version,
+                prevhash_bin, nbits, extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin, target, pow_hash)
+            results.put((request_id, result, None))
+        except Exception as e:
+            results.put((request_id, None, "Validation failed: %s" % e))
+
+# Shares/s checked in this process versus 1..processes validator processes
+# (sha256d, 11 merkle steps), run from the top directory
+def _bench(processes=2, shares=20000, algo='sha256d'):
+    import multiprocessing
+    import time
+
+    table = JobTable(20)
+    steps = [ doublesha(str(i)) for i in xrange(11) ]
+    slot = table.publish('1a', 2, '\x11' * 32, 0x1d00ffff, '\x01' * 60, '\x02' * 120, steps)
+    target = 1 << 255
+    pow_hash = pow_function(algo)
+
+    start = time.time()
+    for i in xrange(shares):
+        job = table.read(slot)
+        check_share(job[4], job[5], job[6], job[1], job[2], job[3], '\0\0\0\1', struct.pack('>L', i),
+            '\x5a\x0b\x1c\x2d', struct.pack('>L', i), target, pow_hash)
+    single = shares / (time.time() - start)
+    print "in process:    %8d shares/s" % single
+
+    for n in xrange(1, processes + 1):
+        requests = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        procs = [ multiprocessing.Process(target=validator_main, args=(table, algo, requests, results))
+            for i in xrange(n) ]
+        for p in procs:
+            p.start()
+        start = time.time()
+        for i in xrange(shares):
+            requests.put((i, slot, '1a', '\0\0\0\1', struct.pack('>L', i), '\x5a\x0b\x1c\x2d',
+                struct.pack('>L', i), None, target))
+        for i in xrange(shares):
+            results.get()
+        rate = shares / (time.time() - start)
+        for p in procs:
+            requests.put(None)
+        for p in procs:
+            p.join()
+        print "%2d validators: %8d shares/s, %.02fx (%d cores)" % (n, rate, rate / single, multiprocessing.cpu_count())
+
+if __name__ == '__main__':
+    _bench()
@@ -1,9 +1,9 @@
-import weakref
 import binascii
 import util
 import StringIO
 import settings
 import struct
+from collections import deque
 
 from twisted.internet import defer
 from lib.exceptions import SubmitException
@@ -12,14 +12,9 @@ import lib.logger
 log = lib.logger.get_logger('template_registry')
 from mining.interfaces import Interfaces
 from extranonce_counter import ExtranonceCounter
+from job_table import check_share, pow_function
 import lib.settings as settings
 
-if settings.DAEMON_ALGO == 'scrypt':
-    import ltc_scrypt
-elif settings.DAEMON_ALGO == 'x11':
-    import x11_hash
-else: pass
-
 class JobIdGenerator(object):
     '''Generate pseudo-unique job_id. It does not need to be absolutely unique,
     because pool sends "clean_jobs" flag to clients and they should drop all previous jobs.'''
@@ -27,8 +22,9 @@ class JobIdGenerator(object):
     
     @classmethod
     def get_new_id(cls):
+        # Wide enough to never wrap while an old job is still registered
         cls.counter += 1
-        if cls.counter % 0xffff == 0:
+        if cls.counter > 0xffffffffffffffff:
             cls.counter = 1
         return "%x" % cls.counter
                 
@@ -38,9 +34,11 @@ class TemplateRegistry(object):
     service and implements block validation and submits.'''
     
     def __init__(self, block_template_class, coinbaser, bitcoin_rpc, instance_id,
-                 on_template_callback, on_block_callback):
-        self.prevhashes = {}
-        self.jobs = weakref.WeakValueDictionary()
+                 on_template_callback, on_block_callback, validators=None):
+        self.jobs = {}              # job_id -> BlockTemplate
+        self.job_order = deque()    # (job_id, time added), oldest first
+        self.generation = 0         # Bumped on every new prevhash, jobs of older generations are stale
+        self.prevhash = None
         
         self.extranonce_counter = ExtranonceCounter(instance_id)
         self.extranonce2_size = block_template_class.coinbase_transaction_class.extranonce_size \
@@ -51,6 +49,8 @@ class TemplateRegistry(object):
         self.bitcoin_rpc = bitcoin_rpc
         self.on_block_callback = on_block_callback
         self.on_template_callback = on_template_callback
+        self.validators = validators    # ValidatorPool checking the shares, None checks them right here
+        self.pow_hash = pow_function(settings.DAEMON_ALGO)
         
         self.last_block = None
         self.update_in_progress = False
@@ -60,11 +60,12 @@ class TemplateRegistry(object):
         # Create first block template on startup
         self.update_block()
         
-    def get_new_extranonce1(self):
+    def get_new_extranonce1(self, instance_id=None):
         '''Generates unique extranonce1 (e.g. for newly
-        subscribed connection.'''
+        subscribed connection. With instance_id it belongs to
+        the partition of that instance (see repartition).'''
         log.debug("Getting Unique Extranonce")
-        return self.extranonce_counter.get_new_bin()
+        return self.extranonce_counter.get_new_bin(instance_id)
     
     def get_last_broadcast_args(self):
         '''Returns arguments for mining.notify
@@ -80,33 +81,34 @@ class TemplateRegistry(object):
             self.last_update_force = Interfaces.timestamper.time()
         
         prevhash = block.prevhash_hex
+        now = Interfaces.timestamper.time()
 
-        if Interfaces.timestamper.time() - self.last_update_force >= settings.FORCE_REFRESH_INTERVAL:
+        if now - self.last_update_force >= settings.FORCE_REFRESH_INTERVAL:
             log.info("FORCED UPDATE!")
             new_block = True
-            self.prevhashes[prevhash] = []
-            self.last_update_force = Interfaces.timestamper.time()
-        elif prevhash in self.prevhashes.keys():
+            self.generation += 1
+            self.last_update_force = now
+        elif prevhash == self.prevhash:
             new_block = False
         else:
             new_block = True
-            self.prevhashes[prevhash] = []
-            self.last_update_force = Interfaces.timestamper.time()
-               
-        # Blocks sorted by prevhash, so it's easy to drop
-        # them on blockchain update
-        self.prevhashes[prevhash].append(block)
-        
-        # Weak reference for fast lookup using job_id
+            self.generation += 1
+            self.last_update_force = now
+        self.prevhash = prevhash
+
+        block.generation = self.generation
+        if self.validators is not None:
+            (coinb1, coinb2) = block.vtx[0]._serialized
+            block.job_slot = self.validators.publish(block.job_id, block.base_version, block.prevhash_bin,
+                block.nBits, coinb1, coinb2, block.merkletree._steps)
         self.jobs[block.job_id] = block
+        self.job_order.append((block.job_id, now))
         
         # Use this template for every new request
         self.last_block = block
         
-        # Drop templates of obsolete blocks
-        for ph in self.prevhashes.keys():
-            if ph != prevhash:
-                del self.prevhashes[ph]
+        # Drop templates of obsolete blocks and the ones over the limits
+        self.retire_jobs(now)
                 
         log.info("New template for %s" % prevhash)
 
@@ -118,6 +120,54 @@ class TemplateRegistry(object):
         # Everything is ready, let's broadcast jobs!
         self.on_template_callback(new_block) 
               
+    def retire_jobs(self, now):
+        '''Releases the oldest jobs while they are stale, over
+        TEMPLATE_MAX_JOBS, older than TEMPLATE_MAX_AGE seconds or
+        while all jobs together use more than TEMPLATE_MAX_BYTES.
+        The last template is always kept.'''
+        used = self.get_memory_usage()['bytes']
+        while self.job_order:
+            (job_id, added) = self.job_order[0]
+            if job_id == self.last_block.job_id:
+                break
+
+            job = self.jobs.get(job_id)
+            if job is not None and job.generation == self.generation and \
+                    len(self.job_order) <= settings.TEMPLATE_MAX_JOBS and \
+                    now - added <= settings.TEMPLATE_MAX_AGE and \
+                    (not settings.TEMPLATE_MAX_BYTES or used <= settings.TEMPLATE_MAX_BYTES):
+                break
+
+            self.job_order.popleft()
+            if job is not None:
+                used -= job.memory_usage()
+            self.release_job(job_id)
+
+    def get_memory_usage(self):
+        '''Approximate memory held by the registered templates'''
+        usage = {
+            'jobs': len(self.jobs),
+            'current_jobs': 0,
+            'generation': self.generation,
+            'transactions': 0,
+            'submits': 0,
+            'bytes': 0,
+            'max_bytes': settings.TEMPLATE_MAX_BYTES,
+        }
+        for job in self.jobs.itervalues():
+            if job.generation == self.generation:
+                usage['current_jobs'] += 1
+            usage['transactions'] += len(job.vtx)
+            usage['submits'] += len(job.submits)
+            usage['bytes'] += job.memory_usage()
+        return usage
+
+    def release_job(self, job_id):
+        job = self.jobs.pop(job_id, None)
+        if job is not None:
+            # Don't wait for the last reference to the template to go away
+            job.submits = set()
+
     def update_block(self):
         '''Registry calls the getblocktemplate() RPC
         and build new block template.'''
@@ -154,21 +204,14 @@ class TemplateRegistry(object):
     def get_job(self, job_id):
         '''For given job_id returns BlockTemplate instance or None'''
 
-        try:
-            j = self.jobs[job_id]
-        except:
+        j = self.jobs.get(job_id)
+        if j is None:
             log.info("Job id '%s' not found" % job_id)
             return None
         
-        # Now we have to check if job is still valid.
-        # Unfortunately weak references are not bulletproof and
-        # old reference can be found until next run of garbage collector.
-        if j.prevhash_hex not in self.prevhashes:
-            log.info("Prevhash of job '%s' is unknown" % job_id)
-            return None
-        
-        if j not in self.prevhashes[j.prevhash_hex]:
-            log.info("Job %s is unknown" % job_id)
+        # Jobs built on an older prevhash can't be mined on anymore
+        if j.generation != self.generation:
+            log.info("Job %s is stale" % job_id)
             return None
         
         return j
@@ -183,7 +226,7 @@ class TemplateRegistry(object):
         return float(diff1) / float(difficulty)
         
     def submit_share(self, job_id, worker_name, session, extranonce1_bin, extranonce2, ntime, nonce,
-                     difficulty, ip, submit_time):
+                     difficulty, ip, submit_time, version_bits=None, version_mask=0):
         '''Check parameters and finalize block template. If it leads
            to valid block candidate, asynchronously submits the block
            back to the bitcoin network.
@@ -192,6 +235,10 @@ class TemplateRegistry(object):
             - job_id, extranonce2, ntime, nonce - in hex form sent by the client
             - difficulty - decimal number from session, again no checks performed
             - submitblock_callback - reference to method which receive result of submitblock()
+            - version_bits - rolled version in hex form (BIP310), only the bits
+              of the negotiated version_mask may differ from the job's version
+
+            With validator processes (VALIDATOR_PROCESSES) the result is a Deferred.
         '''
         
         # Check if extranonce2 looks correctly. extranonce2 is in hex form...
@@ -214,8 +261,23 @@ class TemplateRegistry(object):
         if len(nonce) != 8:
             raise SubmitException("Incorrect size of nonce. Expected 8 chars")
         
+        # Check version rolling
+        version = None
+        if version_bits is not None:
+            if not version_mask:
+                raise SubmitException("Version rolling is not enabled")
+            if len(version_bits) != 8:
+                raise SubmitException("Incorrect size of version bits. Expected 8 chars")
+            try:
+                bits = int(version_bits, 16)
+            except ValueError:
+                raise SubmitException("Invalid version bits")
+            if bits & ~version_mask:
+                raise SubmitException("Version bits outside of the mask")
+            version = job.rolled_version(bits, version_mask)
+
         # Check for duplicated submit
-        if not job.register_submit(extranonce1_bin, extranonce2, ntime, nonce):
+        if not job.register_submit(extranonce1_bin, extranonce2, ntime, nonce, version_bits):
             log.info("Duplicate from %s, (%s %s %s %s)" % \
                     (worker_name, binascii.hexlify(extranonce1_bin), extranonce2, ntime, nonce))
             raise SubmitException("Duplicate share")
@@ -227,33 +289,30 @@ class TemplateRegistry(object):
         extranonce2_bin = binascii.unhexlify(extranonce2)
         ntime_bin = binascii.unhexlify(ntime)
         nonce_bin = binascii.unhexlify(nonce)
-                
-        # 1. Build coinbase
-        coinbase_bin = job.serialize_coinbase(extranonce1_bin, extranonce2_bin)
-        coinbase_hash = util.doublesha(coinbase_bin)
-        
-        # 2. Calculate merkle root
-        merkle_root_bin = job.merkletree.withFirst(coinbase_hash)
-        merkle_root_int = util.uint256_from_str(merkle_root_bin)
-                
-        # 3. Serialize header with given merkle, ntime and nonce
-        header_bin = job.serialize_header(merkle_root_int, ntime_bin, nonce_bin)
-    
-        # 4. Reverse header and compare it with target of the user
-        if settings.DAEMON_ALGO == 'scrypt':
-            hash_bin = ltc_scrypt.getPoWHash(''.join([ header_bin[i*4:i*4+4][::-1] for i in range(0, 20) ]))
-        elif settings.DAEMON_ALGO == 'x11':
-            hash_bin = x11_hash.getPoWHash(''.join([ header_bin[i*4:i*4+4][::-1] for i in range(0, 20) ]))
-        else:
-            hash_bin = util.doublesha(''.join([ header_bin[i*4:i*4+4][::-1] for i in range(0, 20) ]))
+        target_user = self.diff_to_target(difficulty)
+
+        # 1.-4. Coinbase, merkle root, header and PoW, in a validator process if we have them
+        if self.validators is not None and job.job_slot is not None:
+            d = self.validators.validate(job.job_slot, job.job_id, extranonce1_bin, extranonce2_bin, ntime_bin,
+                nonce_bin, version, target_user)
+            d.addCallback(self._share_checked, job, extranonce1_bin, extranonce2_bin, ntime, nonce, version)
+            return d
+
+        (coinb1, coinb2) = job.vtx[0]._serialized
+        checked = check_share(coinb1, coinb2, job.merkletree._steps, job.base_version if version is None else version,
+            job.prevhash_bin, job.nBits, extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin, target_user,
+            self.pow_hash)
+        return self._share_checked(checked, job, extranonce1_bin, extranonce2_bin, ntime, nonce, version)
+
+    def _share_checked(self, checked, job, extranonce1_bin, extranonce2_bin, ntime, nonce, version):
+        '''Rest of submit_share with the result of check_share'''
+        if checked is None:
+            raise SubmitException("Share is above target")
+        (header_bin, hash_bin, merkle_root_bin) = checked
 
         hash_int = util.uint256_from_str(hash_bin)
         pow_hash_hex = "%064x" % hash_int
         header_hex = binascii.hexlify(header_bin)
-                 
-        target_user = self.diff_to_target(difficulty)
-        if hash_int > target_user:
-            raise SubmitException("Share is above target")
 
         # Mostly for debugging purposes
         target_info = self.diff_to_target(50)
@@ -269,7 +328,8 @@ class TemplateRegistry(object):
 
         if hash_int <= job.target:
             log.info("BLOCK CANDIDATE! %s diff(%f/%f)" % (block_hash_hex, share_diff, self.diff_to_target(job.target)))
-            job.finalize(merkle_root_int, extranonce1_bin, extranonce2_bin, int(ntime, 16), int(nonce, 16))
+            merkle_root_int = util.uint256_from_str(merkle_root_bin)
+            job.finalize(merkle_root_int, extranonce1_bin, extranonce2_bin, int(ntime, 16), int(nonce, 16), version)
             
             if not job.is_valid():
                 log.exception("FINAL JOB VALIDATION FAILED!")
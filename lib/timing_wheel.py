@@ -0,0 +1,63 @@
+'''Hashed timing wheel for expiring large numbers of keys.'''
+
+class TimingWheel(object):
+    '''Keys are scheduled into one of `size` buckets of `tick` seconds.
+    advance() empties the buckets whose time has passed and returns
+    their keys, so expiry costs O(expired keys) and scheduling or
+    moving a key is O(1). Keys due further out than one turn of the
+    wheel go around again until their time has come.
+
+    Callers are expected to be lazy: instead of moving a key on every
+    bit of activity, check the key when it comes out of advance() and
+    schedule it again if it's still alive.'''
+
+    def __init__(self, tick, size, now):
+        self.tick = float(tick)
+        self.buckets = [ {} for i in xrange(size) ]     # key -> when
+        self.where = {}                                 # key -> bucket index
+        self.current = int(now // self.tick)
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def schedule(self, key, when):
+        self.cancel(key)
+        # Never into a bucket which has already been emptied
+        pos = max(int(when // self.tick), self.current + 1)
+        if pos - self.current >= len(self.buckets):
+            pos = self.current + len(self.buckets) - 1
+        index = pos % len(self.buckets)
+        self.buckets[index][key] = when
+        self.where[key] = index
+
+    def cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            del self.buckets[index][key]
+
+    def advance(self, now):
+        '''Returns the keys due at or before now'''
+        target = int(now // self.tick)
+        expired = []
+        later = []
+        steps = min(target - self.current, len(self.buckets))
+        for i in xrange(steps):
+            index = (self.current + 1 + i) % len(self.buckets)
+            bucket = self.buckets[index]
+            if not bucket:
+                continue
+            self.buckets[index] = {}
+            for key, when in bucket.iteritems():
+                del self.where[key]
+                if when <= now:
+                    expired.append(key)
+                else:
+                    later.append((key, when))
+
+        self.current = max(target, self.current)
+        for (key, when) in later:
+            self.schedule(key, when)
+        return expired
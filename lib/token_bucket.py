@@ -0,0 +1,77 @@
+'''Token bucket rate limiting for many keys, see TokenBuckets.'''
+
+from collections import OrderedDict
+
+class TokenBuckets(object):
+    '''One token bucket per key: `burst` tokens, refilled at `rate`
+    tokens per second. take() spends a token and returns False when
+    the bucket is empty.
+
+    At most `size` buckets are kept. The least recently used bucket is
+    dropped to make room; a key that comes back starts with a full
+    bucket, which is fine since only keys that were quiet for a while
+    get evicted.'''
+
+    def __init__(self, rate, burst, size):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.size = size
+        self.buckets = OrderedDict()    # key -> [tokens, last refill time]
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def take(self, key, now):
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            if len(self.buckets) >= self.size:
+                self.buckets.popitem(last=False)
+                self.evicted += 1
+            bucket = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        # Most recently used at the end
+        self.buckets[key] = bucket
+
+        if bucket[0] < 1:
+            self.rejected += 1
+            return False
+        bucket[0] -= 1
+        self.allowed += 1
+        return True
+
+    def get_stats(self):
+        return {
+            'buckets': len(self.buckets),
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'evicted': self.evicted,
+        }
+
+# Cost of a take() with a full table, run from the top directory
+def _bench(keys=100000, size=50000, calls=1000000):
+    import random
+    import time
+
+    random.seed(1)
+    buckets = TokenBuckets(10, 20, size)
+    names = [ '10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255) for i in xrange(keys) ]
+    start = time.time()
+    for i in xrange(calls):
+        buckets.take(names[random.randrange(keys)], i / 1000.0)
+    took = time.time() - start
+    # Same loop without the limiter
+    start = time.time()
+    for i in xrange(calls):
+        names[random.randrange(keys)]
+    base = time.time() - start
+    print "%d calls over %d keys, %d buckets: %.02f usec per take()" % (calls, keys, len(buckets),
+        (took - base) * 1000000 / calls)
+    print buckets.get_stats()
+
+if __name__ == '__main__':
+    _bench()
@@ -0,0 +1,124 @@
+'''Validator processes checking shares for the reactor, see ValidatorPool.'''
+
+import multiprocessing
+import threading
+from twisted.internet import reactor, defer
+
+import lib.settings as settings
+from job_table import JobTable, validator_main
+from lib.exceptions import SubmitException
+
+import lib.logger
+log = lib.logger.get_logger('validator_pool')
+
+VALIDATOR_CHECK_TIME = 1
+
+class Validator(object):
+    '''One validator process with its own request queue, so the requests
+    it was given are known when it dies'''
+
+    def __init__(self, table, algo, results):
+        self.requests = multiprocessing.Queue()
+        self.pending = set()    # request ids
+        self.process = multiprocessing.Process(target=validator_main,
+            args=(table, algo, self.requests, results))
+        self.process.daemon = True
+        self.process.start()
+
+class ValidatorPool(object):
+    '''Forks `processes` validators sharing one JobTable. The reactor
+    publishes a job once (publish()), after that a share costs it one
+    small request to the least busy validator and one verdict coming
+    back: validate() returns a Deferred of check_share's result, or fails
+    with a SubmitException.
+
+    Every VALIDATOR_CHECK_TIME the pool fails the requests older than
+    VALIDATOR_TIMEOUT and the ones of validators which died, and starts
+    new validators in place of the dead ones.
+
+    Must be created before the reactor runs. Validators started later to
+    replace dead ones are forked from the running reactor; they only
+    use their queues and the job table.'''
+
+    def __init__(self, processes, slots, algo):
+        self.table = JobTable(slots)
+        self.algo = algo
+        self.results = multiprocessing.Queue()
+        self.pending = {}   # request id -> (Deferred, Validator, deadline)
+        self.request_id = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.validators = [ Validator(self.table, algo, self.results) for i in xrange(processes) ]
+        log.info("Started %d validator processes" % processes)
+        reactor.callWhenRunning(self._start_reader)
+        self.clock = reactor.callLater(VALIDATOR_CHECK_TIME, self.check)
+
+    def publish(self, job_id, version, prevhash_bin, nbits, coinb1, coinb2, merkle_steps):
+        return self.table.publish(job_id, version, prevhash_bin, nbits, coinb1, coinb2, merkle_steps)
+
+    def validate(self, slot, job_id, extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin, version, target):
+        self.request_id += 1
+        validator = min(self.validators, key=lambda v: len(v.pending))
+        d = defer.Deferred()
+        self.pending[self.request_id] = (d, validator, reactor.seconds() + settings.VALIDATOR_TIMEOUT)
+        validator.pending.add(self.request_id)
+        validator.requests.put((self.request_id, slot, job_id, extranonce1_bin, extranonce2_bin, ntime_bin, nonce_bin,
+            version, target))
+        return d
+
+    def _start_reader(self):
+        # A thread of its own, it blocks on the queue for good
+        reader = threading.Thread(target=self._read_results, name='validator_results')
+        reader.daemon = True
+        reader.start()
+
+    def _read_results(self):
+        while True:
+            (request_id, result, error) = self.results.get()
+            reactor.callFromThread(self._verdict, request_id, result, error)
+
+    def _verdict(self, request_id, result, error):
+        # Late verdicts of requests which timed out are dropped
+        pending = self.pending.pop(request_id, None)
+        if pending is None:
+            return
+        (d, validator, deadline) = pending
+        validator.pending.discard(request_id)
+        if error is not None:
+            d.errback(SubmitException(error))
+        else:
+            d.callback(result)
+
+    def _fail(self, request_id, reason):
+        (d, validator, deadline) = self.pending.pop(request_id)
+        validator.pending.discard(request_id)
+        d.errback(SubmitException(reason))
+
+    def check(self):
+        for (i, validator) in enumerate(self.validators):
+            if validator.process.is_alive():
+                continue
+            log.error("Validator process %d died (exit code %s), %d shares lost, restarting it" % (
+                validator.process.pid, validator.process.exitcode, len(validator.pending)))
+            for request_id in list(validator.pending):
+                self._fail(request_id, "Validation failed")
+            self.validators[i] = Validator(self.table, self.algo, self.results)
+            self.restarts += 1
+
+        now = reactor.seconds()
+        expired = [ request_id for (request_id, (d, validator, deadline)) in self.pending.iteritems() if deadline <= now ]
+        if expired:
+            log.error("%d shares got no verdict within %d sec" % (len(expired), settings.VALIDATOR_TIMEOUT))
+            self.timeouts += len(expired)
+        for request_id in expired:
+            self._fail(request_id, "Validation timed out")
+
+        self.clock = reactor.callLater(VALIDATOR_CHECK_TIME, self.check)
+
+    def get_stats(self):
+        return {
+            'processes': len([ v for v in self.validators if v.process.is_alive() ]),
+            'pending': len(self.pending),
+            'timeouts': self.timeouts,
+            'restarts': self.restarts,
+        }
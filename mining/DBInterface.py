@@ -3,9 +3,15 @@ import time
 from datetime import datetime
 import Queue
 import signal
+import threading
+from collections import OrderedDict
 
 import lib.settings as settings
 import DB_Mysql
+from share_rollup import ShareRollup
+from auth_cache import AuthCache
+from credential_table import CredentialTable
+from twisted.internet import threads
 
 import lib.logger
 log = lib.logger.get_logger('DBInterface')
@@ -15,19 +21,76 @@ class DBInterface():
         self.dbi = self.connectDB()
 
     def init_main(self):
-        self.dbi.check_tables() 
+        # Workers of supervisor.tac (WORKER_ID set) only read workers and
+        # write their difficulty. The table checks, the share/block import
+        # and the partition maintenance run in the supervisor alone, which
+        # writes the shares of all of them.
+        maintenance = settings.WORKER_ID is None
+        if maintenance:
+            self.dbi.check_tables() 
         self.q = Queue.Queue()
         self.queueclock = None
-        self.usercache = {}
-        self.clearusercache()
+        self.init_block_lane()
+        self.rollup_q = Queue.Queue()
+        self.rollup = ShareRollup(settings.DB_ROLLUP_TIME) if settings.DB_SHARE_ROLLUP else None
+        self.local = threading.local()
+        self.auth_cache = AuthCache(self.lookup_worker, settings.DB_USERCACHE_TIME,
+                                    settings.DB_USERCACHE_NEGATIVE_TIME, settings.DB_USERCACHE_STALE_TIME,
+                                    settings.DB_USERCACHE_JITTER, settings.DB_USERCACHE_SIZE,
+                                    settings.USERS_CHECK_PASSWORD)
+        self.user_listeners = []
+        # worker_name -> until when its lookups skip the replicas, which may
+        # not have seen the latest change of the worker yet
+        self.primary_reads = {}
+        self.credentials = None
+        if settings.USERS_AUTH_MODE == 'table':
+            self.init_credentials()
+        # Last difficulty of every worker, new connections start with it.
+        # Only used with vardiff, a fixed difficulty stays at POOL_TARGET.
+        self.start_history = settings.VARIABLE_DIFF and settings.VDIFF_START_HISTORY
+        self.worker_diffs = self.dbi.get_worker_diffs() if self.start_history else {}
+        # Difficulties set here since the last history sync began, None
+        # without syncs
+        self.worker_diff_changes = None
+        if self.start_history and not maintenance:
+            # The other workers' retargets only reach us through the DB
+            self.worker_diff_changes = {}
+            self.diffsyncclock = reactor.callLater(settings.VDIFF_HISTORY_SYNC_TIME, self.run_worker_diff_sync)
+        # Difficulty writes, applied in order by one thread at a time
+        self.worker_diff_q = Queue.Queue()
+        self.worker_diff_lock = threading.Lock()
         self.nextStatsUpdate = 0
-        self.scheduleImport()        
         self.next_force_import_time = time.time() + settings.DB_LOADER_FORCE_TIME    
+        if not maintenance:
+            return
+        self.scheduleImport()        
+        if settings.DB_SHARES_PARTITION:
+            self.run_partition_thread()
         signal.signal(signal.SIGINT, self.signal_handler)
 
+    def init_block_lane(self):
+        # Found blocks skip the bulk share queue. Shares are tracked by their
+        # solution hash while they are queued (pending), while an import thread
+        # is writing them (inflight) and once they have a row id (share_ids),
+        # so the block result never has to wait for the backlog or search
+        # the shares table.
+        self.block_q = Queue.Queue()
+        self.payout_q = Queue.Queue()
+        self.block_lock = threading.Lock()
+        self.pending_solutions = {}
+        self.inflight_solutions = set()
+        self.claimed_solutions = set()
+        self.block_shares = {}
+        self.block_results = {}
+        self.share_ids = OrderedDict()
+
     def signal_handler(self, signal, frame):
         print "SIGINT Detected, shutting down"
+        if self.rollup:
+            for row in self.rollup.pop_all():
+                self.rollup_q.put(row)
         self.do_import(self.dbi, True)
+        self.do_block_import(self.dbi)
         reactor.stop()
 
     def set_bitcoinrpc(self, bitcoinrpc):
@@ -37,10 +100,63 @@ class DBInterface():
         log.debug("DB_Mysql INIT")
         return DB_Mysql.DB_Mysql()
 	    
-    def clearusercache(self):
-        log.debug("DBInterface.clearusercache called")
-        self.usercache = {}
-        self.usercacheclock = reactor.callLater(settings.DB_USERCACHE_TIME , self.clearusercache)
+    def init_credentials(self):
+        # Startup load is done right here, nobody is connected yet
+        start = time.time()
+        self.credentials = CredentialTable()
+        self.credentials.load(self.dbi.list_users(self.credential_columns()))
+        self.last_user_sync = start
+        self.next_full_user_sync = start + settings.USERS_TABLE_FULL_SYNC_TIME
+        log.info("Loaded %d workers into the credential table in %.03f sec", len(self.credentials), time.time() - start)
+        self.usersyncclock = reactor.callLater(settings.USERS_TABLE_SYNC_TIME, self.run_user_sync)
+
+    def credential_columns(self):
+        return ('id', 'username', 'password')
+
+    def run_user_sync(self):
+        full = time.time() >= self.next_full_user_sync
+        if full:
+            self.next_full_user_sync = time.time() + settings.USERS_TABLE_FULL_SYNC_TIME
+
+        d = threads.deferToThread(self.fetch_user_changes, full)
+        d.addCallback(self._user_sync_done, full)
+        d.addErrback(self._user_sync_failed)
+        d.addBoth(self._schedule_user_sync)
+
+    def fetch_user_changes(self, full):
+        # Runs in a pool thread. The overlap of one sync period covers
+        # rows committed while the previous sync was running.
+        start = time.time()
+        dbi = self.thread_dbi()
+        if full:
+            rows = list(dbi.list_users(self.credential_columns()))
+        else:
+            rows = list(dbi.list_users(self.credential_columns(), self.credentials.max_id,
+                settings.USERS_TABLE_UPDATED_COLUMN, self.last_user_sync - settings.USERS_TABLE_SYNC_TIME))
+        return (start, rows)
+
+    def _user_sync_done(self, result, full):
+        (start, rows) = result
+        if full:
+            changed = self.credentials.load(rows)
+        else:
+            changed = self.credentials.update(rows)
+        self.last_user_sync = start
+        if changed:
+            self.notify_user_change(changed)
+        log.debug("Credential table sync (%s): %d rows, %d changed", 'full' if full else 'incremental', len(rows), len(changed))
+
+    def _user_sync_failed(self, failure):
+        log.error("Credential table sync failed: %s", failure.getErrorMessage())
+
+    def _schedule_user_sync(self, result):
+        self.usersyncclock = reactor.callLater(settings.USERS_TABLE_SYNC_TIME, self.run_user_sync)
+
+    def thread_dbi(self):
+        # One connection per pool thread for the lookups done outside the reactor
+        if not hasattr(self.local, 'dbi'):
+            self.local.dbi = self.connectDB()
+        return self.local.dbi
 
     def scheduleImport(self):
         # This schedule's the Import
@@ -48,9 +164,18 @@ class DBInterface():
     
     def run_import_thread(self):
         log.debug("run_import_thread current size: %d", self.q.qsize())
+
+        # Hand finished share buckets over to the loader
+        if self.rollup:
+            for row in self.rollup.pop_closed(time.time()):
+                self.rollup_q.put(row)
         
-        if self.q.qsize() >= settings.DB_LOADER_REC_MIN or time.time() >= self.next_force_import_time:
+        if self.q.qsize() >= settings.DB_LOADER_REC_MIN or time.time() >= self.next_force_import_time or not self.rollup_q.empty():
             reactor.callInThread(self.import_thread)
+
+        # Retry block records which failed or were handed back by the bulk loader
+        if not self.block_q.empty() or not self.payout_q.empty():
+            reactor.callInThread(self.block_import_thread)
                 
         self.scheduleImport()
 
@@ -60,6 +185,20 @@ class DBInterface():
         self.do_import(dbi, False)       
         dbi.close()
 
+    def run_partition_thread(self):
+        reactor.callInThread(self.partition_thread)
+        self.partitionclock = reactor.callLater(settings.DB_PARTITION_CHECKTIME, self.run_partition_thread)
+
+    def partition_thread(self):
+        # Adds tomorrow's partitions and archives the expired ones,
+        # on its own connection so the share loader is not held up
+        dbi = self.connectDB()
+        try:
+            dbi.maintain_share_partitions(settings.DB_SHARES_PARTITION_AHEAD, settings.DB_SHARES_RETENTION_DAYS)
+        except Exception as e:
+            log.error("Shares Partition Maintenance Failed: %s", e.args[0])
+        dbi.close()
+
     def _update_pool_info(self, data):
         self.dbi.update_pool_info({ 'blocks' : data['blocks'], 'balance' : data['balance'],
             'connections' : data['connections'], 'difficulty' : data['difficulty'] })
@@ -67,6 +206,8 @@ class DBInterface():
     def do_import(self, dbi, force):
         log.info("DBInterface.do_import called. force: %s, queue size: %s", 'yes' if force == True else 'no', self.q.qsize())
         
+        self.do_rollup_import(dbi)
+
         # Flush the whole queue on force
         forcesize = 0
         if force == True:
@@ -88,29 +229,184 @@ class DBInterface():
                 self.q.task_done()
 
             forcesize -= datacnt
+
+            # Drop the shares the block lane has already written
+            sqldata = self.start_share_import(sqldata)
+            if not sqldata:
+                continue
                 
             # try to do the import, if we fail, log the error and put the data back in the queue
             try:
-                log.info("Inserting %s Share Records", datacnt)
-                dbi.import_shares(sqldata)
+                log.info("Inserting %s Share Records", len(sqldata))
+                share_ids = dbi.import_shares(sqldata)
             except Exception as e:
                 log.error("Insert Share Records Failed: %s", e.args[0])
+                self.abort_share_import(sqldata)
                 for k, v in enumerate(sqldata):
                     self.q.put(v)
                 break  # Allows us to sleep a little
 
+            self.finish_share_import(dbi, sqldata, share_ids)
+
+    def do_rollup_import(self, dbi):
+        while self.rollup_q.empty() == False:
+            rows = []
+            while self.rollup_q.empty() == False and len(rows) < settings.DB_LOADER_REC_MAX:
+                rows.append(self.rollup_q.get())
+                self.rollup_q.task_done()
+
+            try:
+                log.info("Inserting %s Share Rollup Records", len(rows))
+                dbi.import_rollups(rows)
+            except Exception as e:
+                log.error("Insert Share Rollup Records Failed: %s", e.args[0])
+                for row in rows:
+                    self.rollup_q.put(row)
+                break
+
+    def start_share_import(self, sqldata):
+        '''Marks the solutions of a batch as inflight and removes
+        the shares which were already inserted by the block lane.'''
+        batch = []
+        with self.block_lock:
+            for v in sqldata:
+                solution = v[1]
+                if solution in self.claimed_solutions:
+                    self.claimed_solutions.discard(solution)
+                    continue
+                if self.pending_solutions.pop(solution, None) is not None:
+                    self.inflight_solutions.add(solution)
+                batch.append(v)
+        return batch
+
+    def abort_share_import(self, sqldata):
+        with self.block_lock:
+            for v in sqldata:
+                solution = v[1]
+                if solution not in self.inflight_solutions:
+                    continue
+                self.inflight_solutions.discard(solution)
+                self.pending_solutions[solution] = v
+                # The block lane parked a result for this share, let it retry
+                if solution in self.block_results:
+                    self.block_q.put(self.block_results.pop(solution))
+
+    def finish_share_import(self, dbi, sqldata, share_ids):
+        waiting = []
+        with self.block_lock:
+            for v, share_id in zip(sqldata, share_ids):
+                solution = v[1]
+                if solution not in self.inflight_solutions:
+                    continue
+                self.inflight_solutions.discard(solution)
+                self.remember_share_id(solution, share_id)
+                if solution in self.block_results:
+                    waiting.append((self.block_results.pop(solution), share_id))
+
+        for data, share_id in waiting:
+            try:
+                log.info("Updating Found Block Share Record %s", share_id)
+                dbi.found_block(data, share_id)
+            except Exception as e:
+                log.error("Update Found Block Share Record Failed: %s", e.args[0])
+                self.block_q.put(data)
+
+    def remember_share_id(self, solution, share_id):
+        # Called with block_lock held
+        self.share_ids[solution] = share_id
+        while len(self.share_ids) > settings.DB_SOLUTION_CACHE_SIZE:
+            self.share_ids.popitem(last=False)
+
     def queue_share(self, data):
+        if self.rollup:
+            self.rollup.add(data)
+            if not settings.DB_SHARE_ROWS:
+                # Block candidates still get their own row through found_block
+                return
+
+        # Only valid shares can be block candidates
+        if data[4] and data[1]:
+            with self.block_lock:
+                self.pending_solutions[data[1]] = data
         self.q.put(data)
 
     def found_block(self, data):
-        try:
-            log.info("Updating Found Block Share Record")
-            self.do_import(self.dbi, True)  # We can't Update if the record is not there.
-            self.dbi.found_block(data)
-        except Exception as e:
-            log.error("Update Found Block Share Record Failed: %s", e.args[0])
+        log.info("Queueing Found Block Share Record")
+        self.block_q.put(data)
+        reactor.callInThread(self.block_import_thread)
+
+    def queue_payout(self, block_hash, timestamp, rows):
+        log.info("Queueing PPLNS snapshot of %d workers for block %s", len(rows), block_hash)
+        self.payout_q.put((block_hash, timestamp, rows))
+        reactor.callInThread(self.block_import_thread)
+
+    def block_import_thread(self):
+        dbi = self.connectDB()
+        self.do_block_import(dbi)
+        dbi.close()
+
+    def do_block_import(self, dbi):
+        failed = []
+        while self.block_q.empty() == False:
+            data = self.block_q.get()
+            self.block_q.task_done()
+            try:
+                self.import_block(dbi, data)
+            except Exception as e:
+                log.error("Update Found Block Share Record Failed: %s", e.args[0])
+                failed.append(data)
+
+        # Retried by the next run_import_thread
+        for data in failed:
+            self.block_q.put(data)
+
+        failed = []
+        while self.payout_q.empty() == False:
+            payout = self.payout_q.get()
+            self.payout_q.task_done()
+            try:
+                dbi.import_payout(*payout)
+            except Exception as e:
+                log.error("Insert PPLNS Snapshot Failed: %s", e.args[0])
+                failed.append(payout)
+
+        for payout in failed:
+            self.payout_q.put(payout)
+
+    def import_block(self, dbi, data):
+        solution = data[1]
+        share = None
+        with self.block_lock:
+            share_id = self.share_ids.get(solution)
+            if share_id is None:
+                if solution in self.block_shares:
+                    # Our own insert of this share failed last time
+                    share = self.block_shares[solution]
+                elif solution in self.pending_solutions:
+                    # Still waiting in the bulk queue, insert it ourselves
+                    # and make the bulk loader skip it
+                    share = self.pending_solutions.pop(solution)
+                    self.block_shares[solution] = share
+                    self.claimed_solutions.add(solution)
+                elif solution in self.inflight_solutions:
+                    # An import thread is writing it right now,
+                    # finish_share_import applies the result
+                    self.block_results[solution] = data
+                    return
+
+        if share is not None:
+            log.info("Inserting Found Block Share Record")
+            share_id = dbi.import_shares([share])[0]
+            with self.block_lock:
+                del self.block_shares[solution]
+                self.remember_share_id(solution, share_id)
+
+        log.info("Updating Found Block Share Record")
+        dbi.found_block(data, share_id)
 
     def check_password(self, username, password):
+        '''Returns True/False from the auth cache, or a Deferred
+        when the worker has to be looked up in the database.'''
         if username == "":
             log.info("Rejected worker for blank username")
             return False
@@ -118,23 +414,43 @@ class DBInterface():
         # Force username and password to be strings
         username = str(username)
         password = str(password)
-        wid = username + ":-:" + password
 
-        if wid in self.usercache:
+        if self.credentials is None:
+            return self.auth_cache.check(username, password)
+
+        result = self.credentials.check(username, password, settings.USERS_CHECK_PASSWORD)
+        if result is None and settings.USERS_AUTOADD == True:
+            self.credentials.set(username, password)
+            reactor.callInThread(self.thread_insert_user, username, password)
             return True
-        elif not settings.USERS_CHECK_PASSWORD and self.user_exists(username): 
-            self.usercache[wid] = 1
+        elif not result:
+            log.info("Authentication for %s failed" % username)
+        return bool(result)
+
+    def thread_insert_user(self, username, password):
+        try:
+            self.thread_dbi().insert_user(username, password)
+        except Exception as e:
+            log.error("Adding worker %s failed: %s", username, e.args[0])
+
+    def lookup_worker(self, username, password):
+        # Runs in a pool thread, see AuthCache
+        dbi = self.thread_dbi()
+        use_primary = self.primary_reads.get(username, 0) > time.time()
+
+        if not settings.USERS_CHECK_PASSWORD and dbi.get_user(username, use_primary) is not None: 
             return True
-        elif self.dbi.check_password(username, password):
-            self.usercache[wid] = 1
+        elif dbi.check_password(username, password, use_primary):
             return True
         elif settings.USERS_AUTOADD == True:
-            self.insert_user(username, password)
-            self.usercache[wid] = 1
+            dbi.insert_user(username, password)
             return True
         
         log.info("Authentication for %s failed" % username)
         return False
+
+    def get_auth_stats(self):
+        return self.auth_cache.get_stats()
     
     def list_users(self):
         return self.dbi.list_users()
@@ -147,18 +463,129 @@ class DBInterface():
         return user is not None 
 
     def insert_user(self, username, password):        
+        if self.credentials is not None:
+            self.credentials.set(username, password)
         return self.dbi.insert_user(username, password)
 
+    def worker_name(self, id_or_username):
+        # Workers are only known by name to the caches, an id is looked up
+        # once on the primary (before the change, a deleted row is gone)
+        if not id_or_username.isdigit():
+            return id_or_username
+        return self.dbi.get_worker_name(id_or_username)
+
+    def invalidate_user(self, id_or_username, username):
+        # Returns the worker name, None for an unknown id
+        if self.credentials is not None:
+            username = self.credentials.remove(id_or_username) or username
+
+        if username is not None:
+            self.auth_cache.invalidate(username)
+            self.read_from_primary(username)
+        return username
+
+    def read_from_primary(self, username):
+        # For as long as a usable replica may lag behind (checked every
+        # DB_MYSQL_REPLICA_CHECKTIME), the worker's lookups go to the primary
+        if not settings.DB_MYSQL_REPLICAS:
+            return
+        now = time.time()
+        primary_reads = dict([ (name, until) for (name, until) in self.primary_reads.iteritems() if until > now ])
+        primary_reads[username] = now + settings.DB_MYSQL_REPLICA_MAX_LAG + settings.DB_MYSQL_REPLICA_CHECKTIME
+        # Replaced in one go, lookup_worker reads it from pool threads
+        self.primary_reads = primary_reads
+
+    def add_user_listener(self, callback):
+        # callback(usernames) runs in the reactor after worker credentials
+        # changed, usernames is None when any worker may be affected
+        self.user_listeners.append(callback)
+
+    def notify_user_change(self, usernames):
+        for callback in self.user_listeners:
+            reactor.callFromThread(callback, usernames)
+
+    # The cache is invalidated after the write, a lookup between the two
+    # would cache the old credentials
     def delete_user(self, username):
-        self.usercache = {}
-        return self.dbi.delete_user(username)
+        name = self.worker_name(username)
+        ret = self.dbi.delete_user(username)
+        name = self.invalidate_user(username, name)
+        if name:
+            self.notify_user_change([name])
+        return ret
         
     def update_user(self, username, password):
-        self.usercache = {}
-        return self.dbi.update_user(username, password)
+        name = self.worker_name(username)
+        ret = self.dbi.update_user(username, password)
+        name = self.invalidate_user(username, name)
+        if self.credentials is not None and name:
+            self.credentials.set(name, password)
+        if name:
+            self.notify_user_change([name])
+        return ret
 
     def update_worker_diff(self, username, diff):
-        return self.dbi.update_worker_diff(username, diff)
+        self.update_worker_diffs([ (username, diff) ])
+
+    def update_worker_diffs(self, rows):
+        # rows: [(username, diff), ...], written in one go by a pool thread
+        self.remember_worker_diffs(rows)
+        self.worker_diff_q.put(rows)
+        reactor.callInThread(self.thread_update_worker_diffs)
+
+    def remember_worker_diffs(self, rows):
+        if self.start_history:
+            self.worker_diffs.update(rows)
+        if self.worker_diff_changes is not None:
+            self.worker_diff_changes.update(rows)
+
+    def get_worker_diff(self, username):
+        # None for workers we don't know a difficulty for
+        return self.worker_diffs.get(username)
+
+    def run_worker_diff_sync(self):
+        self.worker_diff_changes = {}
+        d = threads.deferToThread(self.fetch_worker_diffs)
+        d.addCallback(self._worker_diff_sync_done)
+        d.addErrback(self._worker_diff_sync_failed)
+        d.addBoth(self._schedule_worker_diff_sync)
+
+    def fetch_worker_diffs(self):
+        # Runs in a pool thread
+        return self.thread_dbi().get_worker_diffs()
+
+    def _worker_diff_sync_done(self, diffs):
+        # Our own retargets of the meantime may not be written yet
+        diffs.update(self.worker_diff_changes)
+        self.worker_diffs = diffs
+        log.debug("Worker difficulty sync: %d workers", len(diffs))
+
+    def _worker_diff_sync_failed(self, failure):
+        log.error("Worker difficulty sync failed: %s", failure.getErrorMessage())
+
+    def _schedule_worker_diff_sync(self, result):
+        self.diffsyncclock = reactor.callLater(settings.VDIFF_HISTORY_SYNC_TIME, self.run_worker_diff_sync)
+
+    def thread_update_worker_diffs(self):
+        # Only one thread writes at a time and it takes the sweeps in queue
+        # order, so an older difficulty can't be committed after a newer one.
+        # A thread finding the lock taken leaves its rows to the writer,
+        # which looks at the queue again after releasing it.
+        while not self.worker_diff_q.empty():
+            if not self.worker_diff_lock.acquire(False):
+                return
+            try:
+                latest = OrderedDict()
+                while not self.worker_diff_q.empty():
+                    latest.update(self.worker_diff_q.get())
+                    self.worker_diff_q.task_done()
+                if latest:
+                    try:
+                        self.thread_dbi().update_worker_diffs(latest.items())
+                    except Exception as e:
+                        log.error("Updating %d worker difficulties failed: %s", len(latest), e.args[0])
+            finally:
+                self.worker_diff_lock.release()
 
     def get_pool_stats(self):
         return self.dbi.get_pool_stats()
@@ -166,6 +593,9 @@ class DBInterface():
     def get_workers_stats(self):
         return self.dbi.get_workers_stats()
 
+    def get_replica_status(self):
+        return self.dbi.get_replica_status()
+
     def clear_worker_diff(self):
         return self.dbi.clear_worker_diff()
 
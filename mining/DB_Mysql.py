@@ -1,11 +1,86 @@
 import time
+import datetime
 import hashlib
 import lib.settings as settings
 import lib.logger
 log = lib.logger.get_logger('DB_Mysql')
 
 import MySQLdb
-                
+
+class MysqlReplica(object):
+    '''Read-only MySQL endpoint. Replication lag is checked at most every
+    DB_MYSQL_REPLICA_CHECKTIME seconds, a lagging or failing replica is
+    skipped until the next check.'''
+
+    def __init__(self, config):
+        self.host = config.get('host', getattr(settings, 'DB_MYSQL_HOST'))
+        self.user = config.get('user', getattr(settings, 'DB_MYSQL_USER'))
+        self.passwd = config.get('pass', getattr(settings, 'DB_MYSQL_PASS'))
+        self.dbname = config.get('dbname', getattr(settings, 'DB_MYSQL_DBNAME'))
+        self.port = config.get('port', getattr(settings, 'DB_MYSQL_PORT'))
+
+        self.dbh = None
+        self.dbc = None
+        self.lag = None
+        self.healthy = False
+        self.next_check = 0
+
+    def __str__(self):
+        return "%s:%s" % (self.host, self.port)
+
+    def connect(self):
+        self.dbh = MySQLdb.connect(self.host, self.user, self.passwd, self.dbname, self.port)
+        self.dbc = self.dbh.cursor()
+        self.dbh.autocommit(True)
+
+    def close(self):
+        if self.dbh:
+            self.dbh.close()
+        self.dbh = None
+        self.dbc = None
+
+    def check(self, now):
+        self.next_check = now + settings.DB_MYSQL_REPLICA_CHECKTIME
+        try:
+            if not self.dbh:
+                self.connect()
+            self.dbc.execute("SHOW SLAVE STATUS")
+            row = self.dbc.fetchone()
+        except MySQLdb.Error as e:
+            log.warning("MySQL replica %s is unavailable: %s", self, e.args)
+            self.close()
+            self.lag = None
+            self.healthy = False
+            return
+
+        if row is None:
+            # Not a replica at all (e.g. a proxy in front of one), trust it
+            self.lag = 0
+        else:
+            columns = [ d[0] for d in self.dbc.description ]
+            # NULL when the replication threads are not running
+            self.lag = row[columns.index('Seconds_Behind_Master')]
+
+        healthy = self.lag is not None and self.lag <= settings.DB_MYSQL_REPLICA_MAX_LAG
+        if healthy != self.healthy:
+            log.info("MySQL replica %s is %s (lag %s)", self, 'in use' if healthy else 'skipped', self.lag)
+        self.healthy = healthy
+
+    def usable(self, now):
+        if now >= self.next_check:
+            self.check(now)
+        return self.healthy
+
+    def execute(self, query, args=None):
+        try:
+            self.dbc.execute(query, args)
+        except MySQLdb.Error:
+            # Back to the primary until the next lag check finds us again
+            self.close()
+            self.healthy = False
+            raise
+        return self.dbc
+
 class DB_Mysql():
     def __init__(self):
         log.debug("DB_Mysql Connecting to DB")
@@ -20,6 +95,10 @@ class DB_Mysql():
         
         self.salt = getattr(settings, 'PASSWORD_SALT')
         self.connect()
+
+        # Reads which may be slightly stale go to the replicas
+        self.replicas = [ MysqlReplica(config) for config in settings.DB_MYSQL_REPLICAS ]
+        self.next_replica = 0
         
     def connect(self):
         self.dbh = MySQLdb.connect(
@@ -52,6 +131,32 @@ class DB_Mysql():
             
             self.dbc.executemany(query, args)
     
+    def execute_read(self, query, args=None, use_primary=False):
+        '''Runs a read query on a healthy replica, falling back to the
+        primary (or on the primary right away with use_primary). Returns
+        the cursor holding the result.'''
+        now = time.time()
+        for i in range(0 if use_primary else len(self.replicas)):
+            replica = self.replicas[(self.next_replica + i) % len(self.replicas)]
+            if not replica.usable(now):
+                continue
+
+            self.next_replica = (self.next_replica + i + 1) % len(self.replicas)
+            try:
+                return replica.execute(query, args)
+            except MySQLdb.Error as e:
+                log.warning("Read on MySQL replica %s failed: %s", replica, e.args)
+
+        self.execute(query, args)
+        return self.dbc
+
+    def get_replica_status(self):
+        return [ {
+            "host": str(replica),
+            "healthy": replica.healthy,
+            "lag": replica.lag
+        } for replica in self.replicas ]
+
     def import_shares(self, data):
         # Data layout
         # 0: worker_name,
@@ -64,16 +169,15 @@ class DB_Mysql():
         # 7: share_diff
 
         log.debug("Importing MYSQL Shares")
-        checkin_times = {}
-        total_shares = 0
-        best_diff = 0
+        share_ids = []
         
         for k, v in enumerate(data):
             # for database compatibility we are converting our_worker to Y/N format
-            if v[4]:
-                v[4] = 'Y'
+            # (without touching the record, it may be queued again on failure)
+            if v[4] and v[4] != 'N':
+                lres = 'Y'
             else:
-                v[4] = 'N'
+                lres = 'N'
 
             self.execute(
                 """
@@ -89,52 +193,121 @@ class DB_Mysql():
                     "time": v[3], 
                     "host": v[5], 
                     "uname": v[0], 
-                    "lres": v[4], 
+                    "lres": lres, 
                     "reason": v[6],
                     "solution": v[1],
                     "difficulty": v[2]
                 }
             )
+            share_ids.append(self.dbc.lastrowid)
 
             self.dbh.commit()
 
-    def found_block(self, data):
-        # for database compatibility we are converting our_worker to Y/N format
-        if data[4]:
-            data[4] = 'Y'
-        else:
-            data[4] = 'N'
+        return share_ids
 
-        # Check for the share in the database before updating it
-        # Note: We can't use DUPLICATE KEY because solution is not a key
+    def import_rollups(self, data):
+        # Data layout, see ShareRollup._rows
+        # 0: bucket time, 1: worker_name,
+        # 2: accepted, 3: accepted_diff,
+        # 4: rejected, 5: rejected_diff,
+        # 6: best_share, 7: reject reasons
 
-        self.execute(
+        log.debug("Importing MYSQL Share Rollups")
+        rejects = []
+
+        self.executemany(
             """
-            Select `id` from `shares`
-            WHERE `solution` = %(solution)s
-            LIMIT 1
+            INSERT INTO `share_rollups`
+            (time, username, accepted, accepted_diff,
+              rejected, rejected_diff, best_share)
+            VALUES
+            (FROM_UNIXTIME(%s), %s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+              `accepted` = `accepted` + VALUES(`accepted`),
+              `accepted_diff` = `accepted_diff` + VALUES(`accepted_diff`),
+              `rejected` = `rejected` + VALUES(`rejected`),
+              `rejected_diff` = `rejected_diff` + VALUES(`rejected_diff`),
+              `best_share` = GREATEST(`best_share`, VALUES(`best_share`))
             """,
-            {
-                "solution": data[1]
-            }
+            [ v[:7] for v in data ]
         )
 
-        shareid = self.dbc.fetchone()
+        for v in data:
+            for (reason, count) in v[7].items():
+                rejects.append((v[0], v[1], reason, count))
+
+        if rejects:
+            self.executemany(
+                """
+                INSERT INTO `share_rollup_rejects`
+                (time, username, reason, count)
+                VALUES
+                (FROM_UNIXTIME(%s), %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                  `count` = `count` + VALUES(`count`)
+                """,
+                rejects
+            )
+
+        self.dbh.commit()
+
+    def import_payout(self, block_hash, timestamp, rows):
+        # rows: (worker_name, window_diff, round_diff), see PPLNSWindow.snapshot
+        log.debug("Importing MYSQL PPLNS Snapshot for %s", block_hash)
+
+        # executemany sends a single multi-row INSERT,
+        # so the snapshot is stored completely or not at all
+        self.executemany(
+            """
+            INSERT IGNORE INTO `pplns_payouts`
+            (block_hash, time, username, window_diff, round_diff)
+            VALUES
+            (%s, FROM_UNIXTIME(%s), %s, %s, %s)
+            """,
+            [ (block_hash, timestamp, v[0], v[1], v[2]) for v in rows ]
+        )
+
+        self.dbh.commit()
+
+    def found_block(self, data, share_id=None):
+        # for database compatibility we are converting our_worker to Y/N format
+        # (the record is queued again if this fails, so leave it alone)
+        if data[4] and data[4] != 'N':
+            result = 'Y'
+        else:
+            result = 'N'
+
+        # The share id usually comes from DBInterface's solution map, so the
+        # shares table (solution is not a key) is only searched when the id
+        # was evicted from it before the block result came in
+        if not share_id:
+            log.info("Share id of solution %s not known, looking it up", data[1])
+            self.execute(
+                """
+                SELECT `id` FROM `shares`
+                WHERE `solution` = %(solution)s
+                LIMIT 1
+                """,
+                {
+                    "solution": data[1]
+                }
+            )
+            row = self.dbc.fetchone()
+            if row and row[0] > 0:
+                share_id = row[0]
 
-        if shareid and shareid[0] > 0:
+        if share_id:
             # Note: difficulty = -1 here
             self.execute(
                 """
                 UPDATE `shares`
                 SET `upstream_result` = %(result)s
-                WHERE `solution` = %(solution)s
-                AND `id` = %(id)s
+                WHERE `id` = %(id)s
                 LIMIT 1
                 """,
                 {
-                    "result": data[4], 
-                    "solution": data[1],
-                    "id": shareid[0]
+                    "result": result, 
+                    "id": share_id
                 }
             )
             
@@ -154,8 +327,8 @@ class DB_Mysql():
                     "time": data[3],
                     "host": data[5],
                     "uname": data[0],
-                    "lres": data[4],
-                    "result": data[4],
+                    "lres": result,
+                    "result": result,
                     "reason": data[6],
                     "solution": data[1]
                 }
@@ -163,27 +336,35 @@ class DB_Mysql():
 
             self.dbh.commit()
         
-    def list_users(self):
-        self.execute(
-            """
-            SELECT *
+    def list_users(self, columns=None, since_id=0, updated_column=None, updated_since=None):
+        # columns limits the result to the given columns, since_id and
+        # updated_since (unix time, needs updated_column) select the
+        # rows added or changed since the last call
+        query = """
+            SELECT %s
             FROM `pool_worker`
-            WHERE `id`> 0
-            """
-        )
+            WHERE `id`> %%(id)s
+            """ % (", ".join([ "`%s`" % c for c in columns ]) if columns else "*")
+
+        if updated_column and updated_since:
+            query += """
+              OR `%s` >= FROM_UNIXTIME(%%(updated)s)
+            """ % updated_column
+
+        dbc = self.execute_read(query, { "id": since_id, "updated": updated_since })
         
         while True:
-            results = self.dbc.fetchmany()
+            results = dbc.fetchmany()
             if not results:
                 break
             
             for result in results:
                 yield result               
                 
-    def get_user(self, id_or_username):
+    def get_user(self, id_or_username, use_primary=False):
         #log.debug("Finding user with id or username of %s", id_or_username)
         
-        self.execute(
+        dbc = self.execute_read(
             """
             SELECT *
             FROM `pool_worker`
@@ -193,12 +374,30 @@ class DB_Mysql():
             {
                 "id": id_or_username if id_or_username.isdigit() else -1,
                 "uname": id_or_username
-            }
+            },
+            use_primary
         )
         
-        user = self.dbc.fetchone()
+        user = dbc.fetchone()
         return user
 
+    def get_worker_name(self, id_or_username):
+        # On the primary, this is asked right before the worker is changed
+        self.execute(
+            """
+            SELECT `username`
+            FROM `pool_worker`
+            WHERE `id` = %(id)s
+              OR `username` = %(uname)s
+            """,
+            {
+                "id": id_or_username if id_or_username.isdigit() else -1,
+                "uname": id_or_username
+            }
+        )
+        row = self.dbc.fetchone()
+        return row[0] if row else None
+
     def get_uid(self, id_or_username):
         log.debug("Finding user id of %s", id_or_username)
         uname = id_or_username.split(".", 1)[0]
@@ -289,10 +488,10 @@ class DB_Mysql():
         
         self.dbh.commit()
 
-    def check_password(self, username, password):
+    def check_password(self, username, password, use_primary=False):
         log.debug("Checking username/password for %s", username)
         
-        self.execute(
+        dbc = self.execute_read(
             """
             SELECT COUNT(*) 
             FROM `pool_worker`
@@ -302,17 +501,18 @@ class DB_Mysql():
             {
                 "uname": username, 
                 "pass": password
-            }
+            },
+            use_primary
         )
         
-        data = self.dbc.fetchone()
+        data = dbc.fetchone()
         if data[0] > 0:
             return True
         
         return False
 
     def get_workers_stats(self):
-        self.execute(
+        dbc = self.execute_read(
             """
             SELECT `username`, `speed`, `last_checkin`, `total_shares`,
               `total_rejects`, `total_found`, `alive`, `difficulty`
@@ -323,7 +523,7 @@ class DB_Mysql():
         
         ret = {}
         
-        for data in self.dbc.fetchall():
+        for data in dbc.fetchall():
             ret[data[0]] = {
                 "username": data[0],
                 "speed": int(data[1]),
@@ -337,6 +537,17 @@ class DB_Mysql():
             
         return ret
 
+    def get_worker_diffs(self):
+        self.execute(
+            """
+            SELECT `username`, `difficulty`
+            FROM `pool_worker`
+            WHERE `difficulty` > 0
+            """
+        )
+
+        return dict([ (data[0], float(data[1])) for data in self.dbc.fetchall() ])
+
     def update_worker_diff(self, username, diff):
         log.debug("Setting difficulty for %s to %s", username, diff)
         
@@ -354,6 +565,20 @@ class DB_Mysql():
         
         self.dbh.commit()
     
+    def update_worker_diffs(self, rows):
+        log.debug("Setting difficulty for %d workers", len(rows))
+
+        self.executemany(
+            """
+            UPDATE `pool_worker`
+            SET `difficulty` = %s
+            WHERE `username` = %s
+            """,
+            [ (diff, username) for (username, diff) in rows ]
+        )
+
+        self.dbh.commit()
+
     def clear_worker_diff(self):
         log.debug("Resetting difficulty for all workers")
         
@@ -375,6 +600,8 @@ class DB_Mysql():
 
     def close(self):
         self.dbh.close()
+        for replica in self.replicas:
+            replica.close()
 
     def check_tables(self):
         log.debug("Checking Database")
@@ -395,5 +622,307 @@ class DB_Mysql():
         
         if data[0] <= 0:
            raise Exception("There is no shares table. Have you imported the schema?")
+
+        if settings.DB_SHARE_ROLLUP:
+            self.create_rollup_tables()
+
+        if settings.PPLNS_ENABLE:
+            self.create_payout_table()
+
+        if settings.DB_SHARES_PARTITION:
+            self.create_archive_tables()
+            if not self.list_share_partitions():
+                self.partition_shares_table()
+
+    def create_payout_table(self):
+        log.debug("Checking PPLNS Payout Table")
+
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS `pplns_payouts` (
+              `block_hash` VARCHAR(65) NOT NULL,
+              `time` DATETIME NOT NULL,
+              `username` VARCHAR(120) NOT NULL,
+              `window_diff` DOUBLE NOT NULL DEFAULT 0,
+              `round_diff` DOUBLE NOT NULL DEFAULT 0,
+              PRIMARY KEY (`block_hash`, `username`)
+            ) ENGINE=InnoDB
+            """
+        )
+
+    def create_rollup_tables(self):
+        log.debug("Checking Share Rollup Tables")
+
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS `share_rollups` (
+              `time` DATETIME NOT NULL,
+              `username` VARCHAR(120) NOT NULL,
+              `accepted` INT UNSIGNED NOT NULL DEFAULT 0,
+              `accepted_diff` DOUBLE NOT NULL DEFAULT 0,
+              `rejected` INT UNSIGNED NOT NULL DEFAULT 0,
+              `rejected_diff` DOUBLE NOT NULL DEFAULT 0,
+              `best_share` DOUBLE NOT NULL DEFAULT 0,
+              PRIMARY KEY (`time`, `username`)
+            ) ENGINE=InnoDB
+            """
+        )
+
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS `share_rollup_rejects` (
+              `time` DATETIME NOT NULL,
+              `username` VARCHAR(120) NOT NULL,
+              `reason` VARCHAR(255) NOT NULL,
+              `count` INT UNSIGNED NOT NULL DEFAULT 0,
+              PRIMARY KEY (`time`, `username`, `reason`)
+            ) ENGINE=InnoDB
+            """
+        )
  
 
+
+    def create_archive_tables(self):
+        log.debug("Checking Share Archive Tables")
+
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS `shares_archive` (
+              `day` DATE NOT NULL,
+              `username` VARCHAR(120) NOT NULL,
+              `our_result` ENUM('Y','N') NOT NULL,
+              `upstream_result` ENUM('Y','N') NOT NULL,
+              `shares` INT UNSIGNED NOT NULL DEFAULT 0,
+              `difficulty` DOUBLE NOT NULL DEFAULT 0,
+              PRIMARY KEY (`day`, `username`, `our_result`, `upstream_result`)
+            ) ENGINE=InnoDB
+            """
+        )
+
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS `shares_archive_blocks` (
+              `id` BIGINT UNSIGNED NOT NULL,
+              `time` DATETIME NOT NULL,
+              `rem_host` VARCHAR(255) NOT NULL,
+              `username` VARCHAR(120) NOT NULL,
+              `our_result` ENUM('Y','N') NOT NULL,
+              `upstream_result` ENUM('Y','N') NOT NULL,
+              `reason` VARCHAR(255),
+              `solution` VARCHAR(257),
+              `difficulty` DOUBLE,
+              PRIMARY KEY (`id`)
+            ) ENGINE=InnoDB
+            """
+        )
+
+        # Partitions already copied into shares_archive but maybe not dropped yet
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS `shares_archive_partitions` (
+              `partition_name` VARCHAR(16) NOT NULL,
+              `archived` DATETIME NOT NULL,
+              PRIMARY KEY (`partition_name`)
+            ) ENGINE=InnoDB
+            """
+        )
+
+    def list_share_partitions(self):
+        '''Returns [(partition_name, day), ...] of the daily shares
+        partitions ordered by day. day is None for the catch-all pmax.'''
+        self.execute(
+            """
+            SELECT `partition_name`
+            FROM INFORMATION_SCHEMA.PARTITIONS
+            WHERE `table_schema` = %(schema)s
+              AND `table_name` = 'shares'
+              AND `partition_name` IS NOT NULL
+            ORDER BY `partition_ordinal_position`
+            """,
+            {
+                "schema": getattr(settings, 'DB_MYSQL_DBNAME')
+            }
+        )
+
+        ret = []
+        for data in self.dbc.fetchall():
+            if data[0] == 'pmax':
+                ret.append((data[0], None))
+            else:
+                ret.append((data[0], datetime.datetime.strptime(data[0], 'p%Y%m%d').date()))
+        return ret
+
+    def _partition_clause(self, day):
+        return "PARTITION p%s VALUES LESS THAN (TO_DAYS('%s'))" % \
+            (day.strftime('%Y%m%d'), (day + datetime.timedelta(days=1)).isoformat())
+
+    def partition_shares_table(self):
+        # One time conversion, this rebuilds the whole table.
+        # MySQL wants the partitioning column in every unique key.
+        log.warning("Converting shares table to daily partitions, this may take a while")
+        today = datetime.date.today()
+        days = [ today + datetime.timedelta(days=i) for i in range(settings.DB_SHARES_PARTITION_AHEAD + 1) ]
+
+        self.execute(
+            """
+            ALTER TABLE `shares`
+            DROP PRIMARY KEY,
+            ADD PRIMARY KEY (`id`, `time`)
+            """
+        )
+
+        # Everything older than today ends up in the first partition
+        # and is archived by the next maintenance run
+        self.execute(
+            "ALTER TABLE `shares` PARTITION BY RANGE (TO_DAYS(`time`)) (%s, %s)" % (
+                "PARTITION p%s VALUES LESS THAN (TO_DAYS('%s'))" % \
+                    ((today - datetime.timedelta(days=1)).strftime('%Y%m%d'), today.isoformat()),
+                ", ".join([ self._partition_clause(day) for day in days ] +
+                    [ "PARTITION pmax VALUES LESS THAN MAXVALUE" ])
+            )
+        )
+
+    def add_share_partitions(self, partitions, days_ahead, today=None):
+        '''Splits empty days off pmax, so inserts always go to a small partition'''
+        today = today or datetime.date.today()
+        last = max([ day for (name, day) in partitions if day ] or [today - datetime.timedelta(days=1)])
+        until = today + datetime.timedelta(days=days_ahead)
+
+        days = []
+        while last < until:
+            last += datetime.timedelta(days=1)
+            days.append(last)
+
+        if not days:
+            return
+
+        log.info("Adding shares partitions up to %s", days[-1].isoformat())
+        self.execute(
+            "ALTER TABLE `shares` REORGANIZE PARTITION pmax INTO (%s)" % \
+                ", ".join([ self._partition_clause(day) for day in days ] +
+                    [ "PARTITION pmax VALUES LESS THAN MAXVALUE" ])
+        )
+
+    def archive_share_partition(self, name, day):
+        '''Compacts one finished day into shares_archive (and keeps found
+        blocks as they are), then drops the partition. Dropping a partition
+        is a cheap metadata operation compared to a bulk DELETE.
+
+        The copy is recorded in shares_archive_partitions in the same
+        transaction, so when the DROP fails or never happens the next run
+        only retries the DROP and doesn't count the day twice.'''
+        self.execute(
+            """
+            SELECT COUNT(*)
+            FROM `shares_archive_partitions`
+            WHERE `partition_name` = %(name)s
+            """,
+            {
+                "name": name
+            }
+        )
+        if self.dbc.fetchone()[0]:
+            log.warning("Shares partition %s was archived before, dropping it", name)
+        else:
+            self.copy_share_partition(name, day)
+
+        self.execute("ALTER TABLE `shares` DROP PARTITION %s" % name)
+
+        self.execute(
+            """
+            DELETE FROM `shares_archive_partitions`
+            WHERE `partition_name` = %(name)s
+            """,
+            {
+                "name": name
+            }
+        )
+        self.dbh.commit()
+
+    def copy_share_partition(self, name, day):
+        log.info("Archiving shares partition %s", name)
+
+        self.execute(
+            """
+            INSERT INTO `shares_archive`
+            (day, username, our_result, upstream_result, shares, difficulty)
+            SELECT %%(day)s, `username`, `our_result`, `upstream_result`,
+              COUNT(*), COALESCE(SUM(`difficulty`), 0)
+            FROM `shares` PARTITION (%s)
+            GROUP BY `username`, `our_result`, `upstream_result`
+            ON DUPLICATE KEY UPDATE
+              `shares` = `shares` + VALUES(`shares`),
+              `difficulty` = `difficulty` + VALUES(`difficulty`)
+            """ % name,
+            {
+                "day": day.isoformat()
+            }
+        )
+
+        self.execute(
+            """
+            INSERT IGNORE INTO `shares_archive_blocks`
+            (id, time, rem_host, username, our_result, upstream_result, reason, solution, difficulty)
+            SELECT `id`, `time`, `rem_host`, `username`, `our_result`,
+              `upstream_result`, `reason`, `solution`, `difficulty`
+            FROM `shares` PARTITION (%s)
+            WHERE `upstream_result` = 'Y'
+            """ % name
+        )
+
+        self.execute(
+            """
+            INSERT INTO `shares_archive_partitions`
+            (partition_name, archived)
+            VALUES (%(name)s, NOW())
+            """,
+            {
+                "name": name
+            }
+        )
+
+        self.dbh.commit()
+
+    def maintain_share_partitions(self, days_ahead, retention_days, today=None):
+        partitions = self.list_share_partitions()
+        if not partitions:
+            log.warning("Shares table is not partitioned, skipping maintenance")
+            return
+
+        today = today or datetime.date.today()
+        self.add_share_partitions(partitions, days_ahead, today)
+
+        oldest = today - datetime.timedelta(days=retention_days)
+        for (name, day) in partitions:
+            if day is not None and day < oldest:
+                self.archive_share_partition(name, day)
+
+# Share insert latency benchmark, simulates `days` days of shares
+# (dated into the future) with the daily partition maintenance in between.
+# Writes to the configured database, point DB_MYSQL_DBNAME to a scratch copy!
+# Run with: python -m mining.DB_Mysql
+def _bench(days=30, shares_per_day=50000, batch=75):
+    dbi = DB_Mysql()
+    dbi.check_tables()
+    start = time.time()
+
+    for d in range(days):
+        ts = start + d * 86400
+        if settings.DB_SHARES_PARTITION:
+            dbi.maintain_share_partitions(settings.DB_SHARES_PARTITION_AHEAD, settings.DB_SHARES_RETENTION_DAYS,
+                datetime.date.fromtimestamp(ts))
+
+        latency = []
+        for i in range(0, shares_per_day, batch):
+            data = [ ['bench.%d' % (n % 100), '%064x' % (d * shares_per_day + i + n), 256.0,
+                      ts + (i + n) * 86400.0 / shares_per_day, True, '127.0.0.1', '', 256.0] for n in range(batch) ]
+            s = time.time()
+            dbi.import_shares(data)
+            latency.append(time.time() - s)
+
+        latency.sort()
+        print "day %2d: batch of %d median %.02f ms, p99 %.02f ms" % (d, batch,
+            latency[len(latency) / 2] * 1000, latency[int(len(latency) * 0.99)] * 1000)
+
+if __name__ == '__main__':
+    _bench()
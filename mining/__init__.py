@@ -1,12 +1,10 @@
-from service import MiningService
+from service import MiningService, MiningExtranonceService
 from subscription import MiningSubscription
 from twisted.internet import defer
 from twisted.internet.error import ConnectionRefusedError
 import time
 import simplejson as json
 from twisted.internet import reactor
-import threading
-from mining.work_log_pruner import WorkLogPruner
 
 @defer.inlineCallbacks
 def setup(on_startup):
@@ -29,11 +27,22 @@ def setup(on_startup):
     from lib.bitcoin_rpc import BitcoinRPC
     from lib.block_template import BlockTemplate
     from lib.coinbaser import SimpleCoinbaser
+    from lib.validator_pool import ValidatorPool
+    import worker_process
 
-    bitcoin_rpc = BitcoinRPC(settings.DAEMON_TRUSTED_HOST,
-                             settings.DAEMON_TRUSTED_PORT,
-                             settings.DAEMON_TRUSTED_USER,
-                             settings.DAEMON_TRUSTED_PASSWORD)
+    # Forked now, before the reactor runs
+    validators = None
+    if settings.VALIDATOR_PROCESSES:
+        validators = ValidatorPool(settings.VALIDATOR_PROCESSES, settings.TEMPLATE_MAX_JOBS + 4, settings.DAEMON_ALGO)
+
+    if worker_process.supervisor is not None:
+        # Multi-process mode, the supervisor talks to the daemon
+        bitcoin_rpc = worker_process.WorkerRPC(worker_process.supervisor)
+    else:
+        bitcoin_rpc = BitcoinRPC(settings.DAEMON_TRUSTED_HOST,
+                                 settings.DAEMON_TRUSTED_PORT,
+                                 settings.DAEMON_TRUSTED_USER,
+                                 settings.DAEMON_TRUSTED_PASSWORD)
 
     log.info("Connecting to RPC...")
 
@@ -57,7 +66,8 @@ def setup(on_startup):
                                 bitcoin_rpc,
                                 getattr(settings, 'INSTANCE_ID'),
                                 MiningSubscription.on_template,
-                                Interfaces.share_manager.on_network_block)
+                                Interfaces.share_manager.on_network_block,
+                                validators=validators)
     
     # Template registry is the main interface between Stratum service
     # and pool core logic
@@ -66,12 +76,10 @@ def setup(on_startup):
     # Set up polling mechanism for detecting new block on the network
     # This is just failsafe solution when -blocknotify
     # mechanism is not working properly    
-    BlockUpdater(registry, bitcoin_rpc)
+    # (in multi-process mode the supervisor polls for all workers)
+    if worker_process.supervisor is None:
+        BlockUpdater(registry, bitcoin_rpc)
 
-    prune_thr = threading.Thread(target=WorkLogPruner, args=(Interfaces.worker_manager.job_log,))
-    prune_thr.daemon = True
-    prune_thr.start()
-    
     log.info("MINING SERVICE IS READY")
     on_startup.callback(True)
 
@@ -0,0 +1,162 @@
+'''Admission control of expensive handshake steps, see AdmissionController.'''
+
+from collections import deque, OrderedDict
+
+class AdmissionController(object):
+    '''Lets at most max_inflight handshakes run at once and queues the
+    rest. Queued handshakes are started round-robin over their keys (the
+    client IP), so a farm reconnecting hundreds of connections from one
+    address doesn't push everybody else to the back of the queue.
+
+    While the reactor lag (see set_lag) is above max_lag nothing new is
+    started; the ones running finish and the queue waits until the
+    reactor has caught up.
+
+    request() calls start() right away or once there's room; every
+    started handshake must call done() when it's over.'''
+
+    def __init__(self, max_inflight, max_lag):
+        self.max_inflight = max_inflight
+        self.max_lag = max_lag
+        self.lag = 0.0
+        self.inflight = 0
+        self.waiting = OrderedDict()    # key -> deque of start callables, in turn order
+        self.queued = 0
+        self.draining = False
+        self.stats = {
+            'admitted': 0,
+            'queued': 0,
+            'max_queue': 0,
+            'max_lag': 0.0,
+        }
+
+    def is_open(self):
+        return self.inflight < self.max_inflight and self.lag <= self.max_lag
+
+    def request(self, key, start):
+        if not self.waiting and self.is_open():
+            self.inflight += 1
+            self.stats['admitted'] += 1
+            start()
+            return True
+
+        if key in self.waiting:
+            self.waiting[key].append(start)
+        else:
+            self.waiting[key] = deque([start])
+        self.queued += 1
+        self.stats['queued'] += 1
+        self.stats['max_queue'] = max(self.stats['max_queue'], self.queued)
+        return False
+
+    def done(self):
+        self.inflight -= 1
+        self._drain()
+
+    def set_lag(self, lag):
+        self.lag = lag
+        self.stats['max_lag'] = max(self.stats['max_lag'], lag)
+        self._drain()
+
+    def _drain(self):
+        # start() may finish right away and call done() again
+        if self.draining:
+            return
+        self.draining = True
+        try:
+            while self.waiting and self.is_open():
+                (key, queue) = self.waiting.popitem(last=False)
+                start = queue.popleft()
+                if queue:
+                    # Back of the line for the key's next one
+                    self.waiting[key] = queue
+                self.queued -= 1
+                self.inflight += 1
+                self.stats['admitted'] += 1
+                start()
+        finally:
+            self.draining = False
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['inflight'] = self.inflight
+        stats['waiting'] = self.queued
+        stats['lag'] = self.lag
+        return stats
+
+# Reconnect storm of `connections` miners against a stub pool in simulated
+# time: one reactor thread paying `sub_cpu` seconds per subscribe and
+# `auth_cpu` per authorize (DB result, set_difficulty, notify), and a stub DB
+# answering in `db_latency` seconds with `db_threads` threads. Compares no
+# admission control with the controller.
+def _bench(connections=20000, farms=200, storm=1.0, sub_cpu=0.0001, auth_cpu=0.0005, db_latency=0.002,
+        db_threads=20, max_inflight=200, max_lag=0.5, lag_check=0.1):
+    import heapq
+    import random
+
+    for controlled in (False, True):
+        random.seed(1)
+        events = []     # (time, seq, callable)
+        seq = [0]
+        state = {'busy_until': 0.0, 'db_free': [0.0] * db_threads, 'max_lag': 0.0, 'authorized': 0,
+            'done_at': 0.0, 'waits': []}
+        controller = AdmissionController(max_inflight, max_lag)
+
+        def at(when, fn):
+            seq[0] += 1
+            heapq.heappush(events, (when, seq[0], fn))
+
+        def run_on_reactor(now, cost, fn):
+            # The reactor runs one callback at a time, lag is how late it starts
+            start = max(now, state['busy_until'])
+            state['max_lag'] = max(state['max_lag'], start - now)
+            state['busy_until'] = start + cost
+            fn(start + cost)
+
+        def authorize(arrival):
+            def start(now=None):
+                now = now or arrival
+                # DB lookup in the thread pool, then the result on the reactor
+                db_free = state['db_free']
+                i = db_free.index(min(db_free))
+                begin = max(now, db_free[i])
+                db_free[i] = begin + db_latency
+                at(begin + db_latency, lambda t: run_on_reactor(t, auth_cpu, finish))
+
+            def finish(t):
+                state['authorized'] += 1
+                state['done_at'] = t
+                state['waits'].append(t - arrival)
+                if controlled:
+                    controller.done()
+
+            if controlled:
+                controller.request(random.randrange(farms), lambda: start(clock[0]))
+            else:
+                start()
+
+        clock = [0.0]
+        # Subscribe costs reactor time too
+        for i in xrange(connections):
+            arrival = random.uniform(0, storm)
+            at(arrival, lambda t: run_on_reactor(t, sub_cpu, authorize))
+
+        def check_lag(t):
+            controller.set_lag(max(0.0, state['busy_until'] - t))
+            if state['authorized'] < connections:
+                at(t + lag_check, check_lag)
+        if controlled:
+            at(lag_check, check_lag)
+
+        while events:
+            (when, n, fn) = heapq.heappop(events)
+            clock[0] = when
+            fn(when)
+
+        waits = sorted(state['waits'])
+        print "%-12s: %d authorized in %.02f sec, max reactor lag %.02f sec, wait median %.02f 99%% %.02f sec" % (
+            'controlled' if controlled else 'uncontrolled', state['authorized'], state['done_at'], state['max_lag'],
+            waits[len(waits) / 2], waits[len(waits) * 99 / 100])
+
+if __name__ == '__main__':
+    _bench()
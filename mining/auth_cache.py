@@ -0,0 +1,157 @@
+import time
+import random
+from collections import OrderedDict
+from twisted.internet import defer, threads, reactor
+
+import lib.logger
+log = lib.logger.get_logger('auth_cache')
+
+class AuthCache(object):
+    '''Caches results of worker credential checks.
+
+    Every entry has its own lifetime (ttl plus random jitter, so entries
+    created together don't expire together), failed logins are cached
+    for negative_ttl. An expired entry is still served for stale_time
+    seconds while it is refreshed in the background. Lookups run in the
+    reactor's thread pool and concurrent lookups of the same credentials
+    share one query.
+
+    At most `size` entries are kept, the least recently used one is
+    dropped to make room, so clients trying random worker names or
+    passwords can't grow the cache without bound. Without check_password
+    entries are kept per worker name, whatever password was sent.
+
+    check() returns the cached bool when there is one, otherwise
+    a Deferred firing with the result of the lookup.'''
+
+    def __init__(self, lookup, ttl, negative_ttl, stale_time, jitter, size, check_password=True):
+        self.lookup = lookup
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_time = stale_time
+        self.jitter = jitter
+        self.size = size
+        self.check_password = check_password
+
+        self.entries = OrderedDict()   # (worker_name, password) -> (result, expires), least recently used first
+        self.passwords = {}            # worker_name -> set of its passwords in entries
+        self.inflight = {}     # (worker_name, password) -> [Deferred, ...]
+        self.stats = {
+            'evicted': 0,
+            'hits': 0,
+            'negative_hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'refreshes': 0,
+            'errors': 0,
+        }
+
+        self.prune_clock = reactor.callLater(self.ttl, self.prune)
+
+    def check(self, worker_name, password):
+        now = time.time()
+        key = (worker_name, password if self.check_password else None)
+        entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            # Back to the most recently used end
+            self.entries[key] = entry
+            (result, expires) = entry
+            if now < expires:
+                self.stats['hits' if result else 'negative_hits'] += 1
+                return result
+
+            if now < expires + self.stale_time:
+                self.stats['stale_hits'] += 1
+                if key not in self.inflight:
+                    self.stats['refreshes'] += 1
+                    self._fetch(key, password).addErrback(lambda failure: None)
+                return result
+
+        self.stats['misses'] += 1
+        return self._fetch(key, password)
+
+    def _fetch(self, key, password):
+        (worker_name, _) = key
+        d = defer.Deferred()
+
+        waiters = self.inflight.get(key)
+        if waiters is not None:
+            self.stats['coalesced'] += 1
+            waiters.append(d)
+            return d
+
+        waiters = self.inflight[key] = [d]
+        lookup = threads.deferToThread(self.lookup, worker_name, password)
+        lookup.addCallbacks(self._fetched, self._fetch_failed, callbackArgs=(key, waiters), errbackArgs=(key, waiters))
+        return d
+
+    def _fetched(self, result, key, waiters):
+        result = bool(result)
+        if self.inflight.get(key) is waiters:
+            del self.inflight[key]
+            ttl = self.ttl if result else self.negative_ttl
+            expires = time.time() + ttl + random.uniform(0, self.jitter)
+            self._store(key, (result, expires))
+        # else the worker was invalidated while this lookup ran, its result
+        # may predate the change and isn't cached
+
+        for d in waiters:
+            d.callback(result)
+
+    def _fetch_failed(self, failure, key, waiters):
+        self.stats['errors'] += 1
+        log.error("Worker lookup for %s failed: %s" % (key[0], failure.getErrorMessage()))
+
+        if self.inflight.get(key) is waiters:
+            del self.inflight[key]
+        for d in waiters:
+            d.errback(failure)
+
+    def _store(self, key, entry):
+        if key not in self.entries:
+            while len(self.entries) >= self.size:
+                self._remove(next(iter(self.entries)))
+                self.stats['evicted'] += 1
+        else:
+            del self.entries[key]
+        self.entries[key] = entry
+        self.passwords.setdefault(key[0], set()).add(key[1])
+
+    def _remove(self, key):
+        del self.entries[key]
+        passwords = self.passwords[key[0]]
+        passwords.discard(key[1])
+        if not passwords:
+            del self.passwords[key[0]]
+
+    def invalidate(self, worker_name):
+        for password in self.passwords.pop(worker_name, ()):
+            del self.entries[(worker_name, password)]
+        # Lookups already running may have read the old credentials, the
+        # next check starts a new one
+        for key in [ key for key in self.inflight if key[0] == worker_name ]:
+            del self.inflight[key]
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.passwords = {}
+        self.inflight = {}
+
+    def prune(self):
+        '''Drops entries which are past their stale time'''
+        now = time.time()
+        expired = [ key for (key, (result, expires)) in self.entries.iteritems() if now >= expires + self.stale_time ]
+        for key in expired:
+            self._remove(key)
+
+        log.debug("Pruned %d auth cache entries, %d workers cached" % (len(expired), len(self.passwords)))
+        self.prune_clock = reactor.callLater(self.ttl, self.prune)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['workers'] = len(self.passwords)
+        stats['entries'] = len(self.entries)
+        stats['inflight'] = len(self.inflight)
+        return stats
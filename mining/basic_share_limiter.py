@@ -3,94 +3,90 @@ import lib.settings as settings
 import lib.logger
 log = lib.logger.get_logger('BasicShareLimiter')
 
-import DBInterface
-dbi = DBInterface.DBInterface()
-#dbi.clear_worker_diff()
-
-from twisted.internet import defer
-from mining.interfaces import Interfaces
+from twisted.internet import reactor
+from mining.interfaces import Interfaces, dbi
+from vardiff_table import VardiffTable
+from vardiff_estimator import VardiffEstimator
 import time
 
-''' This is just a customized ring buffer '''
-class SpeedBuffer:
-    def __init__(self, size_max):
-        self.max = size_max
-        self.data = []
-        self.cur = 0
-        
-    def append(self, x):
-        self.data.append(x)
-        self.cur += 1
-        if len(self.data) == self.max:
-            self.cur = 0
-            self.__class__ = SpeedBufferFull
-            
-    def avg(self):
-        return sum(self.data) / self.cur
-       
-    def pos(self):
-        return self.cur
-           
-    def clear(self):
-        self.data = []
-        self.cur = 0
-            
-    def size(self):
-        return self.cur
-
-class SpeedBufferFull:
-    def __init__(self, n):
-        raise "you should use SpeedBuffer"
-           
-    def append(self, x):                
-        self.data[self.cur] = x
-        self.cur = (self.cur + 1) % self.max
-            
-    def avg(self):
-        return sum(self.data) / self.max
-           
-    def pos(self):
-        return self.cur
-           
-    def clear(self):
-        self.data = []
-        self.cur = 0
-        self.__class__ = SpeedBuffer
-            
-    def size(self):
-        return self.max
-
 class BasicShareLimiter(object):
+    '''Vardiff with the state of all connections in a VardiffTable.
+    A share only bumps the counter of its connection's slot; every
+    VDIFF_SWEEP_TIME seconds one pass retargets all connections whose
+    retarget period is over and sends the difficulty changes and the
+    database updates in one go.'''
+
     def __init__(self):
-        self.worker_stats = {}
         self.target = settings.VDIFF_TARGET_TIME
         self.retarget = settings.VDIFF_RETARGET_TIME
         self.variance = self.target * (float(settings.VDIFF_VARIANCE_PERCENT) / float(100))
         self.tmin = self.target - self.variance
         self.tmax = self.target + self.variance
-        self.buffersize = self.retarget / self.target * 4
-        # TODO: trim the hash of inactive workers
+        self.table = VardiffTable(settings.VDIFF_IDLE_TIME, now=time.time())
+        if settings.VDIFF_ESTIMATOR == 'ewma':
+            self.estimator = VardiffEstimator(self.target, settings.VDIFF_EWMA_HALF_LIFE, settings.VDIFF_CONFIDENCE,
+                settings.VDIFF_MIN_TARGET, settings.VDIFF_MAX_TARGET, settings.VDIFF_X2_TYPE, settings.VDIFF_FLOAT)
+        else:
+            self.estimator = None
+        self.sweepclock = reactor.callLater(settings.VDIFF_SWEEP_TIME, self.sweep)
 
     def submit(self, connection_ref, job_id, current_difficulty, timestamp, worker_name, extranonce1_bin):
         ts = int(timestamp)
+        # The connection's slot in the vardiff table is kept in its MinerSession
+        miner = connection_ref().get_session()['miner']
+        slot = miner.vardiff_slot
 
         # Init the stats for this worker if it isn't set.        
-        if extranonce1_bin not in self.worker_stats or self.worker_stats[extranonce1_bin]['last_ts'] < ts - settings.DB_USERCACHE_TIME :
-            self.worker_stats[extranonce1_bin] = {'last_rtc': (ts - self.retarget / 2), 'last_ts': ts, 'buffer': SpeedBuffer(self.buffersize) }
-            dbi.update_worker_diff(worker_name, settings.POOL_TARGET)
-            return
-        
-        # Standard share update of data
-        self.worker_stats[extranonce1_bin]['buffer'].append(ts - self.worker_stats[extranonce1_bin]['last_ts'])
-        self.worker_stats[extranonce1_bin]['last_ts'] = ts
-
-        # Do We retarget? If not, we're done.
-        if ts - self.worker_stats[extranonce1_bin]['last_rtc'] < self.retarget and self.worker_stats[extranonce1_bin]['buffer'].size() > 0:
+        if slot is None:
+            miner.vardiff_slot = self.table.allocate(connection_ref, worker_name, current_difficulty,
+                ts - self.retarget / 2, ts)
             return
 
-        # Set up and log our check
-        self.worker_stats[extranonce1_bin]['last_rtc'] = ts
-        avg = self.worker_stats[extranonce1_bin]['buffer'].avg()
+        self.table.add_share(slot, ts)
+
+    def sweep(self):
+        now = int(Interfaces.timestamper.time())
+        try:
+            updates = []
+            for (slot, shares, elapsed) in self.table.collect(now, self.retarget):
+                if self.estimator is not None:
+                    new_diff = self.estimator.update(self.table, slot, shares, elapsed)
+                else:
+                    # No share in the whole period counts as one, so the difficulty still drops
+                    avg = float(elapsed) / (shares if shares else 1)
+                    new_diff = self.new_difficulty(self.table.worker_names[slot], self.table.difficulty[slot], avg)
+                if new_diff is not None:
+                    self.table.difficulty[slot] = new_diff
+                    self.send_difficulty(self.table.connections[slot], new_diff)
+                    updates.append((self.table.worker_names[slot], new_diff))
+
+            if updates:
+                log.debug("Retargeted %d of %d connections" % (len(updates), len(self.table)))
+                dbi.update_worker_diffs(updates)
+
+            # Connections which stopped submitting start over with a fresh slot
+            for (slot, connection_ref) in self.table.expire(now):
+                connection = connection_ref()
+                miner = connection.get_session().get('miner') if connection is not None else None
+                if miner is not None and miner.vardiff_slot == slot:
+                    miner.vardiff_slot = None
+        except Exception:
+            log.exception("Vardiff sweep failed")
+
+        self.sweepclock = reactor.callLater(settings.VDIFF_SWEEP_TIME, self.sweep)
+
+    def get_stats(self):
+        return self.table.get_stats()
+
+    def set_difficulty(self, miner, difficulty):
+        if miner.vardiff_slot is not None:
+            self.table.difficulty[miner.vardiff_slot] = difficulty
+            self.table.ew_shares[miner.vardiff_slot] = 0.0
+            self.table.ew_time[miner.vardiff_slot] = 0.0
+
+    def new_difficulty(self, worker_name, current_difficulty, avg):
+        '''Returns the new difficulty for an average share time of avg
+        seconds, or None when the difficulty stays'''
         log.debug("Checking Retarget for %s (%i) avg. %i target %i+-%i" % (worker_name, current_difficulty, avg,
                 self.target, self.variance))
         
@@ -122,33 +118,35 @@ class BasicShareLimiter(object):
             if settings.VDIFF_X2_TYPE:
                 ddiff = 2
                 if (ddiff * current_difficulty) > settings.VDIFF_MAX_TARGET:
-                    ddiff = diff_max / current_difficulty
+                    ddiff = settings.VDIFF_MAX_TARGET / current_difficulty
             else:
                 if ddiff < 1:
                    ddiff = 1
                 if (ddiff + current_difficulty) > settings.VDIFF_MAX_TARGET:
-                    ddiff = diff_max - current_difficulty
+                    ddiff = settings.VDIFF_MAX_TARGET - current_difficulty
             
         else:  # If we are here, then we should not be retargeting.
-            return
+            return None
 
         # At this point we are retargeting this worker
         if settings.VDIFF_X2_TYPE:
             new_diff = current_difficulty * ddiff
         else:
             new_diff = current_difficulty + ddiff
+        if new_diff == current_difficulty:
+            return None
         log.debug("Retarget for %s %i old: %i new: %i" % (worker_name, ddiff, current_difficulty, new_diff))
 
-        self.worker_stats[extranonce1_bin]['buffer'].clear()
-        session = connection_ref().get_session()
-        extranonce1_bin = session.get('extranonce1', None)
+        return new_diff
+
+    def send_difficulty(self, connection_ref, new_diff):
+        connection = connection_ref()
+        miner = connection.get_session()['miner']
 
         (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, _) = \
             Interfaces.template_registry.get_last_broadcast_args()
-        work_id = Interfaces.worker_manager.register_work(extranonce1_bin, job_id, new_diff)
+        work_id = Interfaces.worker_manager.register_work(miner, job_id, new_diff)
         
-        session['difficulty'] = new_diff
-        connection_ref().rpc('mining.set_difficulty', [new_diff,], is_notification=True)
-        connection_ref().rpc('mining.notify', [work_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, False,], is_notification=True)
-        dbi.update_worker_diff(worker_name, new_diff)
-
+        miner.difficulty = new_diff
+        connection.rpc('mining.set_difficulty', [new_diff,], is_notification=True)
+        connection.rpc('mining.notify', [work_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, False,], is_notification=True)
@@ -0,0 +1,110 @@
+'''Closes subscribed connections which don't mine, see ConnectionReaper.'''
+
+import time
+import weakref
+from twisted.internet import reactor
+
+import lib.settings as settings
+from lib.timing_wheel import TimingWheel
+from interfaces import Interfaces
+
+import lib.logger
+log = lib.logger.get_logger('connection_reaper')
+
+REAP_TICK = 5
+
+class ConnectionReaper(object):
+    '''Every subscribed connection is in one timing wheel, due when the
+    first of its timeouts could run out:
+
+      pre_auth       subscribed REAP_PRE_AUTH_TIME ago and never authorized
+      idle           authorized, but no share for REAP_IDLE_TIME
+      write_stalled  more than REAP_WRITE_BUFFER bytes waiting to be sent
+                     for REAP_WRITE_STALL_TIME (the miner stopped reading)
+
+    When it comes due the connection is checked and either closed or put
+    back for its next deadline, so there is no timer per connection and
+    activity costs nothing but a timestamp in the MinerSession. A time
+    of 0 disables the timeout.'''
+
+    def __init__(self):
+        self.wheel = TimingWheel(REAP_TICK, 720, time.time())
+        self.reaped = {
+            'pre_auth': 0,
+            'idle': 0,
+            'write_stalled': 0,
+        }
+        self.clock = reactor.callLater(REAP_TICK, self.run)
+
+    def watch(self, connection, miner, now):
+        miner.subscribed_ts = now
+        self._schedule(weakref.ref(connection), miner, now)
+
+    def _schedule(self, ref, miner, now):
+        due = []
+        if miner.authorized:
+            if settings.REAP_IDLE_TIME:
+                due.append(miner.active_ts + settings.REAP_IDLE_TIME)
+        elif settings.REAP_PRE_AUTH_TIME:
+            due.append(miner.subscribed_ts + settings.REAP_PRE_AUTH_TIME)
+        if settings.REAP_WRITE_STALL_TIME:
+            # The write buffer is only seen when somebody looks at it
+            if miner.stall_ts:
+                due.append(miner.stall_ts + settings.REAP_WRITE_STALL_TIME)
+            else:
+                due.append(now + REAP_TICK * 6)
+        if due:
+            self.wheel.schedule(ref, min(due))
+
+    def run(self):
+        now = Interfaces.timestamper.time()
+        for ref in self.wheel.advance(now):
+            # Closed connections just drop out of the wheel
+            connection = ref()
+            if connection is None:
+                continue
+            miner = connection.get_session().get('miner')
+            if miner is None:
+                continue
+            reason = self.check(connection, miner, now)
+            if reason is None:
+                self._schedule(ref, miner, now)
+                continue
+
+            self.reaped[reason] += 1
+            log.info("Closing connection %s: %s" % (connection._get_ip(), reason))
+            if reason == 'write_stalled' and hasattr(connection.transport, 'abortConnection'):
+                # loseConnection would wait for the buffer to drain
+                connection.transport.abortConnection()
+            else:
+                connection.transport.loseConnection()
+
+        self.clock = reactor.callLater(REAP_TICK, self.run)
+
+    def check(self, connection, miner, now):
+        '''Returns the reason to close the connection, None if it stays'''
+        if miner.authorized:
+            if settings.REAP_IDLE_TIME and now - miner.active_ts >= settings.REAP_IDLE_TIME:
+                return 'idle'
+        elif settings.REAP_PRE_AUTH_TIME and now - miner.subscribed_ts >= settings.REAP_PRE_AUTH_TIME:
+            return 'pre_auth'
+
+        if settings.REAP_WRITE_STALL_TIME:
+            if self.pending_bytes(connection.transport) <= settings.REAP_WRITE_BUFFER:
+                miner.stall_ts = 0
+            elif not miner.stall_ts:
+                miner.stall_ts = now
+            elif now - miner.stall_ts >= settings.REAP_WRITE_STALL_TIME:
+                return 'write_stalled'
+        return None
+
+    @staticmethod
+    def pending_bytes(transport):
+        '''Bytes written to the transport but not sent yet (twisted's FileDescriptor buffers)'''
+        return len(getattr(transport, 'dataBuffer', '')) - getattr(transport, 'offset', 0) + \
+            getattr(transport, '_tempDataLen', 0)
+
+    def get_stats(self):
+        stats = dict(self.reaped)
+        stats['watched'] = len(self.wheel)
+        return stats
@@ -0,0 +1,103 @@
+'''In-memory copy of the pool_worker credentials, so authorizing
+a worker is a dict lookup instead of a database query.'''
+
+class CredentialTable(object):
+    '''Worker name -> password index built from (id, username, password)
+    rows. load() replaces the whole table, update() applies changed rows.
+    Both return the names of the workers whose credentials changed or
+    disappeared, so sessions using them can be revalidated.'''
+
+    def __init__(self):
+        self.passwords = {}     # username -> password
+        self.ids = {}           # id -> username
+        self.max_id = 0
+        self.loaded = False
+
+    def __len__(self):
+        return len(self.passwords)
+
+    def load(self, rows):
+        passwords = {}
+        ids = {}
+        max_id = 0
+        for row in rows:
+            (uid, username, password) = row[:3]
+            passwords[username] = password
+            ids[uid] = username
+            if uid > max_id:
+                max_id = uid
+
+        changed = []
+        if self.loaded:
+            for username, password in self.passwords.iteritems():
+                if passwords.get(username) != password:
+                    changed.append(username)
+
+        self.passwords = passwords
+        self.ids = ids
+        self.max_id = max_id
+        self.loaded = True
+        return changed
+
+    def update(self, rows):
+        changed = []
+        for row in rows:
+            (uid, username, password) = row[:3]
+            old_name = self.ids.get(uid)
+            if old_name is not None and old_name != username:
+                # Renamed worker
+                self.passwords.pop(old_name, None)
+                changed.append(old_name)
+
+            old = self.passwords.get(username)
+            if old is not None and old != password:
+                changed.append(username)
+
+            self.passwords[username] = password
+            self.ids[uid] = username
+            if uid > self.max_id:
+                self.max_id = uid
+        return changed
+
+    def set(self, username, password):
+        self.passwords[username] = password
+
+    def remove(self, id_or_username):
+        if id_or_username.isdigit():
+            username = self.ids.pop(int(id_or_username), None)
+        else:
+            username = id_or_username
+        if username is not None:
+            self.passwords.pop(username, None)
+        return username
+
+    def check(self, username, password, check_password=True):
+        '''True/False, or None for an unknown worker'''
+        stored = self.passwords.get(username)
+        if stored is None:
+            return None
+        if not check_password:
+            return True
+        return stored == password
+
+# CredentialTable startup benchmark
+def _bench(workers=500000):
+    import time
+    import resource
+
+    rows = [ (i, 'account%d.worker%d' % (i / 10, i % 10), 'x%dx' % i) for i in xrange(1, workers + 1) ]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    s = time.time()
+    t = CredentialTable()
+    t.load(iter(rows))
+    print "load: %d workers in %.03f sec" % (len(t), time.time() - s)
+    print "memory: ~%.01f MB" % ((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024.0)
+
+    s = time.time()
+    for i in xrange(1, workers + 1):
+        t.check(rows[i - 1][1], rows[i - 1][2])
+    print "check: %.02f us/lookup" % ((time.time() - s) * 1e6 / workers)
+
+if __name__ == '__main__':
+    _bench()
@@ -4,6 +4,8 @@
    (see launcher_demo.tac for an example).
 ''' 
 import time
+import weakref
+import binascii
 from twisted.internet import reactor, defer
 from lib.util import b58encode
 
@@ -15,36 +17,117 @@ import DBInterface
 dbi = DBInterface.DBInterface()
 dbi.init_main()
 
+from pplns import PPLNSWindow
+
 class WorkerManagerInterface(object):
     def __init__(self):
-        self.worker_log = {}
-        self.worker_log.setdefault('authorized', {})
-        self.job_log = {}
-        self.job_log.setdefault('None', {})
+        self.connections = {}   # worker_name -> WeakSet of connections authorized for it
+        dbi.add_user_listener(self.on_users_changed)
         return
         
     def authorize(self, worker_name, worker_password):
-        # Important NOTE: This is called on EVERY submitted share. So you'll need caching!!!
+        # Called on mining.authorize, the result stays valid for the connection
+        # until the worker's credentials change (see on_users_changed)
+        # Returns True/False or a Deferred when the worker is not cached
         return dbi.check_password(worker_name, worker_password)
 
+    def register_connection(self, worker_name, connection):
+        self.connections.setdefault(worker_name, weakref.WeakSet()).add(connection)
+
+    def on_users_changed(self, worker_names):
+        '''Checks the sessions of changed workers again and revokes the ones
+        whose credentials are no longer valid. worker_names None means all.'''
+        if worker_names is None:
+            worker_names = self.connections.keys()
+
+        for worker_name in worker_names:
+            conns = self.connections.get(worker_name)
+            if not conns:
+                self.connections.pop(worker_name, None)
+                continue
+
+            for conn in list(conns):
+                miner = conn.get_session().get('miner')
+                authorized = miner.authorized if miner is not None else {}
+                if worker_name not in authorized:
+                    conns.discard(conn)
+                    continue
+
+                result = self.authorize(worker_name, authorized[worker_name])
+                if isinstance(result, defer.Deferred):
+                    result.addCallback(self._revalidated, worker_name, weakref.ref(conn))
+                    result.addErrback(self._revalidate_failed, worker_name, weakref.ref(conn))
+                else:
+                    self._revalidated(result, worker_name, weakref.ref(conn))
+
+    def _revalidated(self, is_authorized, worker_name, conn_ref):
+        conn = conn_ref()
+        if is_authorized or conn is None:
+            return
+
+        log.info("Revoking authorization of %s, credentials changed" % worker_name)
+        miner = conn.get_session().get('miner')
+        if miner is not None:
+            miner.authorized.pop(worker_name, None)
+        conns = self.connections.get(worker_name)
+        if conns is not None:
+            conns.discard(conn)
+
+    def _revalidate_failed(self, failure, worker_name, conn_ref):
+        # Can't tell if the credentials are still good, so play it safe
+        log.error("Revalidating %s failed: %s" % (worker_name, failure.getErrorMessage()))
+        self._revalidated(False, worker_name, conn_ref)
+
+    def get_auth_stats(self):
+        return dbi.get_auth_stats()
+
     def update_worker_diff(self, worker_name, diff):
-        return dbi.update_worker_diff(worker_name, diff)
+        return dbi.update_worker_diffs([ (worker_name, diff) ])
 
-    def register_work(self, extranonce1, job_id, difficulty):
-        now = Interfaces.timestamper.time()
-        work_id = WorkIdGenerator.get_new_id()
-        self.job_log.setdefault(extranonce1, {})[work_id] = (job_id, difficulty, now)
-        return work_id
+    def get_start_difficulty(self, worker_name):
+        '''Difficulty a new connection of the worker should start with,
+        None for the pool default'''
+        if not settings.VARIABLE_DIFF:
+            return None
+        diff = dbi.get_worker_diff(worker_name)
+        if diff is None:
+            return None
+        return min(max(diff, settings.VDIFF_MIN_TARGET), settings.VDIFF_MAX_TARGET)
 
-class WorkIdGenerator(object):
-    counter = 1000
-    
-    @classmethod
-    def get_new_id(cls):
-        cls.counter += 1
-        if cls.counter % 0xffff == 0:
-            cls.counter = 1
-        return "%x" % cls.counter
+    def send_difficulty(self, connection, difficulty):
+        '''Switches the connection to the difficulty and sends it
+        a job with it, so the miner doesn't wait for the next broadcast'''
+        miner = connection.get_session()['miner']
+        miner.difficulty = difficulty
+        Interfaces.share_limiter.set_difficulty(miner, difficulty)
+        connection.rpc('mining.set_difficulty', [difficulty,], is_notification=True)
+
+        if miner.extranonce1 is None or Interfaces.template_registry.last_block is None:
+            return
+        (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, _) = \
+            Interfaces.template_registry.get_last_broadcast_args()
+        work_id = self.register_work(miner, job_id, difficulty)
+        connection.rpc('mining.notify', [work_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, False,], is_notification=True)
+
+    def set_extranonce(self, connection, extranonce1):
+        '''Switches the connection to a new extranonce1 and sends it a
+        clean job, work sent for the old extranonce1 can't be checked anymore'''
+        miner = connection.get_session()['miner']
+        miner.extranonce1 = extranonce1
+        miner.jobs.clear()
+        connection.rpc('mining.set_extranonce', [binascii.hexlify(extranonce1), Interfaces.template_registry.extranonce2_size],
+            is_notification=True)
+
+        (job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, _) = \
+            Interfaces.template_registry.get_last_broadcast_args()
+        work_id = self.register_work(miner, job_id, miner.difficulty)
+        connection.rpc('mining.notify', [work_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, True,], is_notification=True)
+
+    def register_work(self, miner, job_id, difficulty):
+        '''Returns a new work_id of the miner (a MinerSession) standing
+        for the job and difficulty'''
+        now = Interfaces.timestamper.time()
+        return miner.jobs.add(job_id, difficulty, now)
 
 class ShareLimiterInterface(object):
     '''Implement difficulty adjustments here'''
@@ -57,10 +140,19 @@ class ShareLimiterInterface(object):
            - raise SubmitException for stop processing this request
            - call mining.set_difficulty on connection to adjust the difficulty'''
         return
+
+    def set_difficulty(self, miner, difficulty):
+        '''Called when the difficulty of a connection is changed
+        from outside the share limiter (e.g. mining.suggest_difficulty)'''
+        return
+
+    def get_stats(self):
+        return {}
  
 class ShareManagerInterface(object):
     def __init__(self):
         self.block_height = 0
+        self.pplns = PPLNSWindow(settings.PPLNS_WINDOW) if settings.PPLNS_ENABLE else None
     
     def on_network_block(self):
         '''Prints when there's new block coming from the network (possibly new round)'''
@@ -70,10 +162,15 @@ class ShareManagerInterface(object):
     def on_submit_share(self, worker_name, block_hash, difficulty, pool_share, timestamp, is_valid, ip, invalid_reason, share_diff, job_id):
         log.info("%s [%s] diff(%f/%f) job_id(%s) share(%i) %s %s" % (worker_name, ip, share_diff, difficulty, job_id, pool_share, 'valid' if is_valid else 'INVALID', invalid_reason))
         dbi.queue_share([worker_name, block_hash, pool_share, timestamp, is_valid, ip, invalid_reason, share_diff ])
+        if is_valid and self.pplns:
+            self.pplns.add(worker_name, pool_share)
  
     def on_submit_block(self, is_accepted, worker_name, block_hash, timestamp, ip, share_diff):
         log.info("Block %s %s" % (block_hash, 'ACCEPTED' if is_accepted else 'REJECTED'))
         dbi.found_block([worker_name, block_hash, -1, timestamp, is_accepted, ip, 'REJECTED', share_diff ])
+        if is_accepted and self.pplns:
+            # Freeze the window and round totals for this block
+            dbi.queue_payout(block_hash, timestamp, self.pplns.snapshot())
         
 class TimestamperInterface(object):
     '''This is the only source for current time in the application.
@@ -0,0 +1,147 @@
+'''Banned IP addresses and networks, see IPBanTable.'''
+
+import socket
+import struct
+from lib.timing_wheel import TimingWheel
+
+V4_MAPPED = 0xffff << 32    # ::ffff:0:0/96, IPv4 addresses live there
+
+def parse_ip(ip):
+    '''IPv4 or IPv6 address as a 128 bit int, IPv4 mapped into ::ffff:0:0/96'''
+    if ':' not in ip:
+        return V4_MAPPED | struct.unpack('>L', socket.inet_pton(socket.AF_INET, ip))[0]
+    (high, low) = struct.unpack('>QQ', socket.inet_pton(socket.AF_INET6, ip))
+    return (high << 64) | low
+
+def format_network(network, prefixlen):
+    if prefixlen >= 96 and network >> 32 == 0xffff:
+        return '%s/%d' % (socket.inet_ntop(socket.AF_INET, struct.pack('>L', network & 0xffffffff)), prefixlen - 96)
+    packed = struct.pack('>QQ', network >> 64, network & 0xffffffffffffffff)
+    return '%s/%d' % (socket.inet_ntop(socket.AF_INET6, packed), prefixlen)
+
+class IPBanTable(object):
+    '''Bans of single addresses or CIDR networks, IPv4 and IPv6.
+
+    Networks are kept in one dict per prefix length, so a lookup is one
+    dict probe per prefix length in use (usually a handful), whatever
+    the number of bans. Timed bans are expired through a timing wheel;
+    bans with no expiry stay until they are lifted.'''
+
+    def __init__(self, tick, size, now):
+        self.networks = {}      # prefix length -> {network: expires, 0 for never}
+        self.lengths = []       # prefix lengths in use, longest first
+        self.wheel = TimingWheel(tick, size, now)
+        self.expired = 0
+
+    def __len__(self):
+        return sum([ len(n) for n in self.networks.itervalues() ])
+
+    @staticmethod
+    def parse(cidr):
+        '''Returns (network, prefixlen) of 'address' or 'address/prefixlen',
+        raises ValueError if it isn't one'''
+        (ip, sep, prefixlen) = str(cidr).partition('/')
+        try:
+            address = parse_ip(ip)
+        except socket.error:
+            raise ValueError("Invalid address %s" % ip)
+        v4 = ':' not in ip
+        prefixlen = int(prefixlen) if sep else (32 if v4 else 128)
+        if prefixlen < 0 or prefixlen > (32 if v4 else 128):
+            raise ValueError("Invalid prefix length %d" % prefixlen)
+        if v4:
+            prefixlen += 96
+        return (address >> (128 - prefixlen) << (128 - prefixlen), prefixlen)
+
+    def ban(self, cidr, expires=0):
+        '''Bans the network until expires, 0 for good.
+        Banning it again replaces the expiry.'''
+        key = self.parse(cidr)
+        (network, prefixlen) = key
+        if prefixlen not in self.networks:
+            self.networks[prefixlen] = {}
+            self.lengths = sorted(self.networks, reverse=True)
+        self.networks[prefixlen][network] = expires
+        if expires:
+            self.wheel.schedule(key, expires)
+        else:
+            self.wheel.cancel(key)
+        return format_network(network, prefixlen)
+
+    def unban(self, cidr):
+        key = self.parse(cidr)
+        self.wheel.cancel(key)
+        return self._remove(key)
+
+    def _remove(self, key):
+        (network, prefixlen) = key
+        networks = self.networks.get(prefixlen)
+        if networks is None or networks.pop(network, None) is None:
+            return False
+        if not networks:
+            del self.networks[prefixlen]
+            self.lengths = sorted(self.networks, reverse=True)
+        return True
+
+    def is_banned(self, ip, now):
+        if not self.lengths:
+            return False
+        try:
+            address = parse_ip(ip)
+        except socket.error:
+            return False
+        for prefixlen in self.lengths:
+            expires = self.networks[prefixlen].get(address >> (128 - prefixlen) << (128 - prefixlen))
+            # The wheel may be a tick behind
+            if expires is not None and (not expires or expires > now):
+                return True
+        return False
+
+    def expire(self, now):
+        '''Lifts the bans which are over, returns how many'''
+        count = 0
+        for key in self.wheel.advance(now):
+            if self._remove(key):
+                count += 1
+        self.expired += count
+        return count
+
+    def get_bans(self):
+        '''{'network/prefixlen': expires}'''
+        bans = {}
+        for (prefixlen, networks) in self.networks.iteritems():
+            for (network, expires) in networks.iteritems():
+                bans[format_network(network, prefixlen)] = expires
+        return bans
+
+# Lookup cost with many bans, run with PYTHONPATH=. from the top directory
+def _bench(bans=100000, lookups=200000):
+    import random
+    import time
+
+    random.seed(1)
+    table = IPBanTable(10, 400, 0)
+    for i in xrange(bans):
+        prefixlen = random.choice((32, 32, 32, 24, 16))
+        table.ban('%d.%d.%d.%d/%d' % (random.randrange(256), random.randrange(256), random.randrange(256),
+            random.randrange(256), prefixlen), random.choice((0, random.randrange(1, 3600))))
+    table.ban('2001:db8::/32')
+    ips = [ '%d.%d.%d.%d' % (random.randrange(256), random.randrange(256), random.randrange(256),
+        random.randrange(256)) for i in xrange(lookups) ]
+
+    start = time.time()
+    banned = 0
+    for ip in ips:
+        if table.is_banned(ip, 0):
+            banned += 1
+    took = time.time() - start
+    print "%d bans, %d prefix lengths: %.02f usec per lookup (%d banned)" % (len(table), len(table.lengths),
+        took * 1000000 / lookups, banned)
+
+    start = time.time()
+    for now in xrange(10, 3601, 10):
+        table.expire(now)
+    print "expired %d bans in %.01f ms, %d left" % (table.expired, (time.time() - start) * 1000, len(table))
+
+if __name__ == '__main__':
+    _bench()
@@ -0,0 +1,123 @@
+'''All per-connection state of a miner in one compact object, kept in
+the stratum session as session['miner'] and released on disconnect.'''
+
+import lib.settings as settings
+from work_log import WorkLog
+
+class MinerSession(object):
+    __slots__ = (
+        'extranonce1',      # binary extranonce1 of the connection, None until subscribed
+        'extranonce_subscribed', # accepts mining.set_extranonce
+        'difficulty',       # current share difficulty
+        'suggested_difficulty', # from mining.suggest_difficulty, None if the miner didn't send one
+        'authorized',       # worker_name -> password
+        'version_mask',     # version rolling mask from mining.configure, 0 when not negotiated
+        'jobs',             # WorkLog of the work sent to the miner
+
+        # Worker stats / banning (ENABLE_WORKER_STATS)
+        'valid',
+        'invalid',
+        'banned',
+        'stats_ts',         # start of the current stats period
+
+        'vardiff_slot',     # slot in BasicShareLimiter's VardiffTable, None until the first share
+
+        # ConnectionReaper
+        'subscribed_ts',
+        'active_ts',        # last share, or the first authorize
+        'stall_ts',         # since when the write buffer is over REAP_WRITE_BUFFER, 0 if it isn't
+    )
+
+    def __init__(self, difficulty):
+        self.extranonce1 = None
+        self.extranonce_subscribed = False
+        self.difficulty = difficulty
+        self.suggested_difficulty = None
+        self.authorized = {}
+        self.version_mask = 0
+        self.jobs = WorkLog(settings.WORK_LOG_SIZE)
+        self.valid = 0
+        self.invalid = 0
+        self.banned = False
+        self.stats_ts = 0
+        self.vardiff_slot = None
+        self.subscribed_ts = 0
+        self.active_ts = 0
+        self.stall_ts = 0
+
+    @classmethod
+    def get(cls, connection, difficulty):
+        '''Returns the MinerSession of the connection, creating it
+        on the first call'''
+        session = connection.get_session()
+        miner = session.get('miner')
+        if miner is None:
+            miner = session['miner'] = cls(difficulty)
+            on_disconnect = getattr(connection, 'on_disconnect', None)
+            if on_disconnect is not None:
+                on_disconnect.addCallback(miner._disconnected)
+        return miner
+
+    def reset_stats(self, now):
+        self.valid = 0
+        self.invalid = 0
+        self.stats_ts = now
+
+    def release(self):
+        # Drop the containers right away instead of waiting for the
+        # connection object to be collected
+        self.authorized.clear()
+        self.jobs.clear()
+
+    def _disconnected(self, result):
+        self.release()
+        return result
+
+# Memory per connection benchmark: MinerSession against the same data in
+# the old layout (session keys plus the worker_log['authorized'] and
+# job_log dicts keyed by extranonce1). Each layout is measured in a
+# process of its own, ru_maxrss only grows. Vardiff state isn't included,
+# it lives in BasicShareLimiter's VardiffTable.
+def _bench_layout(layout, connections, jobs, result):
+    import gc
+    import resource
+
+    gc.collect()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    keep = []
+    if layout == 'MinerSession':
+        for i in xrange(connections):
+            m = MinerSession(16)
+            m.extranonce1 = '%08x' % i
+            m.authorized['account%d.worker' % i] = 'x'
+            for w in xrange(jobs):
+                m.jobs.add('%x' % w, 16, 1400000000)
+            keep.append(m)
+    else:
+        worker_log = {'authorized': {}}
+        job_log = {}
+        for i in xrange(connections):
+            extranonce1 = '%08x' % i
+            session = {'extranonce1': extranonce1, 'difficulty': 16, 'authorized': {}}
+            session['authorized']['account%d.worker' % i] = 'x'
+            worker_log['authorized'][extranonce1] = (0, 0, False, 1400000000)
+            for w in xrange(jobs):
+                job_log.setdefault(extranonce1, {})['%x' % w] = ('%x' % w, 16, 1400000000)
+            keep.append(session)
+        keep.append((worker_log, job_log))
+    result.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024.0)
+
+def _bench(connections=50000, jobs=8):
+    import multiprocessing
+
+    for layout in ('old layout', 'MinerSession'):
+        result = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_bench_layout, args=(layout, connections, jobs, result))
+        p.start()
+        used = result.get()
+        p.join()
+        print "%-12s %d connections with %d jobs: ~%.02f MB, ~%d bytes/connection" % (layout, connections, jobs,
+            used / 1048576, used / connections)
+
+if __name__ == '__main__':
+    _bench()
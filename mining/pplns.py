@@ -0,0 +1,112 @@
+'''Rolling PPLNS window and round accounting kept in memory,
+so payouts don't have to be calculated from the shares table.'''
+
+from array import array
+
+class PPLNSWindow(object):
+    '''Keeps the last `size` difficulty units of valid shares in a ring
+    of two flat arrays (worker index, share value) together with running
+    per-worker totals for the window and for the current round.
+    Adding a share and expiring old ones is O(1) amortized.'''
+
+    def __init__(self, size, capacity=4096):
+        self.size = float(size)
+        self.index = {}                # worker_name -> worker index
+        self.names = []                # worker index -> worker_name
+        self.window_totals = array('d')
+        self.round_totals = array('d')
+
+        self.ring_worker = array('l', [0]) * capacity
+        self.ring_value = array('d', [0.0]) * capacity
+        self.head = 0                  # position of the oldest share
+        self.count = 0
+        self.total = 0.0
+        self.round_total = 0.0
+
+    def _worker(self, worker_name):
+        idx = self.index.get(worker_name)
+        if idx is None:
+            idx = self.index[worker_name] = len(self.names)
+            self.names.append(worker_name)
+            self.window_totals.append(0.0)
+            self.round_totals.append(0.0)
+        return idx
+
+    def _grow(self):
+        # Unroll the ring into twice as big arrays
+        cap = len(self.ring_value)
+        order = range(self.head, cap) + range(0, self.head)
+        self.ring_worker = array('l', [ self.ring_worker[i] for i in order ]) + array('l', [0]) * cap
+        self.ring_value = array('d', [ self.ring_value[i] for i in order ]) + array('d', [0.0]) * cap
+        self.head = 0
+
+    def add(self, worker_name, value):
+        idx = self._worker(worker_name)
+
+        if self.count == len(self.ring_value):
+            self._grow()
+
+        pos = (self.head + self.count) % len(self.ring_value)
+        self.ring_worker[pos] = idx
+        self.ring_value[pos] = value
+        self.count += 1
+        self.total += value
+        self.window_totals[idx] += value
+        self.round_totals[idx] += value
+        self.round_total += value
+
+        # Drop the oldest shares while the rest still fills the window
+        cap = len(self.ring_value)
+        while self.count > 1 and self.total - self.ring_value[self.head] >= self.size:
+            old = self.ring_value[self.head]
+            self.window_totals[self.ring_worker[self.head]] -= old
+            self.total -= old
+            self.head = (self.head + 1) % cap
+            self.count -= 1
+
+    def snapshot(self):
+        '''Returns [(worker_name, window_value, round_value), ...] for all
+        workers with shares in the window or in the round, and starts
+        a new round. Runs in one go on the reactor, so no share can
+        slip in between the copy and the reset.'''
+        rows = []
+        window_totals = self.window_totals
+        round_totals = self.round_totals
+        for idx, worker_name in enumerate(self.names):
+            if window_totals[idx] > 0 or round_totals[idx] > 0:
+                rows.append((worker_name, max(window_totals[idx], 0.0), round_totals[idx]))
+
+        self.round_totals = array('d', [0.0]) * len(self.names)
+        self.round_total = 0.0
+        return rows
+
+    def memory_usage(self):
+        '''Approximate bytes held by the ring and the per-worker arrays'''
+        used = 0
+        for a in (self.ring_worker, self.ring_value, self.window_totals, self.round_totals):
+            used += a.buffer_info()[1] * a.itemsize
+        return used
+
+# PPLNSWindow benchmark
+def _bench(shares=1000000, workers=10000):
+    import time
+    import random
+
+    names = [ 'worker%d' % i for i in xrange(workers) ]
+    values = [ random.choice((256.0, 512.0, 1024.0)) for i in xrange(1000) ]
+
+    # Window big enough to hold every share, the worst case for memory
+    w = PPLNSWindow(shares * 1024.0)
+    s = time.time()
+    for i in xrange(shares):
+        w.add(names[i % workers], values[i % 1000])
+    elapsed = time.time() - s
+    print "add: %d shares in %.03f sec (%.02f us/share)" % (shares, elapsed, elapsed * 1e6 / shares)
+    print "window: %d shares, %.02f MB in arrays" % (w.count, w.memory_usage() / 1048576.0)
+
+    s = time.time()
+    rows = w.snapshot()
+    print "snapshot: %d workers in %.03f sec" % (len(rows), time.time() - s)
+
+if __name__ == '__main__':
+    _bench()
@@ -1,18 +1,168 @@
 import binascii
-from twisted.internet import defer
+import time
+from twisted.internet import defer, reactor
 
 import lib.settings as settings
 from stratum.services import GenericService, admin
 from stratum.pubsub import Pubsub
+from stratum.custom_exceptions import ServiceException
 from interfaces import Interfaces
 from subscription import MiningSubscription
 from lib.exceptions import SubmitException
+from miner_session import MinerSession
+from lib.token_bucket import TokenBuckets
+from ip_ban_table import IPBanTable
+from admission_controller import AdmissionController
+from connection_reaper import ConnectionReaper
+import worker_process
 import json
 import struct
 import lib.util as util
 
 import lib.logger
 log = lib.logger.get_logger('mining')
+
+# In the workers of supervisor.tac every worker keeps its own limits. SO_REUSEPORT
+# spreads the connections of an address over all workers, so the per IP
+# limits are divided among them
+WORKERS = settings.WORKER_PROCESSES if settings.WORKER_ID is not None else 1
+
+# mining.submit rate limits, checked before anything else in submit()
+submit_limit_ip = TokenBuckets(float(settings.SUBMIT_RATE_IP) / WORKERS, float(settings.SUBMIT_BURST_IP) / WORKERS,
+    settings.SUBMIT_LIMIT_SIZE)
+submit_limit_connection = TokenBuckets(settings.SUBMIT_RATE_CONNECTION, settings.SUBMIT_BURST_CONNECTION,
+    settings.SUBMIT_LIMIT_SIZE)
+
+# Banned addresses and networks, checked on subscribe and authorize
+IP_BAN_TICK = 10
+ip_bans = IPBanTable(IP_BAN_TICK, 360, time.time())
+
+def auto_ban_ip(ip, reason):
+    '''Bans the address of a misbehaving worker for IP_BAN_TIME (in all workers)'''
+    if settings.IP_BAN_TIME:
+        log.info("IP %s BANNED for %d sec: %s" % (ip, settings.IP_BAN_TIME, reason))
+        if worker_process.supervisor is not None:
+            worker_process.supervisor.notify('relay', 'ban_ip', ip, settings.IP_BAN_TIME, False)
+        else:
+            ban_ip(ip, settings.IP_BAN_TIME, False)
+
+def ban_ip(cidr, seconds, drop=True):
+    '''Bans cidr in this process for seconds (0 for good) and drops its
+    connections, returns how many were dropped'''
+    try:
+        network = ip_bans.ban(cidr, Interfaces.timestamper.time() + seconds if seconds else 0)
+    except ValueError as e:
+        raise ServiceException(str(e))
+    if not drop:
+        return 0
+
+    dropped = 0
+    now = Interfaces.timestamper.time()
+    for subscription in Pubsub.iterate_subscribers(MiningSubscription.event):
+        connection = subscription.connection_ref() if subscription else None
+        if connection is not None and ip_bans.is_banned(connection._get_ip(), now):
+            connection.transport.loseConnection()
+            dropped += 1
+    log.info("Banned %s for %s, dropped %d connections" % (network, '%d sec' % seconds if seconds else 'good', dropped))
+    return dropped
+
+def unban_ip(cidr):
+    try:
+        return ip_bans.unban(cidr)
+    except ValueError as e:
+        raise ServiceException(str(e))
+
+def expire_ip_bans():
+    ip_bans.expire(Interfaces.timestamper.time())
+    reactor.callLater(IP_BAN_TICK, expire_ip_bans)
+
+reactor.callLater(IP_BAN_TICK, expire_ip_bans)
+
+# Caps the authorizations in progress, see MiningService.authorize
+LAG_CHECK_TIME = 0.1
+admission = AdmissionController(max(1, settings.ADMISSION_MAX_INFLIGHT // WORKERS), settings.ADMISSION_MAX_LAG)
+
+def check_reactor_lag(expected):
+    # How much later than asked for we got called
+    now = time.time()
+    admission.set_lag(max(0.0, now - expected))
+    reactor.callLater(LAG_CHECK_TIME, check_reactor_lag, now + LAG_CHECK_TIME)
+
+if settings.ADMISSION_MAX_INFLIGHT:
+    reactor.callLater(LAG_CHECK_TIME, check_reactor_lag, time.time() + LAG_CHECK_TIME)
+
+# Closes subscribed connections which don't mine
+reaper = ConnectionReaper()
+
+def pick_connections(count, percent, extranonce_subscribed):
+    '''Either count connections or the biggest miners making up percent
+    of the sum of all connection difficulties'''
+    candidates = []
+    total = 0.0
+    for subscription in Pubsub.iterate_subscribers(MiningSubscription.event):
+        connection = subscription.connection_ref() if subscription else None
+        miner = connection.get_session().get('miner') if connection is not None else None
+        if miner is None or miner.extranonce1 is None:
+            continue
+        total += miner.difficulty
+        if miner.authorized and (miner.extranonce_subscribed or not extranonce_subscribed):
+            candidates.append((miner.difficulty, connection))
+
+    # Biggest miners first, fewer connections for the same load
+    candidates.sort(key=lambda c: c[0], reverse=True)
+    if percent:
+        budget = total * float(percent) / 100
+    picked = []
+    for (difficulty, connection) in candidates:
+        if percent:
+            if budget <= 0:
+                break
+            budget -= difficulty
+        elif len(picked) >= int(count):
+            break
+        picked.append(connection)
+    return picked
+
+def migrate(host, port, count, percent, wait):
+    connections = pick_connections(count, percent, False)
+    for connection in connections:
+        connection.rpc('client.reconnect', [host, port, wait], is_notification=True)
+
+    log.info("Asked %d connections to reconnect to %s:%s" % (len(connections), host, port))
+    return len(connections)
+
+def repartition(instance_id, count, percent):
+    connections = pick_connections(count, percent, True)
+    for connection in connections:
+        extranonce1 = Interfaces.template_registry.get_new_extranonce1(instance_id)
+        Interfaces.worker_manager.set_extranonce(connection, extranonce1)
+
+    log.info("Moved %d connections to the partition of instance %d" % (len(connections), instance_id))
+    return len(connections)
+
+# Admin calls changing the state of a process, run in every worker of supervisor.tac
+ADMIN_CALLS = {
+    'ban_ip': ban_ip,
+    'unban_ip': unban_ip,
+    'migrate': migrate,
+    'repartition': repartition,
+}
+
+def relay_admin(method, combine, *params):
+    '''Runs ADMIN_CALLS[method] here, or in every worker through the
+    supervisor (a Deferred of combine(results of all workers))'''
+    if worker_process.supervisor is None:
+        return ADMIN_CALLS[method](*params)
+    d = worker_process.supervisor.call('relay', method, *params)
+    d.addCallbacks(combine, _relay_failed)
+    return d
+
+def _relay_failed(failure):
+    raise ServiceException(failure.getErrorMessage())
+
+def per_worker(count):
+    # A count of connections shared out over the workers
+    return (int(count) + WORKERS - 1) // WORKERS
                 
 class MiningService(GenericService):
     '''This service provides public API for Stratum mining proxy
@@ -33,126 +183,322 @@ class MiningService(GenericService):
         See blocknotify.sh in /scripts/ for more info.'''
         
         log.info("NEW BLOCK NOTIFICATION RECEIVED!")
-        Interfaces.template_registry.update_block()
+        if worker_process.supervisor is not None:
+            # The supervisor fetches the template for all workers
+            worker_process.supervisor.notify('update_block')
+        else:
+            Interfaces.template_registry.update_block()
         return True 
+
+    @admin
+    def get_auth_stats(self):
+        '''Hit/miss counters of the worker authorization cache.'''
+        return Interfaces.worker_manager.get_auth_stats()
+
+    @admin
+    def get_template_stats(self):
+        '''Number of registered block templates and their approximate memory use.'''
+        return Interfaces.template_registry.get_memory_usage()
+
+    @admin
+    def get_vardiff_stats(self):
+        '''Size of the vardiff table and how many idle or closed connections were evicted from it.'''
+        return Interfaces.share_limiter.get_stats()
+
+    @admin
+    def get_submit_limit_stats(self):
+        '''Buckets and allowed/rejected counts of the mining.submit rate limits.'''
+        return {
+            'ip': submit_limit_ip.get_stats(),
+            'connection': submit_limit_connection.get_stats(),
+        }
+
+    @admin
+    def get_admission_stats(self):
+        '''Authorizations in progress and waiting, and the reactor lag seen by the admission control.'''
+        return admission.get_stats()
+
+    @admin
+    def get_reaper_stats(self):
+        '''Connections watched for the idle timeouts and how many were closed for each of them.'''
+        return reaper.get_stats()
+
+    @admin
+    def get_validator_stats(self):
+        '''Running validator processes and shares waiting for their verdict.'''
+        validators = Interfaces.template_registry.validators
+        if validators is None:
+            return {'processes': 0, 'pending': 0, 'timeouts': 0, 'restarts': 0}
+        return validators.get_stats()
+
+    @admin
+    def ban_ip(self, cidr, seconds=0):
+        '''Bans an address or network ('10.0.0.0/8', '2001:db8::/32') for
+        seconds, 0 for good, and drops its connections.'''
+        return relay_admin('ban_ip', sum, cidr, int(seconds))
+
+    @admin
+    def unban_ip(self, cidr):
+        '''Lifts the ban of an address or network, exactly as it was banned.'''
+        return relay_admin('unban_ip', any, cidr)
+
+    @admin
+    def get_ip_bans(self):
+        '''All bans as {'network/prefixlen': expires}, expires 0 means never.'''
+        return ip_bans.get_bans()
     
+    def configure(self, extensions, params=None):
+        '''Negotiates protocol extensions (BIP310 mining.configure).
+        Only version-rolling is supported, with the bits of
+        VERSION_ROLLING_MASK the miner asked for.'''
+        params = params or {}
+        result = {}
+        for extension in extensions:
+            if extension == 'version-rolling' and settings.VERSION_ROLLING_MASK:
+                try:
+                    requested = int(params.get('version-rolling.mask', 'ffffffff'), 16)
+                except (TypeError, ValueError):
+                    requested = 0
+                mask = requested & settings.VERSION_ROLLING_MASK
+                MinerSession.get(self.connection_ref(), settings.POOL_TARGET).version_mask = mask
+                result['version-rolling'] = mask != 0
+                result['version-rolling.mask'] = '%08x' % mask
+            else:
+                result[extension] = False
+        return result
+
+    def _check_ip_ban(self):
+        connection = self.connection_ref()
+        if ip_bans.is_banned(connection._get_ip(), Interfaces.timestamper.time()):
+            connection.transport.loseConnection()
+            raise ServiceException("IP is banned")
+
+    @admin
+    def migrate(self, host, port, count=0, percent=0, wait=0):
+        '''Sends client.reconnect to host:port (another instance) to
+        either count connections or the biggest miners making up percent
+        of the hashrate (estimated from their difficulty), so they
+        reconnect there after wait seconds. Miners which don't support
+        client.reconnect stay. Returns how many were asked to move.'''
+        return relay_admin('migrate', sum, host, int(port), per_worker(count), percent, int(wait))
+
+    @admin
+    def repartition(self, instance_id, count=0, percent=0):
+        '''Hands connections which sent mining.extranonce.subscribe a new
+        extranonce1 from the partition of another instance
+        (mining.set_extranonce), chosen like in migrate. The connections
+        stay on this instance; this only moves load behind a frontend that
+        routes shares by extranonce1 partition (the INSTANCE_ID bits).'''
+        return relay_admin('repartition', sum, int(instance_id), per_worker(count), percent)
+
     def subscribe(self, *args):
         '''Subscribe for receiving mining jobs. This will
         return subscription details, extranonce1_hex and extranonce2_size'''
         
+        self._check_ip_ban()
         extranonce1 = Interfaces.template_registry.get_new_extranonce1()
         extranonce2_size = Interfaces.template_registry.extranonce2_size
         extranonce1_hex = binascii.hexlify(extranonce1)
         
-        session = self.connection_ref().get_session()
-        session['extranonce1'] = extranonce1
-        session['difficulty'] = settings.POOL_TARGET
+        miner = MinerSession.get(self.connection_ref(), settings.POOL_TARGET)
+        miner.extranonce1 = extranonce1
+        miner.difficulty = miner.suggested_difficulty or settings.POOL_TARGET
+        if miner.subscribed_ts == 0:
+            reaper.watch(self.connection_ref(), miner, Interfaces.timestamper.time())
         return Pubsub.subscribe(self.connection_ref(), MiningSubscription()) + (extranonce1_hex, extranonce2_size)
         
     def authorize(self, worker_name, worker_password):
-        '''Let authorize worker on this connection.'''
-        session = self.connection_ref().get_session()
-        session.setdefault('authorized', {})
+        '''Let authorize worker on this connection.
+        With ADMISSION_MAX_INFLIGHT the call may wait for its turn first.'''
+        self._check_ip_ban()
+        if not settings.ADMISSION_MAX_INFLIGHT:
+            return self._admitted(None, worker_name, worker_password)
+
+        d = defer.Deferred()
+        admission.request(self.connection_ref()._get_ip(), lambda: d.callback(None))
+        d.addCallback(self._admitted, worker_name, worker_password)
+        d.addBoth(self._admission_done)
+        return d
+
+    def _admitted(self, result, worker_name, worker_password):
+        if self.connection_ref() is None:
+            # Gave up while waiting
+            return False
+        result = Interfaces.worker_manager.authorize(worker_name, worker_password)
+        if isinstance(result, defer.Deferred):
+            return result.addCallback(self._authorize, worker_name, worker_password)
+        return self._authorize(result, worker_name, worker_password)
+
+    def _admission_done(self, result):
+        admission.done()
+        return result
+
+    def _authorize(self, is_authorized, worker_name, worker_password):
+        if self.connection_ref() is None:
+            # Disconnected while we were asking the database
+            return False
+
+        miner = MinerSession.get(self.connection_ref(), settings.POOL_TARGET)
         ip = self.connection_ref()._get_ip()
-        extranonce1 = session.get('extranonce1', None)
 
-        if Interfaces.worker_manager.authorize(worker_name, worker_password):
+        if is_authorized:
             log.info("Worker authorized: %s IP %s" % (worker_name, str(ip)))
-            session['authorized'][worker_name] = worker_password
-            Interfaces.worker_manager.update_worker_diff(worker_name, settings.POOL_TARGET)
+            first = not miner.authorized
+            miner.authorized[worker_name] = worker_password
+            if first:
+                miner.active_ts = Interfaces.timestamper.time()
+            Interfaces.worker_manager.register_connection(worker_name, self.connection_ref())
+
+            # Start where the worker left off last time, unless the miner asked for a difficulty
+            start = Interfaces.worker_manager.get_start_difficulty(worker_name) if first else None
+            if start is not None and miner.suggested_difficulty is None:
+                if start != miner.difficulty:
+                    log.info("Starting %s at difficulty %s" % (worker_name, start))
+                    Interfaces.worker_manager.send_difficulty(self.connection_ref(), start)
+            elif start is None:
+                Interfaces.worker_manager.update_worker_diff(worker_name, miner.difficulty)
             if settings.ENABLE_WORKER_STATS:
-                Interfaces.worker_manager.worker_log['authorized'][extranonce1] = (0, 0, False, Interfaces.timestamper.time())
+                miner.reset_stats(Interfaces.timestamper.time())
+                miner.banned = False
             return True
         else:
-            ip = self.connection_ref()._get_ip()
             log.info("Failed worker authorization: %s IP %s" % (worker_name, str(ip)))
-            if worker_name in session['authorized']:
-                del session['authorized'][worker_name]
-            if extranonce1 in Interfaces.worker_manager.worker_log['authorized']:
-                del Interfaces.worker_manager.worker_log['authorized'][extranonce1]
+            miner.authorized.pop(worker_name, None)
             return False
         
-    def submit(self, worker_name, work_id, extranonce2, ntime, nonce):
-        '''Try to solve block candidate using given parameters.'''
+    def suggest_difficulty(self, difficulty):
+        '''Miner asks for a share difficulty (mining.suggest_difficulty).
+        It is kept within VDIFF_MIN_TARGET..VDIFF_MAX_TARGET and vardiff
+        continues from there.'''
+        try:
+            difficulty = float(difficulty)
+        except (TypeError, ValueError):
+            return False
+        if difficulty <= 0:
+            return False
+
+        difficulty = min(max(difficulty, settings.VDIFF_MIN_TARGET), settings.VDIFF_MAX_TARGET)
+        miner = MinerSession.get(self.connection_ref(), settings.POOL_TARGET)
+        miner.suggested_difficulty = difficulty
+        if miner.extranonce1 is not None:
+            Interfaces.worker_manager.send_difficulty(self.connection_ref(), difficulty)
+        else:
+            # Picked up by subscribe
+            miner.difficulty = difficulty
+        return True
+
+    def submit(self, worker_name, work_id, extranonce2, ntime, nonce, version_bits=None):
+        '''Try to solve block candidate using given parameters.
+        version_bits is sent by miners doing version rolling (see configure).'''
 
         session = self.connection_ref().get_session()
-        session.setdefault('authorized', {})
-        
-        # Check if worker is authorized to submit shares
+        miner = session.get('miner')
         ip = self.connection_ref()._get_ip()
-        if not Interfaces.worker_manager.authorize(worker_name, session['authorized'].get(worker_name)):
+
+        # Rate limits first, flooding clients shouldn't cost more than this
+        now = Interfaces.timestamper.time()
+        if settings.SUBMIT_RATE_IP and not submit_limit_ip.take(ip, now):
+            raise SubmitException("Rate limit exceeded")
+        if settings.SUBMIT_RATE_CONNECTION and miner is not None and miner.extranonce1 is not None \
+                and not submit_limit_connection.take(miner.extranonce1, now):
+            raise SubmitException("Rate limit exceeded")
+        
+        # Check if worker is authorized to submit shares. Workers are
+        # authorized once per connection, the worker manager revokes
+        # the session when the credentials change.
+        if miner is None or worker_name not in miner.authorized:
             log.info("Worker is not authorized: %s IP %s" % (worker_name, str(ip)))
             raise SubmitException("Worker is not authorized")
 
         # Check if extranonce1 is in connection session
-        extranonce1_bin = session.get('extranonce1', None)
+        extranonce1_bin = miner.extranonce1
         
         if not extranonce1_bin:
             log.info("Connection is not subscribed for mining: IP %s" % str(ip))
             raise SubmitException("Connection is not subscribed for mining")
         
-        difficulty = session['difficulty']
+        difficulty = miner.difficulty
         submit_time = Interfaces.timestamper.time()
+        miner.active_ts = submit_time
 
-        if extranonce1_bin in Interfaces.worker_manager.job_log and work_id in Interfaces.worker_manager.job_log[extranonce1_bin]:
-            (job_id, difficulty, job_ts) = Interfaces.worker_manager.job_log[extranonce1_bin][work_id]
+        job = miner.jobs.get(work_id, submit_time, settings.WORK_EXPIRE)
+        if job is not None:
+            (job_id, difficulty, job_ts) = job
         else:
-            job_ts = Interfaces.timestamper.time()
-            Interfaces.worker_manager.job_log.setdefault(extranonce1_bin, {})[work_id] = (work_id, difficulty, job_ts)
-            job_id = work_id
-        #log.debug("worker_job_log: %s" % repr(Interfaces.worker_manager.job_log))
+            # Unknown or expired work, rejected as an invalid share below
+            job_id = None
 
         pool_share = float(float(difficulty) * float(settings.SHARE_MULTIPLIER))
 
         if settings.ENABLE_WORKER_STATS:
-            (valid, invalid, is_banned, last_ts) = Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin]
-            percent = float(float(invalid) / (float(valid) if valid else 1) * 100)
+            percent = float(float(miner.invalid) / (float(miner.valid) if miner.valid else 1) * 100)
 
-            if is_banned and submit_time - last_ts > settings.WORKER_BAN_TIME:
+            if miner.banned and submit_time - miner.stats_ts > settings.WORKER_BAN_TIME:
                 if percent > settings.INVALID_SHARES_PERCENT:
                     log.info("Worker invalid percent: %0.2f %s STILL BANNED!" % (percent, worker_name))
                 else: 
-                    is_banned = False
+                    miner.banned = False
                     log.info("Clearing ban for worker: %s UNBANNED" %  worker_name)
-                (valid, invalid, is_banned, last_ts) = (0, 0, is_banned, Interfaces.timestamper.time())
+                miner.reset_stats(submit_time)
 
-            if submit_time - last_ts > settings.WORKER_CACHE_TIME and not is_banned:
+            if submit_time - miner.stats_ts > settings.WORKER_CACHE_TIME and not miner.banned:
                 if percent > settings.INVALID_SHARES_PERCENT and settings.ENABLE_WORKER_BANNING:
-                    is_banned = True
+                    miner.banned = True
                     log.info("Worker invalid percent: %0.2f %s BANNED!" % (percent, worker_name))
+                    auto_ban_ip(ip, "invalid percent of %s" % worker_name)
                 else:
                     log.debug("Clearing worker stats for: %s" %  worker_name)
-                (valid, invalid, is_banned, last_ts) = (0, 0, is_banned, Interfaces.timestamper.time())
+                miner.reset_stats(submit_time)
 
-        if settings.ENABLE_WORKER_STATS:
-            log.debug("%s (%d, %d, %s, %d) %0.2f%% job_id(%s) diff(%i) share(%i)" % (worker_name, valid, invalid, is_banned, last_ts, percent, job_id, difficulty, pool_share))
+            log.debug("%s (%d, %d, %s, %d) %0.2f%% job_id(%s) diff(%i) share(%i)" % (worker_name, miner.valid, miner.invalid,
+                miner.banned, miner.stats_ts, percent, job_id, difficulty, pool_share))
         
         Interfaces.share_limiter.submit(self.connection_ref, job_id, difficulty, submit_time, worker_name, extranonce1_bin)
 
         try:
-            (block_header, block_hash, share_diff, on_submit) = Interfaces.template_registry.submit_share(job_id,
-                worker_name, session, extranonce1_bin, extranonce2, ntime, nonce, difficulty, ip, submit_time)
+            if job_id is None:
+                raise SubmitException("Job '%s' not found" % work_id)
+            result = Interfaces.template_registry.submit_share(job_id,
+                worker_name, session, extranonce1_bin, extranonce2, ntime, nonce, difficulty, ip, submit_time,
+                version_bits, miner.version_mask)
         except SubmitException as e:
-            # block_header and block_hash are None when submitted data are corrupted
-            if settings.ENABLE_WORKER_STATS:
-                invalid += 1
-                if invalid > settings.INVALID_SHARES_SPAM:
-                    is_banned = True
-                    log.info("Worker SPAM %s BANNED! IP: %s" % (worker_name, ip))
-                Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin] = (valid, invalid, is_banned, last_ts)
-
-                if is_banned:
-                    raise SubmitException("Worker is temporarily banned")
- 
-            Interfaces.share_manager.on_submit_share(worker_name, False, difficulty, pool_share,
-                submit_time, False, ip, e[0], 0, job_id)  
-            raise
+            self._share_rejected(e, miner, worker_name, difficulty, pool_share, submit_time, ip, job_id)
+
+        if isinstance(result, defer.Deferred):
+            # Checked by a validator process
+            result.addCallbacks(self._share_accepted, self._share_failed,
+                callbackArgs=(miner, worker_name, difficulty, pool_share, submit_time, ip, job_id),
+                errbackArgs=(miner, worker_name, difficulty, pool_share, submit_time, ip, job_id))
+            return result
+        return self._share_accepted(result, miner, worker_name, difficulty, pool_share, submit_time, ip, job_id)
+
+    def _share_failed(self, failure, miner, worker_name, difficulty, pool_share, submit_time, ip, job_id):
+        failure.trap(SubmitException)
+        self._share_rejected(failure.value, miner, worker_name, difficulty, pool_share, submit_time, ip, job_id)
+
+    def _share_rejected(self, e, miner, worker_name, difficulty, pool_share, submit_time, ip, job_id):
+        # block_header and block_hash are None when submitted data are corrupted
+        if settings.ENABLE_WORKER_STATS:
+            miner.invalid += 1
+            if miner.invalid > settings.INVALID_SHARES_SPAM and not miner.banned:
+                miner.banned = True
+                log.info("Worker SPAM %s BANNED! IP: %s" % (worker_name, ip))
+                auto_ban_ip(ip, "invalid shares spam of %s" % worker_name)
+
+            if miner.banned:
+                raise SubmitException("Worker is temporarily banned")
+
+        Interfaces.share_manager.on_submit_share(worker_name, False, difficulty, pool_share,
+            submit_time, False, ip, e[0], 0, job_id)
+        raise e
+
+    def _share_accepted(self, result, miner, worker_name, difficulty, pool_share, submit_time, ip, job_id):
+        (block_header, block_hash, share_diff, on_submit) = result
 
         if settings.ENABLE_WORKER_STATS:
-            valid += 1
-            Interfaces.worker_manager.worker_log['authorized'][extranonce1_bin] = (valid, invalid, is_banned, last_ts)
+            miner.valid += 1
 
-            if is_banned:
+            if miner.banned:
                 raise SubmitException("Worker is temporarily banned")
  
         Interfaces.share_manager.on_submit_share(worker_name,
@@ -164,3 +510,15 @@ class MiningService(GenericService):
 
         return True
         
+
+class MiningExtranonceService(GenericService):
+    '''mining.extranonce.subscribe, the miner accepts
+    mining.set_extranonce on this connection.'''
+
+    service_type = 'mining.extranonce'
+    service_vendor = 'stratum'
+    is_default = True
+
+    def subscribe(self):
+        MinerSession.get(self.connection_ref(), settings.POOL_TARGET).extranonce_subscribed = True
+        return True
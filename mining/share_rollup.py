@@ -0,0 +1,72 @@
+import lib.logger
+log = lib.logger.get_logger('share_rollup')
+
+class WorkerRollup(object):
+    '''Share counters of one worker in one time bucket'''
+    __slots__ = ('accepted', 'accepted_diff', 'rejected', 'rejected_diff', 'best_share', 'reasons')
+
+    def __init__(self):
+        self.accepted = 0
+        self.accepted_diff = 0.0
+        self.rejected = 0
+        self.rejected_diff = 0.0
+        self.best_share = 0.0
+        self.reasons = {}
+
+class ShareRollup(object):
+    '''Aggregates submitted shares into per-worker counters for every
+    bucket_time seconds. Closed buckets are returned as one row per worker,
+    so the database gets one insert per worker and bucket instead of
+    one insert per share.'''
+
+    def __init__(self, bucket_time):
+        self.bucket_time = int(bucket_time)
+        self.buckets = {}
+
+    def add(self, data):
+        # Same layout as DBInterface.queue_share
+        (worker_name, block_hash, pool_share, timestamp, is_valid, ip, invalid_reason, share_diff) = data[:8]
+
+        bucket = int(timestamp) - int(timestamp) % self.bucket_time
+        workers = self.buckets.get(bucket)
+        if workers is None:
+            workers = self.buckets[bucket] = {}
+
+        r = workers.get(worker_name)
+        if r is None:
+            r = workers[worker_name] = WorkerRollup()
+
+        if is_valid:
+            r.accepted += 1
+            r.accepted_diff += pool_share
+            if share_diff > r.best_share:
+                r.best_share = share_diff
+        else:
+            r.rejected += 1
+            r.rejected_diff += pool_share
+            r.reasons[invalid_reason] = r.reasons.get(invalid_reason, 0) + 1
+
+    def pop_closed(self, now):
+        '''Removes and returns the rows of all buckets which ended before now'''
+        rows = []
+        for bucket in [ b for b in self.buckets if b + self.bucket_time <= now ]:
+            rows.extend(self._rows(bucket, self.buckets.pop(bucket)))
+        return rows
+
+    def pop_all(self):
+        rows = []
+        for bucket in self.buckets.keys():
+            rows.extend(self._rows(bucket, self.buckets.pop(bucket)))
+        return rows
+
+    def _rows(self, bucket, workers):
+        # Row layout
+        # 0: bucket start (unix time)
+        # 1: worker_name
+        # 2: accepted, 3: accepted_diff
+        # 4: rejected, 5: rejected_diff
+        # 6: best_share
+        # 7: {reject reason: count}
+        log.debug("Closing share bucket %d with %d workers" % (bucket, len(workers)))
+        return [ (bucket, worker_name, r.accepted, r.accepted_diff, r.rejected, r.rejected_diff,
+                  r.best_share, r.reasons) for (worker_name, r) in workers.iteritems() ]
@@ -26,16 +26,10 @@ class MiningSubscription(Subscription):
         for subscription in Pubsub.iterate_subscribers(cls.event):
             try:
                 if subscription != None:
-                    session = subscription.connection_ref().get_session()
-                    session.setdefault('authorized', {})
-                    if session['authorized'].keys():
-                        worker_name = session['authorized'].keys()[0]
-                        difficulty = session['difficulty']
-                        extranonce1_bin = session.get('extranonce1', None)
-                        work_id = Interfaces.worker_manager.register_work(extranonce1_bin, job_id, difficulty)
+                    miner = subscription.connection_ref().get_session().get('miner')
+                    if miner is not None:
+                        work_id = Interfaces.worker_manager.register_work(miner, job_id, miner.difficulty)
                         subscription.emit_single(work_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs)          
-                    else:
-                        subscription.emit_single(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean_jobs)
 
             except Exception as e:
                 log.exception("Error broadcasting work to client %s" % str(e))
@@ -53,10 +47,12 @@ class MiningSubscription(Subscription):
             log.error("Template not ready yet")
             return result
         
-        # Force set higher difficulty
-        self.connection_ref().rpc('mining.set_difficulty', [settings.POOL_TARGET,], is_notification=True)
+        # Force set the starting difficulty
+        miner = self.connection_ref().get_session()['miner']
+        work_id = Interfaces.worker_manager.register_work(miner, job_id, miner.difficulty)
+        self.connection_ref().rpc('mining.set_difficulty', [miner.difficulty,], is_notification=True)
         clean_jobs = True
-        self.emit_single(job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, True)
+        self.emit_single(work_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, True)
         
         return result
                 
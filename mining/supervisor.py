@@ -0,0 +1,196 @@
+'''Multi-process mode: the supervisor (supervisor.tac) runs WORKER_PROCESSES
+copies of launcher.tac which share the stratum port with SO_REUSEPORT.
+
+The supervisor is the only process talking to the coin daemon. It polls
+for new blocks, fetches each template once and tells the workers to pick
+it up, and passes their submitblock calls on. Shares and found blocks of
+all workers come back to the supervisor's share manager, so there is one
+DB writer and one PPLNS window. See mining/worker_process.py for the
+worker side, scripts/stratum_loadgen.py measures the shares/s.'''
+
+import os
+import sys
+import time
+from twisted.application import service
+from twisted.internet import reactor, protocol, defer
+
+import lib.settings as settings
+from lib.bitcoin_rpc import BitcoinRPC
+from lib.ipc import IPCChannel
+from interfaces import Interfaces
+
+import lib.logger
+log = lib.logger.get_logger('supervisor')
+
+class WorkerProcess(protocol.ProcessProtocol):
+    '''One worker, talking to the supervisor over its fds 3 (in) and 4 (out)'''
+
+    def __init__(self, supervisor, worker_id):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+        self.channel = None
+        self.started = time.time()
+
+    def connectionMade(self):
+        self.channel = IPCChannel(self.write, self.supervisor)
+
+    def write(self, data):
+        self.transport.writeToChild(3, data)
+
+    def childDataReceived(self, fd, data):
+        if fd == 4:
+            self.channel.data_received(data)
+
+    def processEnded(self, reason):
+        self.channel.connection_lost()
+        self.supervisor.worker_ended(self, reason)
+
+class Supervisor(service.Service):
+    def __init__(self, count):
+        self.count = count
+        self.workers = {}       # worker_id -> WorkerProcess
+        self.stopping = False
+        self.restarts = 0
+        self.bitcoin_rpc = BitcoinRPC(settings.DAEMON_TRUSTED_HOST,
+                                      settings.DAEMON_TRUSTED_PORT,
+                                      settings.DAEMON_TRUSTED_USER,
+                                      settings.DAEMON_TRUSTED_PASSWORD)
+        self.template = None    # last getblocktemplate result, handed to the workers
+        self.prevhash = None
+        self.last_update = 0
+        self.fetching = None    # waiters of the getblocktemplate in progress
+        self.clock = None
+
+    def startService(self):
+        service.Service.startService(self)
+        for worker_id in xrange(self.count):
+            self.spawn(worker_id)
+        self.poll()
+
+    def stopService(self):
+        self.stopping = True
+        if self.clock is not None and self.clock.active():
+            self.clock.cancel()
+        for worker in self.workers.values():
+            worker.transport.signalProcess('TERM')
+        return service.Service.stopService(self)
+
+    def spawn(self, worker_id):
+        env = dict(os.environ)
+        env['STRATUM_WORKER_ID'] = str(worker_id)
+        # sys.argv[0] is the twistd running us
+        args = [sys.executable, sys.argv[0], '-ny', 'launcher.tac', '-l', '-',
+                '--pidfile=%s_%d.pid' % (settings.STRATUM_MINING_PROCESS_NAME, worker_id)]
+        worker = WorkerProcess(self, worker_id)
+        reactor.spawnProcess(worker, sys.executable, args, env=env, path=os.getcwd(),
+                             childFDs={0: 'w', 1: 1, 2: 2, 3: 'w', 4: 'r'})
+        self.workers[worker_id] = worker
+        log.info("Started worker %d, pid %d" % (worker_id, worker.transport.pid))
+
+    def worker_ended(self, worker, reason):
+        if self.workers.get(worker.worker_id) is worker:
+            del self.workers[worker.worker_id]
+        if self.stopping:
+            return
+        log.error("Worker %d ended after %d sec: %s" % (worker.worker_id, time.time() - worker.started,
+            reason.getErrorMessage()))
+        self.restarts += 1
+        reactor.callLater(settings.WORKER_RESTART_DELAY, self.spawn, worker.worker_id)
+
+    @defer.inlineCallbacks
+    def poll(self):
+        # Same checks as BlockUpdater, once for all the workers
+        try:
+            prevhash = yield self.bitcoin_rpc.prevhash()
+            if prevhash != self.prevhash:
+                log.info("New block! Prevhash: %s" % prevhash)
+                self.prevhash = prevhash
+                yield self.refresh()
+            elif time.time() - self.last_update >= settings.MERKLE_REFRESH_INTERVAL:
+                yield self.refresh()
+        except Exception:
+            log.exception("Supervisor poll failed")
+        finally:
+            if not self.stopping:
+                self.clock = reactor.callLater(settings.PREVHASH_REFRESH_INTERVAL, self.poll)
+
+    def refresh(self):
+        '''Fetches a new template and tells the workers about it,
+        concurrent calls share one getblocktemplate'''
+        d = defer.Deferred()
+        if self.fetching is None:
+            self.fetching = [d]
+            self.bitcoin_rpc.getblocktemplate().addBoth(self._fetched)
+        else:
+            self.fetching.append(d)
+        return d
+
+    def _fetched(self, result):
+        (waiters, self.fetching) = (self.fetching, None)
+        if isinstance(result, dict):
+            self.template = result
+            self.last_update = time.time()
+            self.broadcast('update_block')
+            log.info("Template of height %d sent to %d workers" % (result['height'], len(self.workers)))
+        for d in waiters:
+            if isinstance(result, dict):
+                d.callback(result)
+            else:
+                d.errback(result)
+
+    def broadcast(self, method, *params):
+        for worker in self.workers.values():
+            worker.channel.notify(method, *params)
+
+    # Calls of the workers
+
+    def ipc_getblocktemplate(self):
+        if self.template is None:
+            return self.refresh()
+        return self.template
+
+    def ipc_update_block(self):
+        # blocknotify reached one of the workers
+        self.refresh()
+        return True
+
+    def ipc_submitblock(self, block_hex, block_hash_hex):
+        d = self.bitcoin_rpc.submitblock(block_hex, block_hash_hex)
+        d.addBoth(self._submitted)
+        return d
+
+    def _submitted(self, result):
+        # Accepted or not, the daemon may have moved on
+        self.refresh()
+        return result
+
+    def ipc_prevhash(self):
+        return self.bitcoin_rpc.prevhash()
+
+    def ipc_validateaddress(self, address):
+        return self.bitcoin_rpc.validateaddress(address)
+
+    def ipc_getinfo(self):
+        return self.bitcoin_rpc.getinfo()
+
+    def ipc_getdifficulty(self):
+        return self.bitcoin_rpc.getdifficulty()
+
+    def ipc_blockexists(self, block_hash_hex):
+        return self.bitcoin_rpc.blockexists(block_hash_hex)
+
+    def ipc_relay(self, method, *params):
+        # An admin call of one worker, run in all of them
+        calls = [ worker.channel.call('admin', method, *params) for worker in self.workers.values() ]
+        return defer.gatherResults(calls, consumeErrors=True).addErrback(self._relay_failed)
+
+    def _relay_failed(self, failure):
+        # gatherResults wraps the first error
+        failure.trap(defer.FirstError)
+        return failure.value.subFailure
+
+    def ipc_share(self, *args):
+        Interfaces.share_manager.on_submit_share(*args)
+
+    def ipc_block(self, *args):
+        Interfaces.share_manager.on_submit_block(*args)
@@ -0,0 +1,130 @@
+'''Share rate estimator for vardiff, see VardiffEstimator.'''
+
+import math
+
+class VardiffEstimator(object):
+    '''Estimates the share rate of a connection from exponentially
+    decayed sums of its shares and of the time they were counted over
+    (two floats per connection, kept in the VardiffTable columns
+    ew_shares and ew_time).
+
+    Shares arrive as a Poisson process, so at the target share time the
+    decayed share count has mean lam = ew_time / target and a standard
+    deviation of about sqrt(lam). The difficulty is only changed when
+    the count is more than `confidence` standard deviations off, and
+    then straight to the difficulty matching the estimated rate. The
+    estimate is rescaled to the new difficulty instead of being thrown
+    away, so a retarget doesn't start from zero knowledge.
+
+    Without `floats` the difficulty is rounded to a whole number before
+    it is clamped, like BasicShareLimiter's integer (VDIFF_FLOAT = False)
+    path does.'''
+
+    def __init__(self, target, half_life, confidence, min_diff, max_diff, x2=False, floats=True):
+        self.target = float(target)
+        self.half_life = float(half_life)
+        self.confidence = float(confidence)
+        self.min_diff = min_diff
+        self.max_diff = max_diff
+        self.x2 = x2
+        self.floats = floats
+
+    def update(self, table, slot, shares, elapsed):
+        '''Adds one period to the estimate of the slot and returns the
+        new difficulty, or None when it stays'''
+        decay = math.exp(-elapsed * math.log(2) / self.half_life)
+        ew_shares = table.ew_shares[slot] * decay + shares
+        ew_time = table.ew_time[slot] * decay + elapsed
+
+        current = table.difficulty[slot]
+        new_diff = None
+        lam = ew_time / self.target
+        if abs(ew_shares - lam) > self.confidence * math.sqrt(lam):
+            # Half a share when none came at all, the rate isn't really 0
+            new_diff = self.clamp(current * max(ew_shares, 0.5) / lam)
+            if new_diff == current:
+                new_diff = None
+            else:
+                # Same hashrate at the new difficulty
+                ew_shares *= float(current) / new_diff
+
+        table.ew_shares[slot] = ew_shares
+        table.ew_time[slot] = ew_time
+        return new_diff
+
+    def clamp(self, diff):
+        if self.x2:
+            diff = 2.0 ** round(math.log(diff, 2))
+        if not self.floats:
+            diff = int(round(diff))
+        return min(max(diff, self.min_diff), self.max_diff)
+
+# Simulation of BasicShareLimiter's rule (VDIFF_X2_TYPE) against the estimator
+def _bench(miners=500, hours=6, target=15, retarget=90, variance=30, half_life=300, confidence=2.0, seed=1):
+    import random
+
+    class Columns(object):
+        def __init__(self):
+            self.ew_shares = [0.0]
+            self.ew_time = [0.0]
+            self.difficulty = [1.0]
+
+    def poisson(lam):
+        if lam > 50:
+            return max(0, int(round(random.gauss(lam, math.sqrt(lam)))))
+        l = math.exp(-lam)
+        k = 0
+        p = random.random()
+        while p > l:
+            k += 1
+            p *= random.random()
+        return k
+
+    tmin = target * (1 - variance / 100.0)
+    tmax = target * (1 + variance / 100.0)
+
+    def basic(diff, shares, elapsed):
+        avg = float(elapsed) / (shares if shares else 1)
+        if avg > tmax and diff > 1:
+            return max(diff * 0.5, 1)
+        elif avg < tmin:
+            return min(diff * 2, 2 ** 20)
+        return None
+
+    estimator = VardiffEstimator(target, half_life, confidence, 1, 2 ** 20, x2=True)
+    periods = hours * 3600 / retarget
+
+    for name in ('basic', 'estimator'):
+        random.seed(seed)
+        notifies = 0
+        converge = []
+        for m in xrange(miners):
+            # Hashrate in difficulty-1 shares per second, ideal difficulty 1..65536
+            rate = 2 ** random.uniform(0, 16) / target
+            ideal = rate * target
+            cols = Columns()
+            settled = None
+            for p in xrange(periods):
+                diff = cols.difficulty[0]
+                shares = poisson(rate / diff * retarget)
+                if name == 'basic':
+                    new_diff = basic(diff, shares, retarget)
+                else:
+                    new_diff = estimator.update(cols, 0, shares, retarget)
+                if new_diff is not None:
+                    cols.difficulty[0] = new_diff
+                    notifies += 1
+
+                within = ideal / 2 <= cols.difficulty[0] <= ideal * 2
+                if within and settled is None:
+                    settled = p + 1
+                elif not within:
+                    settled = None
+            converge.append(settled * retarget if settled else hours * 3600)
+
+        converge.sort()
+        print "%-9s: %5.1f notifies/miner/hour, time to converge median %5d sec, 90%% %5d sec" % (name,
+            float(notifies) / miners / hours, converge[len(converge) / 2], converge[len(converge) * 9 / 10])
+
+if __name__ == '__main__':
+    _bench()
@@ -0,0 +1,182 @@
+'''Vardiff state of all connections in array columns, indexed by slot.'''
+
+from array import array
+from lib.timing_wheel import TimingWheel
+
+class VardiffTable(object):
+    '''One slot per connection doing vardiff. A share only increments
+    the slot's counter; the retarget sweep reads whole columns at once
+    and hands back the slots which are due. Freed slots are reused.
+
+    Slots without a share for idle_time seconds, or whose connection is
+    gone, are evicted through a timing wheel (see expire()).'''
+
+    def __init__(self, idle_time, tick=10, capacity=1024, now=0):
+        self.idle_time = idle_time
+        self.wheel = TimingWheel(tick, int(idle_time // tick) + 2, now)
+        self.evicted_idle = 0
+        self.evicted_closed = 0
+        self.shares = array('l', [0]) * capacity        # shares since the last retarget check
+        self.last_rtc = array('d', [0.0]) * capacity    # time of the last retarget check
+        self.last_ts = array('d', [0.0]) * capacity     # time of the last share
+        self.difficulty = array('d', [0.0]) * capacity
+        self.ew_shares = array('d', [0.0]) * capacity   # VardiffEstimator state
+        self.ew_time = array('d', [0.0]) * capacity
+        self.connections = [None] * capacity            # weak reference to the connection
+        self.worker_names = [None] * capacity
+        self.free = range(capacity - 1, -1, -1)
+        self.used = 0
+
+    def __len__(self):
+        return self.used
+
+    def _grow(self):
+        cap = len(self.shares)
+        self.shares.extend(array('l', [0]) * cap)
+        self.last_rtc.extend(array('d', [0.0]) * cap)
+        self.last_ts.extend(array('d', [0.0]) * cap)
+        self.difficulty.extend(array('d', [0.0]) * cap)
+        self.ew_shares.extend(array('d', [0.0]) * cap)
+        self.ew_time.extend(array('d', [0.0]) * cap)
+        self.connections.extend([None] * cap)
+        self.worker_names.extend([None] * cap)
+        self.free.extend(range(2 * cap - 1, cap - 1, -1))
+
+    def allocate(self, connection_ref, worker_name, difficulty, last_rtc, now):
+        if not self.free:
+            self._grow()
+        slot = self.free.pop()
+        self.shares[slot] = 0
+        self.last_rtc[slot] = last_rtc
+        self.last_ts[slot] = now
+        self.difficulty[slot] = difficulty
+        self.ew_shares[slot] = 0.0
+        self.ew_time[slot] = 0.0
+        self.connections[slot] = connection_ref
+        self.worker_names[slot] = worker_name
+        self.used += 1
+        self.wheel.schedule(slot, now + self.idle_time)
+        return slot
+
+    def release(self, slot):
+        if self.connections[slot] is None:
+            return
+        self.connections[slot] = None
+        self.worker_names[slot] = None
+        self.free.append(slot)
+        self.used -= 1
+        self.wheel.cancel(slot)
+
+    def add_share(self, slot, now):
+        self.shares[slot] += 1
+        self.last_ts[slot] = now
+
+    def collect(self, now, retarget):
+        '''Returns [(slot, shares, elapsed), ...] for the live slots whose
+        retarget period is over and starts a new period for them.
+        Slots of closed connections are released.'''
+        last_rtc = self.last_rtc
+        due = [ slot for slot, t in enumerate(last_rtc) if now - t >= retarget ]
+
+        result = []
+        shares = self.shares
+        connections = self.connections
+        for slot in due:
+            ref = connections[slot]
+            if ref is None:
+                continue
+            if ref() is None:
+                self.release(slot)
+                self.evicted_closed += 1
+                continue
+            result.append((slot, shares[slot], now - last_rtc[slot]))
+            shares[slot] = 0
+            last_rtc[slot] = now
+        return result
+
+    def expire(self, now):
+        '''Releases the slots which are idle or belong to closed
+        connections and returns [(slot, connection_ref), ...] of the idle
+        ones whose connection is still open'''
+        idle = []
+        for slot in self.wheel.advance(now):
+            ref = self.connections[slot]
+            if ref is None:
+                continue
+            if ref() is None:
+                self.release(slot)
+                self.evicted_closed += 1
+            elif now - self.last_ts[slot] >= self.idle_time:
+                self.release(slot)
+                self.evicted_idle += 1
+                idle.append((slot, ref))
+            else:
+                # Had shares since it was scheduled
+                self.wheel.schedule(slot, self.last_ts[slot] + self.idle_time)
+        return idle
+
+    def get_stats(self):
+        return {
+            'slots': self.used,
+            'capacity': len(self.shares),
+            'scheduled': len(self.wheel),
+            'evicted_idle': self.evicted_idle,
+            'evicted_closed': self.evicted_closed,
+        }
+
+# A week of reconnect churn in simulated time, run with PYTHONPATH=. from the top directory
+def _soak(days=7, connections=2000, churn=0.01, idle=0.05, step=30, idle_time=600):
+    import random
+    import time
+    import weakref
+
+    class Connection(object):
+        pass
+
+    random.seed(1)
+    now = 0
+    table = VardiffTable(idle_time, now=now)
+    live = []       # [connection, slot, silent]
+    slots = {}      # slot -> entry of live
+    start = time.time()
+    peak = 0
+    expire_time = 0.0
+
+    def connect(entry, n):
+        c = Connection()
+        entry[0] = c
+        entry[1] = table.allocate(weakref.ref(c), 'w%d' % n, 1.0, now, now)
+        slots[entry[1]] = entry
+
+    for i in xrange(connections):
+        live.append([None, None, False])
+        connect(live[-1], i)
+
+    n = connections
+    end = days * 86400
+    while now < end:
+        now += step
+        # Every minute `churn` of the connections reconnect, `idle` of the new ones never submit
+        for entry in random.sample(live, int(len(live) * churn * step / 60)):
+            connect(entry, n)
+            entry[2] = random.random() < idle
+            n += 1
+
+        for entry in live:
+            if entry[1] is not None and not entry[2]:
+                table.add_share(entry[1], now)
+
+        s = time.time()
+        for (slot, ref) in table.expire(now):
+            slots.pop(slot)[1] = None
+        expire_time += time.time() - s
+        peak = max(peak, len(table))
+
+    stats = table.get_stats()
+    print "%d days, %d connections, %d connects: peak %d slots, capacity %d, %d now" % (days, connections, n,
+        peak, stats['capacity'], stats['slots'])
+    print "evicted idle %d, closed %d, %.03f ms expiry per %d sec step, total %.01f sec" % (stats['evicted_idle'],
+        stats['evicted_closed'], expire_time * 1000 / (end / step), step, time.time() - start)
+
+if __name__ == '__main__':
+    _soak()
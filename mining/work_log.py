@@ -0,0 +1,89 @@
+'''Bounded per-connection log of the work sent to a miner.'''
+
+from array import array
+
+class WorkLog(object):
+    '''Hands out the work_ids of one connection and remembers the last
+    `size` of them. work_ids are a per-connection sequence number, the
+    entry for sequence number n lives in slot n % size, so a lookup is
+    one index and one compare, and a work_id can't be reused while an
+    older entry with the same id is still around (that would take 2**64
+    broadcasts). Sending new work overwrites the oldest slot, work older
+    than `expire` seconds is treated as unknown on lookup.'''
+    __slots__ = ('seq', 'seqs', 'job_ids', 'difficulties', 'timestamps')
+
+    def __init__(self, size):
+        self.seq = 0
+        self.seqs = array('L', [0]) * size     # 0 marks an empty slot
+        self.job_ids = [None] * size
+        self.difficulties = array('d', [0.0]) * size
+        self.timestamps = array('d', [0.0]) * size
+
+    def __len__(self):
+        return len([ s for s in self.seqs if s ])
+
+    def add(self, job_id, difficulty, timestamp):
+        '''Stores the work and returns its new work_id'''
+        self.seq += 1
+        slot = self.seq % len(self.seqs)
+        self.seqs[slot] = self.seq
+        self.job_ids[slot] = job_id
+        self.difficulties[slot] = difficulty
+        self.timestamps[slot] = timestamp
+        return "%x" % self.seq
+
+    def get(self, work_id, now, expire):
+        '''Returns (job_id, difficulty, timestamp) or None for unknown,
+        overwritten or expired work'''
+        try:
+            seq = int(work_id, 16)
+        except (TypeError, ValueError):
+            return None
+
+        slot = seq % len(self.seqs)
+        if seq == 0 or self.seqs[slot] != seq or now > self.timestamps[slot] + expire:
+            return None
+        return (self.job_ids[slot], self.difficulties[slot], self.timestamps[slot])
+
+    def clear(self):
+        size = len(self.seqs)
+        self.seqs = array('L', [0]) * size
+        self.job_ids = [None] * size
+
+# Expiry cost against connection count, the old WorkLogPruner scan vs the ring
+def _bench(counts=(1000, 10000, 50000), broadcasts=64, size=32, expire=180):
+    import time
+
+    for connections in counts:
+        # Old layout: one dict per connection, scanned every minute
+        job_log = {}
+        ts = 0
+        for b in xrange(broadcasts):
+            for c in xrange(connections):
+                job_log.setdefault(c, {})['%x' % b] = (b, 16, ts)
+            ts += 30
+        s = time.time()
+        now = ts
+        for userwork in job_log.itervalues():
+            for wli in tuple(userwork.keys()):
+                if now > userwork[wli][2] + expire:
+                    del userwork[wli]
+        scan = time.time() - s
+
+        logs = [ WorkLog(size) for c in xrange(connections) ]
+        s = time.time()
+        for b in xrange(broadcasts):
+            for l in logs:
+                l.add(b, 16, b * 30)
+        ring = (time.time() - s) / broadcasts
+
+        s = time.time()
+        for l in logs:
+            l.get('%x' % broadcasts, ts, expire)
+        lookup = (time.time() - s) / connections
+
+        print "%6d connections: pruner scan %.03f sec (blocks the dicts), ring add+expiry %.03f sec per broadcast, lookup %.02f us" % (
+            connections, scan, ring, lookup * 1e6)
+
+if __name__ == '__main__':
+    _bench()
@@ -0,0 +1,136 @@
+'''Multi-process mode: worker side, see mining/supervisor.py.
+
+A worker is launcher.tac started by the supervisor with
+STRATUM_WORKER_ID set. It listens on the stratum port with SO_REUSEPORT,
+so the kernel spreads new connections over the workers, and gets
+templates from the supervisor instead of the coin daemon.'''
+
+import socket
+from twisted.internet import reactor, protocol, stdio
+
+import lib.settings as settings
+from lib.ipc import IPCChannel
+from interfaces import Interfaces
+
+import lib.logger
+log = lib.logger.get_logger('worker_process')
+
+# IPCChannel to the supervisor, None when running as a single process
+supervisor = None
+
+class SupervisorConnection(protocol.Protocol):
+    def __init__(self, handler):
+        self.handler = handler
+
+    def connectionMade(self):
+        global supervisor
+        supervisor = IPCChannel(self.transport.write, self.handler)
+
+    def dataReceived(self, data):
+        supervisor.data_received(data)
+
+    def connectionLost(self, reason):
+        log.error("Lost the supervisor, exiting")
+        supervisor.connection_lost()
+        if reactor.running:
+            reactor.stop()
+
+class SupervisorCalls(object):
+    '''Calls of the supervisor'''
+
+    def ipc_update_block(self):
+        if Interfaces.template_registry is not None:
+            Interfaces.template_registry.update_block()
+
+    def ipc_admin(self, method, *params):
+        # An admin call relayed to all workers, see service.relay_admin
+        import service
+        return service.ADMIN_CALLS[method](*params)
+
+class WorkerRPC(object):
+    '''Stands in for BitcoinRPC, the supervisor makes the daemon calls'''
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def getblocktemplate(self):
+        # The template the supervisor fetched last
+        return self.channel.call('getblocktemplate')
+
+    def submitblock(self, block_hex, block_hash_hex):
+        return self.channel.call('submitblock', block_hex, block_hash_hex)
+
+    def prevhash(self):
+        return self.channel.call('prevhash')
+
+    def validateaddress(self, address):
+        return self.channel.call('validateaddress', address)
+
+    def getinfo(self):
+        return self.channel.call('getinfo')
+
+    def getdifficulty(self):
+        return self.channel.call('getdifficulty')
+
+    def blockexists(self, block_hash_hex):
+        return self.channel.call('blockexists', block_hash_hex)
+
+class WorkerShareManager(object):
+    '''Hands shares and found blocks to the supervisor's share manager'''
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def on_network_block(self):
+        pass
+
+    def on_submit_share(self, worker_name, block_hash, difficulty, pool_share, timestamp, is_valid, ip, invalid_reason, share_diff, job_id):
+        self.channel.notify('share', worker_name, block_hash, difficulty, pool_share, timestamp, is_valid, ip,
+            invalid_reason, share_diff, job_id)
+
+    def on_submit_block(self, is_accepted, worker_name, block_hash, timestamp, ip, share_diff):
+        self.channel.notify('block', is_accepted, worker_name, block_hash, timestamp, ip, share_diff)
+
+def listen_reuseport(port, factory, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Python 2 doesn't know the constant, 15 on Linux
+    sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+    sock.bind(('', port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    listener = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    # The reactor has its own copy of the descriptor
+    sock.close()
+    return listener
+
+def start(worker_id, on_startup):
+    '''Connects to the supervisor and takes over the stratum port from
+    stratum's own listener. Called by launcher.tac after stratum.setup()'''
+    from stratum import settings as stratum_settings
+    from stratum.socket_transport import SocketTransportFactory
+    from stratum.services import ServiceEventHandler
+
+    stdio.StandardIO(SupervisorConnection(SupervisorCalls()), stdin=3, stdout=4)
+    Interfaces.set_share_manager(WorkerShareManager(supervisor))
+
+    port = stratum_settings.LISTEN_SOCKET_TRANSPORT
+    stratum_settings.LISTEN_SOCKET_TRANSPORT = None
+    if worker_id != 0:
+        # Only one process can have the other transports
+        stratum_settings.LISTEN_HTTP_TRANSPORT = None
+        stratum_settings.LISTEN_HTTPS_TRANSPORT = None
+        stratum_settings.LISTEN_WS_TRANSPORT = None
+        stratum_settings.LISTEN_WSS_TRANSPORT = None
+
+    def listen(result):
+        factory = SocketTransportFactory(debug=stratum_settings.DEBUG,
+                                         signing_id=stratum_settings.SIGNING_ID,
+                                         event_handler=ServiceEventHandler,
+                                         tcp_proxy_protocol_enable=stratum_settings.TCP_PROXY_PROTOCOL)
+        listen_reuseport(port, factory)
+        log.info("Worker %d (instance %d) listening on port %d" % (worker_id, settings.INSTANCE_ID, port))
+        return result
+
+    if port:
+        on_startup.addCallback(listen)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+'''Stratum load generator: opens connections to a running pool, subscribes,
+authorizes and submits shares as fast as the pool answers them, then
+prints the answered mining.submit calls per second.
+
+Shares carry made up nonces, so most are rejected as above target; the
+pool still does the full check (coinbase, merkle root, header, PoW) for
+each of them. Set the workers' VARIABLE_DIFF = False so the difficulty
+stays put.
+
+Scaling of the multi-process mode: start "twistd -ny supervisor.tac"
+with WORKER_PROCESSES = 1, 2, 4 ... (restart in between) and run for
+each
+
+  python scripts/stratum_loadgen.py --host 127.0.0.1 --port 3333 \\
+      --processes 4 --connections 200 --seconds 30
+
+on another machine or on cores the pool doesn't use.'''
+
+import json
+import multiprocessing
+import optparse
+import select
+import socket
+import struct
+import time
+
+class Client(object):
+    def __init__(self, host, port, worker, password, depth):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.worker = worker
+        self.password = password
+        self.depth = depth
+        self.buffer = ''
+        self.out = ''
+        self.request_id = 0
+        self.extranonce2_size = None
+        self.extranonce2 = 0
+        self.job = None             # (work_id, ntime)
+        self.authorized = False
+        self.inflight = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.send('mining.subscribe', [])
+
+    def send(self, method, params):
+        self.request_id += 1
+        self.out += json.dumps({'id': self.request_id, 'method': method, 'params': params}) + '\n'
+        return self.request_id
+
+    def flush(self):
+        if self.out:
+            sent = self.sock.send(self.out)
+            self.out = self.out[sent:]
+
+    def submit(self):
+        while self.authorized and self.job is not None and self.inflight < self.depth:
+            self.extranonce2 += 1
+            extranonce2 = ('%x' % self.extranonce2).zfill(self.extranonce2_size * 2)[-self.extranonce2_size * 2:]
+            nonce = struct.pack('>L', self.extranonce2 & 0xffffffff).encode('hex')
+            self.send('mining.submit', [self.worker, self.job[0], extranonce2, self.job[1], nonce])
+            self.inflight += 1
+
+    def read(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError("Connection closed by the pool")
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            if line:
+                self.message(json.loads(line))
+        self.submit()
+
+    def message(self, message):
+        if message.get('method') == 'mining.notify':
+            params = message['params']
+            self.job = (params[0], params[7])
+            return
+        if message.get('method') is not None:
+            return
+
+        if message['id'] == 1:
+            # mining.subscribe
+            self.extranonce2_size = message['result'][2]
+            self.send('mining.authorize', [self.worker, self.password])
+        elif message['id'] == 2:
+            self.authorized = message.get('result') is True
+            if not self.authorized:
+                raise EOFError("Worker %s not authorized: %s" % (self.worker, message.get('error')))
+        else:
+            self.inflight -= 1
+            if message.get('result') is True:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+
+def run(host, port, worker, password, connections, depth, start, until, result):
+    clients = [ Client(host, port, worker, password, depth) for i in xrange(connections) ]
+    by_sock = dict([ (c.sock, c) for c in clients ])
+    counted = False
+    base = (0, 0)
+    error = None
+    try:
+        while time.time() < until:
+            if not counted and time.time() >= start:
+                # Connect and authorize storm is over, count from here
+                base = (sum([ c.accepted for c in clients ]), sum([ c.rejected for c in clients ]))
+                counted = True
+            writers = [ c.sock for c in clients if c.out ]
+            (readable, writable, _) = select.select(by_sock.keys(), writers, [], 0.1)
+            for sock in writable:
+                by_sock[sock].flush()
+            for sock in readable:
+                by_sock[sock].read()
+    except (EOFError, socket.error) as e:
+        error = str(e)
+    for c in clients:
+        c.sock.close()
+    accepted = sum([ c.accepted for c in clients ]) - base[0]
+    rejected = sum([ c.rejected for c in clients ]) - base[1]
+    result.put((accepted, rejected, error))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=3333)
+    parser.add_option('--worker', default='bench.1')
+    parser.add_option('--password', default='x')
+    parser.add_option('--processes', type='int', default=multiprocessing.cpu_count(),
+        help="load generator processes")
+    parser.add_option('--connections', type='int', default=100, help="connections per process")
+    parser.add_option('--depth', type='int', default=4, help="mining.submit calls in flight per connection")
+    parser.add_option('--warmup', type='float', default=5, help="seconds before counting starts")
+    parser.add_option('--seconds', type='float', default=30)
+    (options, args) = parser.parse_args()
+
+    start = time.time() + options.warmup
+    until = start + options.seconds
+    result = multiprocessing.Queue()
+    procs = [ multiprocessing.Process(target=run, args=(options.host, options.port, options.worker,
+        options.password, options.connections, options.depth, start, until, result))
+        for i in xrange(options.processes) ]
+    for p in procs:
+        p.start()
+    results = [ result.get() for p in procs ]
+    for p in procs:
+        p.join()
+
+    for (accepted, rejected, error) in results:
+        if error:
+            print "load generator process failed: %s" % error
+    accepted = sum([ r[0] for r in results ])
+    rejected = sum([ r[1] for r in results ])
+    print "%d connections: %d shares/s answered (%d accepted, %d rejected) over %d sec" % (
+        options.processes * options.connections, (accepted + rejected) / options.seconds,
+        accepted, rejected, options.seconds)
+
+if __name__ == '__main__':
+    main()